@@ -0,0 +1,52 @@
+import os
+import sys
+import gzip
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from known_stops import KnownStopIndex
+
+# python3 benchmarks/bench_known_stops.py
+# Membership of the naptanIds of one Arrivals feed (~20k distinct ids) in the known stops (~20k ids):
+# previous list scan versus the persisted set, with and without the Bloom filter in front.
+
+KNOWN_STOPS = 20000
+FEED_IDS = 20000
+NEW_IDS = 150
+
+
+def main():
+    random.seed(42)
+    known_ids = [f'490{i:07d}A' for i in range(KNOWN_STOPS)]
+    feed_ids = random.sample(known_ids, FEED_IDS - NEW_IDS) + [f'490{i:07d}N' for i in range(NEW_IDS)]
+    # New ids spread over the feed, so the timed slice holds some of them too
+    random.shuffle(feed_ids)
+
+    # The list scan is quadratic, it is timed on a slice of the feed and scaled up
+    sample = feed_ids[:500]
+    start = time.perf_counter()
+    unknown_sample = [n for n in sample if n not in known_ids]
+    list_time = (time.perf_counter() - start) * len(feed_ids) / len(sample)
+
+    print(f'{FEED_IDS} feed ids against {KNOWN_STOPS} known ids, {NEW_IDS} new')
+    print(f'list scan (scaled)  : {list_time:8.3f}s')
+    for use_bloom_filter in (False, True):
+        start = time.perf_counter()
+        known_stops = KnownStopIndex(known_ids, use_bloom_filter=use_bloom_filter)
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        unknown = known_stops.unknown(feed_ids)
+        lookup_time = time.perf_counter() - start
+        name = 'bloom filter + set' if use_bloom_filter else 'set'
+        # Same answer as the list scan on the slice it timed
+        assert known_stops.unknown(sample) == unknown_sample, name
+        print(f'{name:<20}: {lookup_time:8.3f}s lookups ({len(unknown)} unknown), {build_time:.3f}s to build')
+
+    set_size = len(gzip.compress('\n'.join(sorted(known_ids)).encode('utf-8')))
+    bloom_size = len(KnownStopIndex(known_ids, use_bloom_filter=True).bloom_filter.to_bytes())
+    print(f'persisted set: {set_size / 1024:.1f} KB gzip, Bloom filter: {bloom_size / 1024:.1f} KB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tfl_client import TflClient
+from stoppoint_fetcher import fetch_stop_points
+
+# python3 benchmarks/bench_stoppoint_fetch.py
+# StopPoint discovery against a local fake TfL server (fixed latency per request, a multi-id request with
+# an unknown id answers 404 like TfL does, every 50th request answers 429):
+#   1) previous loop: one request per id, sequential (its sleep(5) every 6 calls is left out)
+#   2) concurrent single-id requests
+#   3) concurrent multi-id batches with single-id fallback for failed batches
+# The client has no TfL quota for the run, the time the same request count takes at the quota is printed.
+
+NAPTAN_IDS = [f'4900{i:05d}A' for i in range(2000)]
+UNKNOWN_IDS = set(NAPTAN_IDS[::97])
+LATENCY_SECONDS = 0.03
+TFL_REQUESTS_PER_MINUTE = 450
+
+
+class FakeTflHandler(BaseHTTPRequestHandler):
+    requests_served = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with FakeTflHandler.lock:
+            FakeTflHandler.requests_served += 1
+            request_number = FakeTflHandler.requests_served
+        time.sleep(LATENCY_SECONDS)
+
+        ids = urlparse(self.path).path.split('/StopPoint/', 1)[1].split(',')
+        if request_number % 50 == 0:
+            self.answer(429, {'message': 'Too many requests'}, {'Retry-After': '0'})
+        elif any(naptan_id in UNKNOWN_IDS for naptan_id in ids):
+            self.answer(404, {'message': 'The following stop point is not recognised'})
+        else:
+            stations = [{'naptanId': naptan_id, 'commonName': f'Stop {naptan_id}', 'lat': 51.5, 'lon': -0.12}
+                        for naptan_id in ids]
+            self.answer(200, stations if len(ids) > 1 else stations[0])
+
+    def answer(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def previous_loop(tfl_client, naptan_ids):
+    rows = []
+    for naptan_id in naptan_ids:
+        res = tfl_client.get(f'StopPoint/{naptan_id}')
+        if res.status_code == 200:
+            station = res.json()
+            rows.append((naptan_id, station['commonName'], station['lat'], station['lon']))
+    return len(rows)
+
+
+def concurrent_fetch(tfl_client, naptan_ids, batch_size):
+    rows = []
+    fetch_stop_points(tfl_client, naptan_ids, rows.extend, concurrency=16, batch_size=batch_size, base_backoff=0.01)
+    return len(rows)
+
+
+def measure(name, function, *args):
+    FakeTflHandler.requests_served = 0
+    start = time.perf_counter()
+    stops = function(*args)
+    elapsed = time.perf_counter() - start
+    requests_served = FakeTflHandler.requests_served
+    at_quota = requests_served / TFL_REQUESTS_PER_MINUTE * 60
+    print(f'{name:>22} | {stops:>5} | {requests_served:>8} | {elapsed:>8.2f} | {at_quota:>13.0f}')
+
+
+def main():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTflHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tfl_client = TflClient(base_url=f'http://127.0.0.1:{server.server_address[1]}', pool_size=16)
+
+    print(f'{len(NAPTAN_IDS)} ids, {len(UNKNOWN_IDS)} unknown to TfL, {LATENCY_SECONDS * 1000:.0f} ms per request')
+    print(f"{'path':>22} | {'stops':>5} | {'requests':>8} | {'wall (s)':>8} | {'at quota (s)':>13}")
+    # Few ids only for the sequential loop, its time is scaled to the full list
+    sample = NAPTAN_IDS[:200]
+    FakeTflHandler.requests_served = 0
+    start = time.perf_counter()
+    previous_loop(tfl_client, sample)
+    scale = len(NAPTAN_IDS) / len(sample)
+    print(f"{'sequential (scaled)':>22} | {'-':>5} | {FakeTflHandler.requests_served * scale:>8.0f} | "
+          f"{(time.perf_counter() - start) * scale:>8.2f} | {len(NAPTAN_IDS) / TFL_REQUESTS_PER_MINUTE * 60:>13.0f}")
+    measure('concurrent single-id', concurrent_fetch, tfl_client, NAPTAN_IDS, 1)
+    measure('concurrent batch of 20', concurrent_fetch, tfl_client, NAPTAN_IDS, 20)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+import os
+import time
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from google.api_core import exceptions as gcp_exceptions
+
+# Durable work queue of naptanIds waiting for their StopPoint coordinates, one row per id:
+#   pending    waiting to be claimed (retry_after set after a failure: not before that time)
+#   in_flight  claimed by a worker, claimed again by another one once its lease expires (worker crashed)
+#   done       coordinates stored, never asked again
+#   failed     gave up after max_attempts
+# Workers claim batches, mark ids done as soon as their rows are stored and release what they could not
+# start, so a run that stops half way is resumed without asking TfL again for finished ids.
+#
+# Between function invocations the database lives in the bucket. Every invocation works on its own copy, so a
+# claim is only visible to the others once uploaded: uploads are generation-match writes, and an invocation
+# that lost the race downloads the latest copy, replays its own changes on it and tries again
+# (sync_queue_file). Two overlapping invocations therefore never claim the same ids nor drop each other's acks.
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+# The database file is kept in the bucket between function invocations
+QUEUE_OBJECT_PATH = 'discovery_queue/discovery_queue.sqlite3'
+# The arrivals job creates one empty object per stop it could not place, see predicted_arrivals/discovery_inbox.py
+DISCOVERY_INBOX_PREFIX = 'discovery_inbox/'
+
+LEASE_SECONDS = float(os.environ.get('DISCOVERY_LEASE_SECONDS', 15 * 60))
+MAX_ATTEMPTS = int(os.environ.get('DISCOVERY_MAX_ATTEMPTS', 5))
+RETRY_BASE_SECONDS = float(os.environ.get('DISCOVERY_RETRY_BASE_SECONDS', 5 * 60))
+
+
+class DiscoveryQueue:
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS,
+                 retry_base_seconds=RETRY_BASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.connect()
+
+    def connect(self):
+        # isolation_level=None: transactions are opened explicitly, see transaction()
+        self.connection = sqlite3.connect(self.path, isolation_level=None, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS discovery_items (
+                naptan_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                retry_after REAL NOT NULL DEFAULT 0,
+                claimed_by TEXT,
+                claimed_at REAL,
+                updated_at REAL NOT NULL,
+                last_error TEXT
+            )''')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS discovery_items_state ON discovery_items (state, retry_after)')
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, two workers never claim the same id
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.connection
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def enqueue(self, naptan_ids):
+        # Ids already in the queue keep their state, returns how many were added
+        now = time.time()
+        with self.transaction() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                'INSERT OR IGNORE INTO discovery_items (naptan_id, state, updated_at) VALUES (?, ?, ?)',
+                [(naptan_id, PENDING, now) for naptan_id in naptan_ids])
+            return connection.total_changes - before
+
+    def claim(self, worker_id, limit):
+        # Ready pending ids, and in flight ids whose lease expired, become in flight for this worker
+        now = time.time()
+        with self.transaction() as connection:
+            rows = connection.execute('''
+                SELECT naptan_id FROM discovery_items
+                WHERE (state = ? AND retry_after <= ?) OR (state = ? AND claimed_at < ?)
+                ORDER BY retry_after, updated_at
+                LIMIT ?''', (PENDING, now, IN_FLIGHT, now - self.lease_seconds, limit)).fetchall()
+            naptan_ids = [row[0] for row in rows]
+            connection.executemany('''
+                UPDATE discovery_items SET state = ?, claimed_by = ?, claimed_at = ?, updated_at = ?
+                WHERE naptan_id = ?''', [(IN_FLIGHT, worker_id, now, now, naptan_id) for naptan_id in naptan_ids])
+        return naptan_ids
+
+    def mark_done(self, naptan_ids):
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany('''
+                UPDATE discovery_items SET state = ?, claimed_by = NULL, updated_at = ?, last_error = NULL
+                WHERE naptan_id = ?''', [(DONE, now, naptan_id) for naptan_id in naptan_ids])
+
+    def mark_failed(self, naptan_ids, error=None):
+        # Back to pending after an exponential delay, failed for good after max_attempts
+        now = time.time()
+        with self.transaction() as connection:
+            for naptan_id in naptan_ids:
+                row = connection.execute('SELECT attempts FROM discovery_items WHERE naptan_id = ?',
+                                         (naptan_id,)).fetchone()
+                attempts = (row[0] if row else 0) + 1
+                state = FAILED if attempts >= self.max_attempts else PENDING
+                retry_after = now + self.retry_base_seconds * 2 ** (attempts - 1)
+                connection.execute('''
+                    UPDATE discovery_items SET state = ?, attempts = ?, retry_after = ?, claimed_by = NULL,
+                        updated_at = ?, last_error = ?
+                    WHERE naptan_id = ?''', (state, attempts, retry_after, now, error, naptan_id))
+
+    def release(self, naptan_ids):
+        # Claimed but never started (time budget spent), pending again right away with no attempt counted
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany('''
+                UPDATE discovery_items SET state = ?, claimed_by = NULL, updated_at = ?
+                WHERE naptan_id = ? AND state = ?''', [(PENDING, now, naptan_id, IN_FLIGHT) for naptan_id in naptan_ids])
+
+    def backlog(self):
+        # {'ready': n, 'delayed': n, 'in_flight': n, 'done': n, 'failed': n, 'next_retry_at': time or None}
+        now = time.time()
+        counts = {'ready': 0, 'delayed': 0, IN_FLIGHT: 0, DONE: 0, FAILED: 0}
+        for state, ready, count in self.connection.execute('''
+                SELECT state, retry_after <= ?, COUNT(*) FROM discovery_items GROUP BY state, retry_after <= ?''',
+                                                           (now, now)):
+            if state == PENDING:
+                counts['ready' if ready else 'delayed'] += count
+            else:
+                counts[state] += count
+        counts['next_retry_at'] = self.connection.execute(
+            'SELECT MIN(retry_after) FROM discovery_items WHERE state = ? AND retry_after > ?',
+            (PENDING, now)).fetchone()[0]
+        return counts
+
+    def checkpoint(self):
+        # Folds the WAL into the database file, so the file alone holds every committed change
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        self.checkpoint()
+        self.connection.close()
+
+    def snapshot(self, snapshot_path):
+        # Consistent single file copy of the database (online backup), committed WAL content included
+        destination = sqlite3.connect(snapshot_path)
+        try:
+            self.connection.backup(destination)
+        finally:
+            destination.close()
+
+
+def remove_database_files(path):
+    for file_path in (path, f'{path}-wal', f'{path}-shm'):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+def restore_queue_file(bucket, local_path, object_path=QUEUE_OBJECT_PATH):
+    # Returns the generation of the object downloaded to local_path, 0 when the queue is new
+    # WAL files of a previous copy would be applied on top of the downloaded database, they are removed first
+    remove_database_files(local_path)
+    blob = bucket.blob(object_path)
+    try:
+        blob.download_to_filename(local_path)
+    except gcp_exceptions.NotFound:
+        remove_database_files(local_path)
+        return 0
+    return blob.generation
+
+
+def reload_queue(bucket, queue, object_path=QUEUE_OBJECT_PATH):
+    # Replaces the local copy of the queue by the latest stored one, returns its generation
+    queue.connection.close()
+    generation = restore_queue_file(bucket, queue.path, object_path)
+    queue.connect()
+    return generation
+
+
+def sync_queue_file(bucket, queue, generation, replay, object_path=QUEUE_OBJECT_PATH, max_attempts=5):
+    # Stores the queue with a generation match. When another invocation stored it in between, the latest copy is
+    # downloaded and replay(queue) applies this invocation's changes on it again before the next attempt.
+    # Returns the new generation, None when the queue could not be stored
+    for attempt in range(1, max_attempts + 1):
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as snapshot_file:
+            queue.snapshot(snapshot_file.name)
+            blob = bucket.blob(object_path)
+            try:
+                blob.upload_from_filename(snapshot_file.name, content_type='application/vnd.sqlite3',
+                                          if_generation_match=generation)
+                return blob.generation
+            except gcp_exceptions.PreconditionFailed:
+                print(f'Discovery queue {object_path} changed since it was restored, replaying ({attempt}/{max_attempts})')
+        generation = reload_queue(bucket, queue, object_path)
+        replay(queue)
+    print(f'Could not store discovery queue {object_path} after {max_attempts} attempts')
+    return None
+
+
+def read_discovery_inbox(bucket, prefix=DISCOVERY_INBOX_PREFIX):
+    # Returns (naptanIds, their inbox blobs), the blobs are deleted once the ids are safely in the queue
+    blobs = list(bucket.list_blobs(prefix=prefix))
+    return [blob.name[len(prefix):] for blob in blobs], blobs
+
+
+def clear_discovery_inbox(bucket, blobs):
+    # An id queued again by the arrivals job in between is simply enqueued again (and ignored) next run
+    bucket.delete_blobs(blobs, on_error=lambda blob: None)
@@ -0,0 +1,156 @@
+import os
+import gzip
+import math
+import struct
+import hashlib
+from datetime import datetime, timezone, timedelta
+from google.api_core import exceptions as gcp_exceptions
+
+# Persistent set of the naptanIds that already have coordinates, kept in the bucket next to the CSVs:
+#   known_stops/known_naptan_ids.txt.gz   one id per line, metadata 'reconciled_at'
+#   known_stops/known_naptan_ids.bloom    Bloom filter of the same ids, for callers that only need a fast
+#                                         "definitely not known" answer without downloading the set
+# New ids are added as their coordinates are stored, the BigQuery DISTINCT scan only reconciles the set
+# every KNOWN_STOPS_RECONCILE_HOURS.
+
+KNOWN_STOPS_PATH = 'known_stops/known_naptan_ids.txt.gz'
+BLOOM_FILTER_PATH = 'known_stops/known_naptan_ids.bloom'
+RECONCILE_HOURS = float(os.environ.get('KNOWN_STOPS_RECONCILE_HOURS', 24))
+# Optional: in process the set lookup alone is already O(1), the filter mostly serves readers of the .bloom object
+USE_BLOOM_FILTER = os.environ.get('KNOWN_STOPS_BLOOM_FILTER', '0') == '1'
+
+# Set of the last load, reused by a warm function instance while the object generation does not change
+_known_stops_cache = {'generation': None, 'naptan_ids': None, 'reconciled_at': None}
+
+
+class BloomFilter:
+    # k bit positions per id from two 64 bit halves of a blake2b digest (double hashing)
+
+    def __init__(self, capacity, false_positive_rate=0.01, num_bits=None, num_hashes=None, bits=None):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.num_bits = num_bits or max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.num_hashes = num_hashes or max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bits if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    def positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        # False: never added. True: added, or a false positive
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+    def to_bytes(self):
+        return struct.pack('<QI', self.num_bits, self.num_hashes) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        num_bits, num_hashes = struct.unpack_from('<QI', data)
+        return cls(1, num_bits=num_bits, num_hashes=num_hashes, bits=bytearray(data[12:]))
+
+
+class KnownStopIndex:
+
+    def __init__(self, naptan_ids, generation=0, reconciled_at=None, use_bloom_filter=USE_BLOOM_FILTER):
+        self.naptan_ids = set(naptan_ids)
+        self.generation = generation
+        self.reconciled_at = reconciled_at
+        self.added = set()
+        self.bloom_filter = None
+        if use_bloom_filter:
+            self.bloom_filter = BloomFilter(capacity=2 * len(self.naptan_ids) + 1000)
+            for naptan_id in self.naptan_ids:
+                self.bloom_filter.add(naptan_id)
+
+    def __contains__(self, naptan_id):
+        # Most ids in the feed are known, the Bloom filter rejects the unknown ones before the set lookup
+        if self.bloom_filter is not None and naptan_id not in self.bloom_filter:
+            return False
+        return naptan_id in self.naptan_ids
+
+    def __len__(self):
+        return len(self.naptan_ids)
+
+    def add_many(self, naptan_ids):
+        for naptan_id in naptan_ids:
+            if naptan_id not in self.naptan_ids:
+                self.naptan_ids.add(naptan_id)
+                self.added.add(naptan_id)
+                if self.bloom_filter is not None:
+                    self.bloom_filter.add(naptan_id)
+
+    def unknown(self, naptan_ids):
+        return [naptan_id for naptan_id in naptan_ids if naptan_id not in self]
+
+    def reconciliation_due(self, reconcile_hours=RECONCILE_HOURS):
+        if self.reconciled_at is None:
+            return True
+        return datetime.now(timezone.utc) - self.reconciled_at > timedelta(hours=reconcile_hours)
+
+    def reconcile(self, naptan_ids):
+        # BigQuery is the reference, ids added since the index was loaded may not be visible in it yet
+        self.naptan_ids = set(naptan_ids) | self.added
+        self.reconciled_at = datetime.now(timezone.utc)
+        if self.bloom_filter is not None:
+            self.rebuild_bloom_filter()
+
+    def rebuild_bloom_filter(self):
+        self.bloom_filter = BloomFilter(capacity=2 * len(self.naptan_ids) + 1000)
+        for naptan_id in self.naptan_ids:
+            self.bloom_filter.add(naptan_id)
+
+
+def load_known_stops(bucket):
+    # Returns a KnownStopIndex, empty (and due for reconciliation) when the bucket has none yet
+    blob = bucket.blob(KNOWN_STOPS_PATH)
+    try:
+        blob.reload()
+    except gcp_exceptions.NotFound:
+        return KnownStopIndex([])
+
+    if _known_stops_cache['generation'] != blob.generation:
+        data = blob.download_as_bytes(if_generation_match=blob.generation)
+        _known_stops_cache['naptan_ids'] = gzip.decompress(data).decode('utf-8').split()
+        reconciled_at = (blob.metadata or {}).get('reconciled_at')
+        _known_stops_cache['reconciled_at'] = datetime.fromisoformat(reconciled_at) if reconciled_at else None
+        _known_stops_cache['generation'] = blob.generation
+
+    return KnownStopIndex(_known_stops_cache['naptan_ids'], generation=blob.generation,
+                          reconciled_at=_known_stops_cache['reconciled_at'])
+
+
+def save_known_stops(bucket, known_stops, max_attempts=3):
+    # Generation-match write: when another run saved in between, its ids are merged in and the write retried
+    for attempt in range(1, max_attempts + 1):
+        blob = bucket.blob(KNOWN_STOPS_PATH)
+        blob.metadata = {'reconciled_at': known_stops.reconciled_at.isoformat()} if known_stops.reconciled_at else None
+        data = gzip.compress('\n'.join(sorted(known_stops.naptan_ids)).encode('utf-8'))
+        try:
+            blob.upload_from_string(data, content_type='application/gzip', if_generation_match=known_stops.generation)
+        except gcp_exceptions.PreconditionFailed:
+            print(f'Known stops changed while saving, merging and retrying ({attempt}/{max_attempts})')
+            latest = load_known_stops(bucket)
+            known_stops.add_many(latest.naptan_ids)
+            known_stops.generation = latest.generation
+            continue
+
+        known_stops.generation = blob.generation
+        _known_stops_cache.update({'generation': blob.generation, 'naptan_ids': list(known_stops.naptan_ids),
+                                   'reconciled_at': known_stops.reconciled_at})
+        if known_stops.bloom_filter is not None:
+            if len(known_stops) > known_stops.bloom_filter.capacity:
+                # Past its capacity the false positive rate climbs, sized again for the current set
+                known_stops.rebuild_bloom_filter()
+            bucket.blob(BLOOM_FILTER_PATH).upload_from_string(known_stops.bloom_filter.to_bytes(),
+                                                              content_type='application/octet-stream')
+        print(f'Saved {len(known_stops)} known naptanIds')
+        return True
+
+    print(f'Could not save known naptanIds after {max_attempts} attempts')
+    return False
@@ -1,13 +1,20 @@
 from google.cloud import storage, bigquery, pubsub_v1
 import csv
-import requests
 from datetime import datetime
 from io import StringIO
+import os
 import time
+import uuid
 from flask import Flask
+from tfl_client import TflClient
+from tfl_quota import DISCOVERY, quota_from_env
+from known_stops import load_known_stops, save_known_stops
+from discovery_queue import (DiscoveryQueue, clear_discovery_inbox, read_discovery_inbox, restore_queue_file,
+                             sync_queue_file)
+from stoppoint_fetcher import STOPPOINT_CONCURRENCY, STOPPOINT_HEADER, fetch_stop_points
 
 def fetch_naptan_ids(Request):
-    # 1) ---->  Read Table and fetch unique naptan Ids already captured
+    # 1) ---->  Known naptan Ids: persisted set in the bucket, the DISTINCT scan only reconciles it periodically
 
     PROJECT_ID = 'lon-trans-streaming-pipeline'
 
@@ -15,40 +22,39 @@ def fetch_naptan_ids(Request):
     data_set = 'bus_density_streaming_pipeline'
     table = 'stopspoint_coordinates'
 
-    # SQL query — adjust table name
-    query = f"""
-        SELECT DISTINCT naptanId
-        FROM `{PROJECT_ID}.{data_set}.{table}`
-    """
-    query_job = BQ_client.query(query)
-    results = query_job.result()
+    # GCS cconfiguration
+    BUCKET_NAME = 'bus_stop_points'
+    client = storage.Client(project=PROJECT_ID)
+    bucket = client.bucket(BUCKET_NAME)
 
-    existingNaptanIds = [row["naptanId"] for row in results]
+    known_stops = load_known_stops(bucket)
+    if known_stops.reconciliation_due():
+        # SQL query — adjust table name
+        query = f"""
+            SELECT DISTINCT naptanId
+            FROM `{PROJECT_ID}.{data_set}.{table}`
+        """
+        query_job = BQ_client.query(query)
+        results = query_job.result()
 
+        known_stops.reconcile(row["naptanId"] for row in results)
+        print(f'Reconciled known naptanIds with BigQuery: {len(known_stops)} ids')
+        save_known_stops(bucket, known_stops)
 
-    # 2) ----> API Call of buss arrivals tp get NaptanIds data
 
-    arrivals_url = "https://api.tfl.gov.uk/Mode/bus/Arrivals"
-    app_key = '132c49c6367b496ba654bc8092f0610a'
-    url_append = f'?app_key={app_key}' 
-    print(arrivals_url + url_append)
-    arrivals_response = requests.get(arrivals_url + url_append)
+    # 2) ----> New naptanIds: the arrivals job leaves the stops it could not place in the discovery inbox,
+    #          so the Arrivals feed it already downloads every cycle is not downloaded again here
 
-    if arrivals_response:
-        arrivals_response_json = arrivals_response.json()
-        naptanids = list(set([record['naptanId'] for record in arrivals_response_json]))
+    app_key = '132c49c6367b496ba654bc8092f0610a'
+    inbox_naptan_ids, inbox_blobs = read_discovery_inbox(bucket)
 
-    naptan_to_capture = [n for n in naptanids if n not in existingNaptanIds]
+    # Unknown ids join the durable discovery queue, ids already queued (or done, or failed for good) keep their state
+    queue_path = os.environ.get('DISCOVERY_QUEUE_PATH', '/tmp/discovery_queue.sqlite3')
+    queue_generation = restore_queue_file(bucket, queue_path)
+    queue = DiscoveryQueue(queue_path)
 
     # 3) ---> StopPoint API CALL
 
-    iteration = 0
-    time_sleep_iterator = 0 
-    batch_result = [('naptanId', 'commonName', 'latitude', 'longitud')]
-
-    # GCS cconfiguration
-    BUCKET_NAME = 'bus_stop_points'
-
     # Pub/Sub configuration
     TOPIC_ID = 'naptan_ids_recieved_trigger_again'
     publisher = pubsub_v1.PublisherClient()
@@ -56,58 +62,93 @@ def fetch_naptan_ids(Request):
     message_str = f"NaptanId Collection Processes finished, run again"
     message_bytes = message_str.encode("utf-8")
 
-    if naptan_to_capture:
-
-        for naptan_id in naptan_to_capture[0:300]: # Will process some at a time not all, eventutally data will be smaller
-
-            # API CALL FOR COORDINATES MAPPING
-            station_map_url = f'https://api.tfl.gov.uk/StopPoint/{naptan_id}'
-            res = requests.get(station_map_url)
-
-            if res.status_code == 200:
-                station = res.json()
-                commonName = station['commonName']
-                latitude =  station['lat']
-                longitud = station['lon']
-                batch_result.append((naptan_id,commonName,latitude,longitud))
-                print(f'Iteration {iteration} ✅')
-                iteration += 1
-                
-                if time_sleep_iterator == 5:
-                    time.sleep(5)
-                    time_sleep_iterator = 0
-                else:
-                    time_sleep_iterator += 1
-            
-            else:
-                print(f'Some errors in iteration {iteration} found, NaptanId: {naptan_id}, status code: {res.status_code}')
-                iteration += 1
-                continue
-
-        # Store in GCS bucket
+    # A crashed run leaves its ids in flight, they are claimed again once their lease expires
+    worker_id = f'{os.environ.get("K_REVISION", "local")}-{uuid.uuid4().hex[:8]}'
+    naptan_to_capture = []
+
+    def enqueue_and_claim(queue):
+        # Replayed on the latest copy when another invocation stored the queue first, so both never hold the same ids
+        added = queue.enqueue(known_stops.unknown(inbox_naptan_ids))
+        naptan_to_capture[:] = queue.claim(worker_id, limit=int(os.environ.get('STOPPOINT_MAX_PER_RUN', 5000)))
+        print(f'Queued {added} new naptanIds for discovery ({len(inbox_naptan_ids)} in the inbox), '
+              f'claimed {len(naptan_to_capture)}')
+
+    enqueue_and_claim(queue)
+    stored_generation = sync_queue_file(bucket, queue, queue_generation, enqueue_and_claim)
+    if stored_generation is None:
+        # Claims that were not stored are not leases, nothing is fetched and the inbox is left for the next run
+        naptan_to_capture = []
+    else:
+        if inbox_blobs:
+            # The inbox ids are in the stored queue now
+            clear_discovery_inbox(bucket, inbox_blobs)
+        queue_generation = stored_generation
 
-        now = datetime.now()
-        DESTINATION_PATH =  f"naptan_data/year={now.year}/month={now.month:02}/day={now.day:02}/hour={now.hour:02}/minute={now.minute:02}/naptan_snapshot.csv"
-        client = storage.Client(project=PROJECT_ID)
-        bucket = client.bucket(BUCKET_NAME)
-        blob = bucket.blob(DESTINATION_PATH)
+    # This run's changes, replayed on the latest copy of the queue when another invocation stored it in between
+    done_ids, failed_ids, skipped_ids = [], [], []
 
-        csv_buffer = StringIO()
-        writer = csv.writer(csv_buffer)
-        writer.writerows(batch_result)
+    def replay_changes(queue):
+        queue.mark_done(done_ids)
+        queue.mark_failed(failed_ids, error='StopPoint lookup failed')
+        queue.release(skipped_ids)
 
-        blob.upload_from_string(csv_buffer.getvalue(), content_type="text/csv")
+    def store_queue():
+        nonlocal queue_generation
+        stored_generation = sync_queue_file(bucket, queue, queue_generation, replay_changes)
+        if stored_generation is not None:
+            queue_generation = stored_generation
 
-        print(f'Stored {len(batch_result)-1} in GCS and now sending a message to pubsub to trigger process again')
+    if naptan_to_capture:
 
-        time.sleep(60)
-        # Send message tu pub/sub    
-        future = publisher.publish(topic_path, message_bytes)
-        print(f"✅ Message published. Message ID: {future.result()}")
-        return f'✅  Naptan Ids captured and sent to BigQuery', 200 
-    else:
-        print('No new Naptan Ids to capture')
-        time.sleep(60)
-        future = publisher.publish(topic_path, message_bytes)
-        print(f"✅ Message published. Message ID: {future.result()}")
-        return f'✅  No new Naptan Ids found', 200 
\ No newline at end of file
+        # Results are stored in GCS as they come, one CSV part per flush under this run's minute partition
+        now = datetime.now()
+        DESTINATION_PREFIX = f"naptan_data/year={now.year}/month={now.month:02}/day={now.day:02}/hour={now.hour:02}/minute={now.minute:02}"
+        stored_parts = []
+
+        def store_rows(rows):
+            blob = bucket.blob(f'{DESTINATION_PREFIX}/naptan_snapshot_part{len(stored_parts):04d}.csv')
+            csv_buffer = StringIO()
+            writer = csv.writer(csv_buffer)
+            writer.writerows([STOPPOINT_HEADER] + rows)
+            blob.upload_from_string(csv_buffer.getvalue(), content_type="text/csv")
+            stored_parts.append(len(rows))
+            # Stored ids are known from now on, the index is saved once the lookups are over
+            known_stops.add_many(row[0] for row in rows)
+            # Checkpoint: a run stopped after this point does not ask TfL again for these ids
+            done_ids.extend(row[0] for row in rows)
+            queue.mark_done([row[0] for row in rows])
+            store_queue()
+
+        # Concurrent lookups paced by the TfL quota, ids left when the time budget runs out are released to the queue
+        # Shared TfL budget at discovery priority: lookups wait while live arrivals need the tokens. The function
+        # and the arrivals job run on different hosts, the budget is the GCS one (TFL_QUOTA_BACKEND=gcs, the default)
+        # in TFL_QUOTA_BUCKET, the same bucket on both
+        tfl_quota = quota_from_env(caller='stop_discovery', priority=DISCOVERY, storage_client=client)
+        stoppoint_client = TflClient(app_key=app_key, pool_size=STOPPOINT_CONCURRENCY, quota=tfl_quota)
+        stats = fetch_stop_points(stoppoint_client, naptan_to_capture, store_rows,
+                                  time_budget_seconds=float(os.environ.get('STOPPOINT_TIME_BUDGET_SECONDS', 420)))
+        failed_ids.extend(stats['failed_ids'])
+        skipped_ids.extend(stats['skipped_ids'])
+        queue.mark_failed(failed_ids, error='StopPoint lookup failed')
+        queue.release(skipped_ids)
+        if stored_parts:
+            save_known_stops(bucket, known_stops)
+        if tfl_quota is not None:
+            print(f'TfL quota: {tfl_quota.metrics()}')
+
+        print(f'Stored {sum(stored_parts)} in GCS in {len(stored_parts)} files')
+
+    store_queue()
+    backlog = queue.backlog()
+    queue.close()
+    print(f'Discovery backlog: {backlog}')
+
+    # Runs follow the backlog: straight away while ids are ready, otherwise an idle wait before looking at the feed again
+    if backlog['ready'] == 0:
+        time.sleep(float(os.environ.get('DISCOVERY_IDLE_SECONDS', 60)))
+    # Send message tu pub/sub
+    future = publisher.publish(topic_path, message_bytes)
+    print(f"✅ Message published. Message ID: {future.result()}")
+    if naptan_to_capture:
+        return f'✅  Naptan Ids captured and sent to BigQuery', 200
+    return f'✅  No new Naptan Ids found', 200
@@ -0,0 +1,189 @@
+import os
+import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from tfl_quota import DeadlineExceeded
+
+# Concurrent StopPoint lookups. Ids are asked in batches through the multi-id endpoint /StopPoint/{id1,id2,...},
+# a batch that fails (one unknown id is enough) is asked again one id at a time. A fixed pool of workers pulls
+# batches from a queue, every request (retries included) is paced by the TfL quota of the client
+# (tfl_quota.TflQuota, shared with the arrivals job), 429 and 5xx answers are retried with jittered exponential
+# backoff. Once the time budget is spent no request is started and the ids left are returned as skipped. Rows are handed to the writer every flush_rows
+# results, so a run that is stopped half way keeps everything it fetched.
+
+STOPPOINT_CONCURRENCY = int(os.environ.get('STOPPOINT_CONCURRENCY', 16))
+
+STOPPOINT_HEADER = ('naptanId', 'commonName', 'latitude', 'longitud')
+STOPPOINT_BATCH_SIZE = int(os.environ.get('STOPPOINT_BATCH_SIZE', 20))
+
+
+def station_row(naptan_id, station):
+    return (naptan_id, station['commonName'], station['lat'], station['lon'])
+
+
+def station_ids(station):
+    # Ids a StopPoint answers for: its own and those of its child stops (a hub answers for its stops)
+    ids = {station.get('naptanId'), station.get('id')}
+    for child in station.get('children') or []:
+        ids |= station_ids(child)
+    ids.discard(None)
+    return ids
+
+
+def batch_station_rows(naptan_ids, stations):
+    # /StopPoint/{id1,id2,...} answers an array (a single object for one id). Stations are matched to the
+    # requested ids by naptanId or child stop id only, a single id takes the single station it was answered.
+    # Returns (rows, ids with no usable station), those are asked again one by one
+    if isinstance(stations, dict):
+        stations = [stations]
+    requested = set(naptan_ids)
+    matched = {}
+    for station in stations:
+        for station_id in station_ids(station) & requested:
+            # The requested stop itself wins over a hub listing it as a child
+            if station_id not in matched or station.get('naptanId', station.get('id')) == station_id:
+                matched[station_id] = station
+    if len(naptan_ids) == 1 and len(stations) == 1:
+        matched.setdefault(naptan_ids[0], stations[0])
+
+    rows, missing = [], []
+    for naptan_id in naptan_ids:
+        try:
+            rows.append(station_row(naptan_id, matched[naptan_id]))
+        except KeyError:
+            missing.append(naptan_id)
+    return rows, missing
+
+
+def retry_delay(attempt, retry_after, base_backoff, max_backoff):
+    # Full jitter, never shorter than the Retry-After TfL sent with a 429
+    delay = random.uniform(0, min(max_backoff, base_backoff * 2 ** attempt))
+    try:
+        return max(delay, float(retry_after)) if retry_after else delay
+    except ValueError:
+        return delay
+
+
+async def request_stop_points(tfl_client, naptan_ids, semaphore, deadline, max_retries, base_backoff, max_backoff):
+    # Returns the decoded StopPoint response, or None when the ids do not exist or the request kept failing
+    # Raises DeadlineExceeded when the time budget ran out while waiting for a token or backing off
+    label = ','.join(naptan_ids)
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        # The semaphore bounds requests in flight, it is not held while backing off
+        async with semaphore:
+            if deadline is not None and time.monotonic() > deadline:
+                raise DeadlineExceeded(label)
+            try:
+                # The quota wait happens in the request thread, up to the deadline
+                response = await asyncio.to_thread(tfl_client.get, f'StopPoint/{label}', deadline=deadline)
+            except requests.RequestException as e:
+                response, error = None, e
+        if response is not None:
+            if response.status_code == 200:
+                try:
+                    return response.json()
+                except ValueError as e:
+                    print(f'NaptanId: {label}, unexpected StopPoint response: {e}')
+                    return None
+            if response.status_code != 429 and response.status_code < 500:
+                # e.g. 404: an id unknown to TfL, asking again would not change the answer
+                print(f'NaptanId: {label}, status code: {response.status_code}')
+                return None
+            error = f'status code {response.status_code}'
+            retry_after = response.headers.get('Retry-After')
+
+        if attempt == max_retries:
+            print(f'NaptanId: {label} failed after {attempt + 1} attempts: {error}')
+            return None
+        delay = retry_delay(attempt, retry_after, base_backoff, max_backoff)
+        if deadline is not None and time.monotonic() + delay > deadline:
+            raise DeadlineExceeded(label)
+        await asyncio.sleep(delay)
+
+
+async def fetch_stop_point_batch(tfl_client, naptan_ids, semaphore, deadline, retry_options):
+    # Returns (rows, failed ids, skipped ids), ids are skipped when the time budget ran out before they were asked
+    try:
+        stations = await request_stop_points(tfl_client, naptan_ids, semaphore, deadline, **retry_options)
+    except DeadlineExceeded:
+        # The ids are still unknown, the next run picks them up
+        return [], [], list(naptan_ids)
+    if stations is None:
+        rows, missing = [], list(naptan_ids)
+    else:
+        rows, missing = batch_station_rows(naptan_ids, stations)
+    if len(naptan_ids) == 1 or not missing:
+        return rows, missing, []
+
+    # One unknown id fails the whole multi-id request: the ids of a failed batch are asked one by one
+    failed = []
+    for i, naptan_id in enumerate(missing):
+        try:
+            station = await request_stop_points(tfl_client, [naptan_id], semaphore, deadline, **retry_options)
+        except DeadlineExceeded:
+            return rows, failed, missing[i:]
+        station_rows, _ = batch_station_rows([naptan_id], station) if station is not None else ([], None)
+        if station_rows:
+            rows += station_rows
+        else:
+            failed.append(naptan_id)
+    return rows, failed, []
+
+
+async def fetch_all_stop_points(tfl_client, naptan_ids, write_rows, concurrency, batch_size, time_budget_seconds,
+                                flush_rows, retry_options):
+    semaphore = asyncio.Semaphore(concurrency)
+    # One worker thread per request in flight, the default executor has min(32, cpus + 4) threads
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    deadline = time.monotonic() + time_budget_seconds if time_budget_seconds else None
+    stats = {'fetched': 0, 'failed': 0, 'skipped': 0, 'failed_ids': [], 'skipped_ids': []}
+    pending_rows = []
+    write_lock = asyncio.Lock()
+
+    batches = asyncio.Queue()
+    for i in range(0, len(naptan_ids), batch_size):
+        batches.put_nowait(naptan_ids[i:i + batch_size])
+
+    async def worker():
+        nonlocal pending_rows
+        while not batches.empty():
+            batch = batches.get_nowait()
+            if deadline is not None and time.monotonic() > deadline:
+                rows, failed, skipped = [], [], batch
+            else:
+                rows, failed, skipped = await fetch_stop_point_batch(tfl_client, batch, semaphore, deadline,
+                                                                     retry_options)
+            stats['fetched'] += len(rows)
+            stats['failed'] += len(failed)
+            stats['skipped'] += len(skipped)
+            stats['failed_ids'] += failed
+            stats['skipped_ids'] += skipped
+            pending_rows += rows
+            if len(pending_rows) >= flush_rows:
+                rows, pending_rows = pending_rows, []
+                async with write_lock:
+                    await asyncio.to_thread(write_rows, rows)
+
+    # Only concurrency batches are started at a time, the deadline is checked before each one
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    if pending_rows:
+        await asyncio.to_thread(write_rows, pending_rows)
+    return stats
+
+
+def fetch_stop_points(tfl_client, naptan_ids, write_rows, concurrency=STOPPOINT_CONCURRENCY,
+                      batch_size=STOPPOINT_BATCH_SIZE, time_budget_seconds=None, flush_rows=500, max_retries=4, base_backoff=0.5, max_backoff=30.0):
+    # write_rows(rows) receives (naptanId, commonName, latitude, longitud) tuples as they are fetched
+    # batch_size ids are asked per request (/StopPoint/{id1,id2,...}), 1 asks every id on its own
+    # Returns {'fetched': n, 'failed': n, 'skipped': n, 'failed_ids': [...], 'skipped_ids': [...]},
+    # skipped ids were left for lack of time budget
+    started_at = time.monotonic()
+    retry_options = {'max_retries': max_retries, 'base_backoff': base_backoff, 'max_backoff': max_backoff}
+    stats = asyncio.run(fetch_all_stop_points(tfl_client, list(naptan_ids), write_rows, concurrency, batch_size,
+                                              time_budget_seconds, flush_rows, retry_options))
+    print(f"StopPoint lookups: {stats['fetched']} fetched, {stats['failed']} failed, {stats['skipped']} left for "
+          f"the next run in {time.monotonic() - started_at:.1f}s")
+    return stats
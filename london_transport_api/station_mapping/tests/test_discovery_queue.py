@@ -0,0 +1,161 @@
+import os
+import sys
+import pytest
+from google.api_core import exceptions as gcp_exceptions
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import discovery_queue
+from discovery_queue import (DONE, FAILED, IN_FLIGHT, DiscoveryQueue, restore_queue_file, sync_queue_file)
+
+# python3 -m pytest tests/
+
+
+class FakeBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+
+    def download_to_filename(self, path):
+        if self.name not in self.bucket.objects:
+            raise gcp_exceptions.NotFound(self.name)
+        data, self.generation = self.bucket.objects[self.name]
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def upload_from_filename(self, path, content_type=None, if_generation_match=None):
+        current = self.bucket.objects.get(self.name, (None, 0))[1]
+        if if_generation_match is not None and if_generation_match != current:
+            raise gcp_exceptions.PreconditionFailed(self.name)
+        self.bucket.generation += 1
+        self.generation = self.bucket.generation
+        with open(path, 'rb') as f:
+            self.bucket.objects[self.name] = (f.read(), self.generation)
+
+
+class FakeBucket:
+
+    def __init__(self):
+        self.objects = {}
+        self.generation = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class Clock:
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(discovery_queue.time, 'time', clock)
+    return clock
+
+
+def states(queue):
+    return dict(queue.connection.execute('SELECT naptan_id, state FROM discovery_items'))
+
+
+def test_claims_are_exclusive_until_the_lease_expires(tmp_path, clock):
+    queue = DiscoveryQueue(str(tmp_path / 'queue.sqlite3'), lease_seconds=60)
+    assert queue.enqueue(['n1', 'n2', 'n3']) == 3
+    assert queue.enqueue(['n1', 'n4']) == 1
+
+    assert queue.claim('worker-a', limit=2) == ['n1', 'n2']
+    assert queue.claim('worker-b', limit=10) == ['n3', 'n4']
+    assert queue.claim('worker-b', limit=10) == []
+
+    # worker-a crashed: its ids are claimed again once the lease expired, ids marked done never are
+    queue.mark_done(['n3'])
+    clock.now += 61
+    assert sorted(queue.claim('worker-c', limit=10)) == ['n1', 'n2', 'n4']
+    assert states(queue)['n3'] == DONE
+
+
+def test_failed_ids_wait_for_their_retry_and_give_up_after_max_attempts(tmp_path, clock):
+    queue = DiscoveryQueue(str(tmp_path / 'queue.sqlite3'), max_attempts=3, retry_base_seconds=10)
+    queue.enqueue(['n1'])
+
+    for attempt, delay in [(1, 10), (2, 20)]:
+        assert queue.claim('worker', limit=1) == ['n1']
+        queue.mark_failed(['n1'], error='404')
+        # Exponential backoff: not claimable before retry_after
+        clock.now += delay - 1
+        assert queue.claim('worker', limit=1) == []
+        clock.now += 1
+
+    assert queue.claim('worker', limit=1) == ['n1']
+    queue.mark_failed(['n1'], error='404')
+    clock.now += 10 ** 6
+    assert queue.claim('worker', limit=1) == []
+    assert states(queue)['n1'] == FAILED
+
+
+def test_released_ids_are_claimable_right_away(tmp_path, clock):
+    queue = DiscoveryQueue(str(tmp_path / 'queue.sqlite3'))
+    queue.enqueue(['n1', 'n2'])
+    assert queue.claim('worker', limit=2) == ['n1', 'n2']
+    queue.mark_done(['n1'])
+    # Releasing a done id does not bring it back
+    queue.release(['n1', 'n2'])
+    assert queue.claim('worker', limit=2) == ['n2']
+    backlog = queue.backlog()
+    assert backlog[IN_FLIGHT] == 1 and backlog[DONE] == 1 and backlog['ready'] == 0
+
+
+def test_overlapping_invocations_replay_their_changes(tmp_path):
+    bucket = FakeBucket()
+
+    def invocation(name):
+        path = str(tmp_path / f'{name}.sqlite3')
+        generation = restore_queue_file(bucket, path)
+        return DiscoveryQueue(path), generation
+
+    queue_a, generation_a = invocation('a')
+    queue_b, generation_b = invocation('b')
+    claimed = {}
+
+    def enqueue_and_claim(name):
+        def replay(queue):
+            queue.enqueue([f'n{i}' for i in range(10)])
+            claimed[name] = queue.claim(name, limit=5)
+        return replay
+
+    # Both enqueue and claim on their own copy, b stores second and replays its claim on a's copy
+    for name, queue in [('a', queue_a), ('b', queue_b)]:
+        enqueue_and_claim(name)(queue)
+    generation_a = sync_queue_file(bucket, queue_a, generation_a, enqueue_and_claim('a'))
+    generation_b = sync_queue_file(bucket, queue_b, generation_b, enqueue_and_claim('b'))
+    assert generation_a is not None and generation_b is not None
+    assert not set(claimed['a']) & set(claimed['b'])
+
+    # Acks of a are stored after b's claim: a replays them on b's copy, b's acks then on a's
+    for name, queue, generation in [('a', queue_a, generation_a), ('b', queue_b, generation_b)]:
+        queue.mark_done(claimed[name])
+        assert sync_queue_file(bucket, queue, generation, lambda q, name=name: q.mark_done(claimed[name])) is not None
+
+    queue_c, _ = invocation('c')
+    assert queue_c.backlog()[DONE] == 10
+
+
+def test_queue_that_keeps_changing_is_not_stored(tmp_path):
+    bucket = FakeBucket()
+    queue = DiscoveryQueue(str(tmp_path / 'queue.sqlite3'))
+    replays = []
+
+    def replay(queue):
+        replays.append(queue.backlog())
+        # Another invocation stores the queue again before every retry
+        bucket.blob(discovery_queue.QUEUE_OBJECT_PATH).upload_from_filename(queue.path)
+
+    bucket.blob(discovery_queue.QUEUE_OBJECT_PATH).upload_from_filename(queue.path)
+    assert sync_queue_file(bucket, queue, 0, replay, max_attempts=3) is None
+    assert len(replays) == 3
@@ -2,6 +2,9 @@ from google.cloud import storage
 import time
 from flask import Flask
 
+# Only used by the previous temporary/ -> latest/ CSV flow. The arrivals job now publishes versioned
+# snapshots under snapshots/<version>/ and points latest/manifest.json at them (predicted_arrivals/snapshot_store.py)
+
 def move_files(Request):
     
     bucket_name = "arrivals_data"
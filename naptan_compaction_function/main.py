@@ -0,0 +1,186 @@
+from google.cloud import bigquery, storage
+from google.api_core import exceptions as gcp_exceptions
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+import json
+import os
+import re
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Compaction of the StopPoint CSVs written by stop discovery (london_transport_api/station_mapping), a few
+# hundred rows per object under one minute partition per run:
+#   naptan_data/year=YYYY/month=MM/day=DD/hour=HH/minute=MM/naptan_snapshot*.csv
+# into one deduplicated Parquet file holding every stop (last write of a naptanId wins, whatever its day):
+#   naptan_compacted/stop_points_<run>.parquet
+#   naptan_compacted/manifest.json    {"watermark": last compacted minute, "path": current file}
+# Every run only lists the minutes after the watermark, merges them into the current file and writes the result
+# to a new path. The manifest is swapped with a generation-match precondition, then the stopspoint_coordinates
+# external table is pointed at the new file: readers switch from one complete file to the next, and only then is
+# the previous file deleted.
+
+BUCKET_NAME = 'bus_stop_points'
+SOURCE_PREFIX = 'naptan_data/'
+COMPACTED_PREFIX = 'naptan_compacted'
+MANIFEST_PATH = f'{COMPACTED_PREFIX}/manifest.json'
+# A discovery run keeps writing parts under the minute it started in for up to its time budget,
+# minutes are only compacted once no run can still be writing in them
+SETTLE_MINUTES = int(os.environ.get('NAPTAN_COMPACTION_SETTLE_MINUTES', 15))
+DOWNLOAD_WORKERS = int(os.environ.get('NAPTAN_COMPACTION_DOWNLOAD_WORKERS', 16))
+
+PROJECT_ID = 'lon-trans-streaming-pipeline'
+STATIONS_RAW_TABLE = 'lon-trans-streaming-pipeline.bus_density_streaming_pipeline.stopspoint_coordinates'
+
+MINUTE_PARTITION = re.compile(r'year=(\d{4})/month=(\d{2})/day=(\d{2})/hour=(\d{2})/minute=(\d{2})/')
+COMPACTED_FILE = re.compile(r'/stop_points_(\w+)\.parquet$')
+CSV_DTYPES = {'naptanId': str, 'commonName': str, 'latitude': float, 'longitud': float}
+
+
+def minute_partition(path):
+    # naptan_data/year=2025/month=06/day=01/hour=12/minute=05/... --> 2025-06-01T12:05, None for other objects
+    match = MINUTE_PARTITION.search(path)
+    if match is None:
+        return None
+    year, month, day, hour, minute = match.groups()
+    return f'{year}-{month}-{day}T{hour}:{minute}'
+
+
+def minute_prefix(minute):
+    # 2025-06-01T12:05 --> naptan_data/year=2025/month=06/day=01/hour=12/minute=05/
+    return (f'{SOURCE_PREFIX}year={minute[0:4]}/month={minute[5:7]}/day={minute[8:10]}/'
+            f'hour={minute[11:13]}/minute={minute[14:16]}/')
+
+
+def settle_cutoff(now, settle_minutes=SETTLE_MINUTES):
+    # Last minute partition that can be compacted: no discovery run can still be writing in it
+    return (now - timedelta(minutes=settle_minutes)).strftime('%Y-%m-%dT%H:%M')
+
+
+def read_manifest(bucket):
+    # Returns (manifest, generation), generation 0 when nothing was compacted yet
+    blob = bucket.blob(MANIFEST_PATH)
+    try:
+        data = blob.download_as_bytes()
+    except gcp_exceptions.NotFound:
+        return {'watermark': None, 'path': None}, 0
+    return json.loads(data), blob.generation
+
+
+def compacted_paths(manifest):
+    # Files the manifest references, oldest rows first. Manifests of the per day layout list one file per day
+    if manifest.get('path'):
+        return [manifest['path']]
+    return [path for _, path in sorted(manifest.get('days', {}).items())]
+
+
+def delete_replaced_files(bucket, current_path, run_version):
+    # Compacted files of earlier runs: replaced ones, per day files, files of runs that lost the manifest swap or
+    # could not update the table. Files of later runs may be in use and are left alone
+    deleted = 0
+    for blob in bucket.list_blobs(prefix=f'{COMPACTED_PREFIX}/'):
+        match = COMPACTED_FILE.search(blob.name)
+        if match is None or blob.name == current_path or match.group(1) >= run_version:
+            continue
+        try:
+            blob.delete()
+            deleted += 1
+        except gcp_exceptions.NotFound:
+            pass
+    return deleted
+
+
+def new_source_blobs(bucket, watermark, cutoff):
+    # CSV objects of the minutes after the watermark and up to cutoff, in write order. Partitions are zero
+    # padded, so listing from the watermark minute (start_offset) skips everything compacted before
+    start_offset = minute_prefix(watermark) if watermark else None
+    blobs = []
+    for blob in bucket.list_blobs(prefix=SOURCE_PREFIX, start_offset=start_offset):
+        minute = minute_partition(blob.name)
+        if minute is None or not blob.name.endswith('.csv'):
+            continue
+        if minute > cutoff:
+            break
+        if watermark is None or minute > watermark:
+            blobs.append((minute, blob))
+    return blobs
+
+
+def read_stop_points_csv(minute, blob):
+    df = pd.read_csv(BytesIO(blob.download_as_bytes()), dtype=CSV_DTYPES)
+    df['written_at'] = pd.Timestamp(minute)
+    return df
+
+
+def read_parquet_blob(bucket, path):
+    return pq.read_table(BytesIO(bucket.blob(path).download_as_bytes())).to_pandas()
+
+
+def compact_stop_points(bucket, existing_paths, new_frames, run_version):
+    # Rows of the compacted files first, then the new minutes in write order, the last row of a naptanId wins
+    frames = [read_parquet_blob(bucket, path) for path in existing_paths] + new_frames
+    stops_df = pd.concat(frames, ignore_index=True)
+    stops_df = stops_df.drop_duplicates(subset='naptanId', keep='last').sort_values('naptanId').reset_index(drop=True)
+
+    buffer = BytesIO()
+    pq.write_table(pa.Table.from_pandas(stops_df, preserve_index=False), buffer, compression='zstd')
+    path = f'{COMPACTED_PREFIX}/stop_points_{run_version}.parquet'
+    bucket.blob(path).upload_from_string(buffer.getvalue(), content_type='application/vnd.apache.parquet',
+                                         if_generation_match=0)
+    print(f'Compacted {sum(len(df) for df in new_frames)} new rows into {path} ({len(stops_df)} stops)')
+    return path
+
+
+def point_table_at(BQ_client, table_ref, bucket_name, path):
+    # The external table reads the current file only, never a glob over files of different runs
+    table = BQ_client.get_table(table_ref)
+    external_config = table.external_data_configuration
+    external_config.source_uris = [f'gs://{bucket_name}/{path}']
+    table.external_data_configuration = external_config
+    BQ_client.update_table(table, ['external_data_configuration'])
+
+
+def compact_naptan_data(Request, client=None, BQ_client=None, now=None):
+
+    client = client or storage.Client()
+    bucket = client.bucket(BUCKET_NAME)
+
+    manifest, manifest_generation = read_manifest(bucket)
+    cutoff = settle_cutoff(now or datetime.now())
+    source_blobs = new_source_blobs(bucket, manifest['watermark'], cutoff)
+    if not source_blobs:
+        print(f"No new minute partitions after {manifest['watermark']}")
+        return 'No new NaptanId files to compact', 200
+
+    # Tiny objects: the time goes into round trips, they are downloaded concurrently
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        frames = list(executor.map(lambda item: read_stop_points_csv(*item), source_blobs))
+
+    run_version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    replaced_paths = compacted_paths(manifest)
+    path = compact_stop_points(bucket, replaced_paths, frames, run_version)
+
+    new_manifest = {'watermark': max(minute for minute, _ in source_blobs), 'path': path,
+                    'updated_at': datetime.now(timezone.utc).isoformat()}
+    try:
+        bucket.blob(MANIFEST_PATH).upload_from_string(json.dumps(new_manifest), content_type='application/json',
+                                                      if_generation_match=manifest_generation)
+    except gcp_exceptions.PreconditionFailed:
+        # Another run compacted in between: its manifest stands, the file of this run is dropped
+        print('Manifest changed while compacting, discarding this run')
+        bucket.blob(path).delete()
+        return 'Compaction superseded by another run', 409
+
+    try:
+        point_table_at(BQ_client or bigquery.Client(project=PROJECT_ID), STATIONS_RAW_TABLE, BUCKET_NAME, path)
+    except Exception as e:
+        # The table still reads the previous file, which is kept: the next run points it at its own file
+        print(f'Could not point {STATIONS_RAW_TABLE} at {path}: {e}')
+        return f'Compacted {len(source_blobs)} NaptanId files, table not updated', 500
+
+    # The table no longer reads the replaced files
+    print(f'Deleted {delete_replaced_files(bucket, path, run_version)} replaced compacted files')
+
+    print(f"Compacted {len(source_blobs)} files up to {new_manifest['watermark']} into {path}")
+    return f'Compacted {len(source_blobs)} NaptanId files', 200
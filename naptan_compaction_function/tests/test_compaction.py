@@ -0,0 +1,155 @@
+import os
+import sys
+from datetime import datetime
+from io import BytesIO
+import pyarrow.parquet as pq
+from google.api_core import exceptions as gcp_exceptions
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from main import MANIFEST_PATH, compact_naptan_data, minute_partition, new_source_blobs, read_manifest, settle_cutoff
+
+# python3 -m pytest tests/
+
+
+class FakeBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = bucket.objects.get(name, (None, 0))[1]
+
+    def download_as_bytes(self):
+        if self.name not in self.bucket.objects:
+            raise gcp_exceptions.NotFound(self.name)
+        data, self.generation = self.bucket.objects[self.name]
+        return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        current = self.bucket.objects.get(self.name, (None, 0))[1]
+        if if_generation_match is not None and if_generation_match != current:
+            raise gcp_exceptions.PreconditionFailed(self.name)
+        self.bucket.generation += 1
+        self.generation = self.bucket.generation
+        self.bucket.objects[self.name] = (data if isinstance(data, bytes) else data.encode('utf-8'), self.generation)
+
+    def delete(self):
+        if self.bucket.objects.pop(self.name, None) is None:
+            raise gcp_exceptions.NotFound(self.name)
+
+
+class FakeBucket:
+
+    def __init__(self):
+        self.objects = {}
+        self.generation = 0
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix='', start_offset=None):
+        return [FakeBlob(self, name) for name in sorted(self.objects)
+                if name.startswith(prefix) and (start_offset is None or name >= start_offset)]
+
+
+class FakeStorage:
+
+    def __init__(self, bucket):
+        self.fake_bucket = bucket
+
+    def bucket(self, name):
+        return self.fake_bucket
+
+
+class FakeExternalConfig:
+    source_uris = []
+
+
+class FakeTable:
+    external_data_configuration = FakeExternalConfig()
+
+
+class FakeBigQuery:
+
+    def __init__(self):
+        self.table = FakeTable()
+
+    def get_table(self, table_ref):
+        return self.table
+
+    def update_table(self, table, fields):
+        self.table = table
+
+
+def write_part(bucket, minute, rows, part=0):
+    path = (f'naptan_data/year={minute[0:4]}/month={minute[5:7]}/day={minute[8:10]}/hour={minute[11:13]}/'
+            f'minute={minute[14:16]}/naptan_snapshot_part{part:04d}.csv')
+    csv = 'naptanId,commonName,latitude,longitud\n' + ''.join(f'{n},{name},51.5,-0.1\n' for n, name in rows)
+    bucket.blob(path).upload_from_string(csv)
+
+
+def compacted_stops(bucket):
+    manifest, _ = read_manifest(bucket)
+    df = pq.read_table(BytesIO(bucket.blob(manifest['path']).download_as_bytes())).to_pandas()
+    return dict(zip(df['naptanId'], df['commonName']))
+
+
+def test_settle_cutoff():
+    assert settle_cutoff(datetime(2025, 6, 1, 12, 5), settle_minutes=15) == '2025-06-01T11:50'
+    assert settle_cutoff(datetime(2025, 6, 1, 0, 10), settle_minutes=15) == '2025-05-31T23:55'
+
+
+def test_new_source_blobs_between_watermark_and_cutoff():
+    bucket = FakeBucket()
+    for minute in ['2025-06-01T11:58', '2025-06-01T11:59', '2025-06-01T12:00', '2025-06-01T12:01']:
+        write_part(bucket, minute, [('n1', 'A')])
+    bucket.blob('naptan_data/year=2025/month=06/day=01/hour=12/minute=00/_SUCCESS').upload_from_string('')
+
+    # The watermark minute itself was compacted, minutes after the cutoff are still being written
+    minutes = [minute for minute, _ in new_source_blobs(bucket, '2025-06-01T11:58', '2025-06-01T12:00')]
+    assert minutes == ['2025-06-01T11:59', '2025-06-01T12:00']
+    assert [minute for minute, _ in new_source_blobs(bucket, None, '2025-06-01T11:58')] == ['2025-06-01T11:58']
+    assert minute_partition('naptan_data/other.csv') is None
+
+
+def test_last_write_wins_across_days_and_runs():
+    bucket = FakeBucket()
+    BQ_client = FakeBigQuery()
+    write_part(bucket, '2025-06-01T23:59', [('n1', 'Old name'), ('n2', 'B')])
+    write_part(bucket, '2025-06-02T00:01', [('n1', 'New name')])
+
+    assert compact_naptan_data(None, FakeStorage(bucket), BQ_client, now=datetime(2025, 6, 2, 0, 20))[1] == 200
+    assert compacted_stops(bucket) == {'n1': 'New name', 'n2': 'B'}
+    manifest, _ = read_manifest(bucket)
+    assert manifest['watermark'] == '2025-06-02T00:01'
+    assert BQ_client.table.external_data_configuration.source_uris == [f"gs://bus_stop_points/{manifest['path']}"]
+
+    # Next run: only the minutes after the watermark and before the settle window are read
+    write_part(bucket, '2025-06-03T10:00', [('n2', 'B renamed')])
+    write_part(bucket, '2025-06-03T10:30', [('n3', 'Too recent')])
+    assert compact_naptan_data(None, FakeStorage(bucket), BQ_client, now=datetime(2025, 6, 3, 10, 20))[1] == 200
+    assert compacted_stops(bucket) == {'n1': 'New name', 'n2': 'B renamed'}
+
+    # One compacted file left, the one the table reads
+    manifest, _ = read_manifest(bucket)
+    compacted = [name for name in bucket.objects if name.endswith('.parquet')]
+    assert compacted == [manifest['path']]
+
+    assert compact_naptan_data(None, FakeStorage(bucket), BQ_client, now=datetime(2025, 6, 3, 10, 20))[1] == 200
+    assert compacted_stops(bucket) == {'n1': 'New name', 'n2': 'B renamed'}
+
+
+def test_per_day_files_are_merged_into_one():
+    bucket = FakeBucket()
+    write_part(bucket, '2025-06-01T10:00', [('n1', 'Day one'), ('n2', 'B')])
+    compact_naptan_data(None, FakeStorage(bucket), FakeBigQuery(), now=datetime(2025, 6, 1, 11, 0))
+    manifest, generation = read_manifest(bucket)
+    day_path = 'naptan_compacted/day=2025-06-01/stop_points_20250601T110000000000Z.parquet'
+    bucket.blob(day_path).upload_from_string(bucket.blob(manifest['path']).download_as_bytes())
+    bucket.blob(manifest['path']).delete()
+    bucket.blob(MANIFEST_PATH).upload_from_string(
+        '{"watermark": "2025-06-01T10:00", "days": {"2025-06-01": "%s"}}' % day_path, if_generation_match=generation)
+
+    write_part(bucket, '2025-06-02T10:00', [('n1', 'Day two')])
+    compact_naptan_data(None, FakeStorage(bucket), FakeBigQuery(), now=datetime(2025, 6, 2, 11, 0))
+    assert compacted_stops(bucket) == {'n1': 'Day two', 'n2': 'B'}
+    assert day_path not in bucket.objects
@@ -0,0 +1,61 @@
+from array import array
+import ijson
+import numpy as np
+import pandas as pd
+
+# Streaming parser for the TfL Arrivals payload. Only the columns used by enrich_data are read, ids are
+# dictionary encoded as they are parsed so neither the full JSON document nor a list of ~20 field dicts
+# per prediction is ever held in memory.
+
+CATEGORICAL_COLUMNS = ['vehicleId', 'naptanId', 'lineId', 'timestamp']
+ARRIVALS_COLUMNS = CATEGORICAL_COLUMNS + ['timeToStation']
+
+
+def empty_arrivals_df():
+    arrivals_pred_df = pd.DataFrame({column: pd.Categorical([]) for column in CATEGORICAL_COLUMNS})
+    arrivals_pred_df['timeToStation'] = np.array([], dtype=np.int32)
+    return arrivals_pred_df
+
+
+def parse_arrivals_stream(stream):
+    # stream: any file-like object with a read() method (e.g. response.raw of a streamed requests call)
+
+    categories = {column: {} for column in CATEGORICAL_COLUMNS}
+    codes = {column: array('i') for column in CATEGORICAL_COLUMNS}
+    time_to_station = array('i')
+    skipped = 0
+
+    # Predictions are built one at a time by the C backend and discarded once their columns are encoded
+    for prediction in ijson.items(stream, 'item', use_float=True):
+        # Predictions without timeToStation cant be placed in any window
+        prediction_time_to_station = prediction.get('timeToStation')
+        if prediction_time_to_station is None:
+            skipped += 1
+            continue
+
+        for column in CATEGORICAL_COLUMNS:
+            column_value = prediction.get(column)
+            if column_value is None:
+                codes[column].append(-1)
+            else:
+                column_categories = categories[column]
+                code = column_categories.get(column_value)
+                if code is None:
+                    code = len(column_categories)
+                    column_categories[column_value] = code
+                codes[column].append(code)
+        time_to_station.append(int(prediction_time_to_station))
+
+    if skipped:
+        print(f'{skipped} predictions without timeToStation were skipped')
+
+    if len(time_to_station) == 0:
+        return empty_arrivals_df()
+
+    arrivals_pred_df = pd.DataFrame({
+        column: pd.Categorical.from_codes(np.frombuffer(codes[column], dtype=np.int32),
+                                          categories=list(categories[column]))
+        for column in CATEGORICAL_COLUMNS
+    })
+    arrivals_pred_df['timeToStation'] = np.frombuffer(time_to_station, dtype=np.int32)
+    return arrivals_pred_df
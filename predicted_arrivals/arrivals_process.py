@@ -1,12 +1,11 @@
 import pandas as pd
-import numpy as np
 from datetime import datetime
 import pytz
 import os 
 from io import StringIO
 import requests
 from google.cloud import bigquery, storage
-from sklearn.metrics.pairwise import haversine_distances
+from cluster_index import ClusterIndex, assign_nearest_clusters
 
 
 
@@ -18,6 +17,9 @@ def main():
     BQ_client = bigquery.Client(project=PROJECT_ID)
     DATA_SET = 'bus_density_streaming_pipeline'
 
+    # Max distance (km) for a new naptanId to be attached to its closest cluster, unset means no limit
+    MAX_CLUSTER_DISTANCE_KM = float(os.environ['MAX_CLUSTER_DISTANCE_KM']) if os.environ.get('MAX_CLUSTER_DISTANCE_KM') else None
+
     # Cloud storage configuration
     Storage_client = storage.Client(project=PROJECT_ID)
     DESTINATION_BUCKET = 'arrivals_data'
@@ -104,34 +106,12 @@ def main():
         if len(raw_stations_coorinates_df) > 0: # --> If Not found NaptanIds are in Coordinates raw table 
             print('Found those NaptanIds as they are already part of raw coordinates')
 
-            # Apply haversine_distances to each not found coordinate
-
-            clustered_coords = np.radians(clusterized_stations_df[['latitude', 'longitude']].values)
-            cluster_labels = clusterized_stations_df['clusterAgglomerative'].values
-
-            proximity_clusters = [] 
-
-            for i in range(0,len(raw_stations_coorinates_df)):
-            
-                latitude = raw_stations_coorinates_df.iloc[i]['latitude']
-                longitude = raw_stations_coorinates_df.iloc[i]['longitude']
-
-                # New point (also in radians)
-
-                new_point = np.radians([[latitude,longitude]])
-
-                # Compute distances to all points
-                distances = haversine_distances(clustered_coords, new_point) * 6371.0088  # km
-
-                # Find the closest point and append to list of proximity clusters
-                closest_index = np.argmin(distances)
-                closest_cluster = cluster_labels[closest_index]
-
-                proximity_clusters.append(closest_cluster)
-
-                # print(f"Closest cluster: {closest_cluster}")
+            # Assign the closest cluster to all not found coordinates in one batched BallTree query
 
-            raw_stations_coorinates_df['clusterAgglomerative'] = proximity_clusters
+            cluster_index = ClusterIndex(clusterized_stations_df)
+            raw_stations_coorinates_df = assign_nearest_clusters(cluster_index=cluster_index,
+                                                                 coordinates_df=raw_stations_coorinates_df,
+                                                                 max_distance_km=MAX_CLUSTER_DISTANCE_KM)
 
             # Now merge with not found naptan Ids:
             not_found_naptan_df_enriched = not_found_naptan_df.merge(raw_stations_coorinates_df[['naptanId', 'latitude'	, 'longitude', 'clusterAgglomerative']], how='left', on='naptanId')
@@ -1,48 +1,81 @@
 import pandas as pd
-import numpy as np
 import time
+import signal
+import threading
 from datetime import datetime
 import pytz
 import os 
-from io import StringIO
 import requests
 from google.cloud import bigquery, storage, pubsub_v1
-from sklearn.metrics.pairwise import haversine_distances
+from arrivals_parser import parse_arrivals_stream
+from cluster_index import ClusterIndex, assign_nearest_clusters
+from cluster_cache import load_cluster_mapping_table
+from cycle_timer import CycleTimer
+from tfl_client import TflClient
+from tfl_quota import LIVE, quota_from_env
+from sharded_fetch import fetch_arrivals_sharded
+from incremental_enrichment import IncrementalEnricher
+from snapshot_writer import snapshot_content_type, snapshot_file_name, write_snapshot
+from density_cube import build_density_cube
+from snapshot_store import (FAILED, SUPERSEDED, GcsObjectStore, new_snapshot_version, publish_snapshot,
+                            read_manifest, snapshot_object_path)
+from snapshot_archive import archive_snapshot
+from discovery_inbox import queue_unknown_stops
+
+# GCP configuration
+PROJECT_ID = 'lon-trans-streaming-pipeline'
+DATA_SET = 'bus_density_streaming_pipeline'
+CLUSTER_STATIONS_TABLE = 'stopspoint_coordinates_aggloclusters_enriched'
+BUCKET = 'arrivals_data'
+# Bucket of the stop discovery function, stops with no coordinates are queued in it
+DISCOVERY_BUCKET = os.environ.get('DISCOVERY_BUCKET', 'bus_stop_points')
+# Snapshot is written as zstd Parquet, SNAPSHOT_FORMAT=csv keeps the previous CSV file
+SNAPSHOT_FORMAT = os.environ.get('SNAPSHOT_FORMAT', 'parquet')
+PUBSUB_TOPIC_ID = 'london-transport-data-topic'
+# Object read by the dashboard before snapshots were published behind latest/manifest.json
+LEGACY_LATEST_CSV_PATH = 'latest/arrivals_most_recent_snapshot.csv'
 
 
 def fetch_cluster_mapping_table(project_id, data_set, BQ_client, cluster_stations_table):
 
-    query = f"""
-        SELECT *
-        FROM `{project_id}.{data_set}.{cluster_stations_table}`
-    """
-    result =  BQ_client.query(query)
+    # Cluster table is cached locally and only downloaded again when its version changes
+    clusterized_stations_df, cluster_table_version = load_cluster_mapping_table(BQ_client=BQ_client,
+                                                                                project_id=project_id,
+                                                                                data_set=data_set,
+                                                                                cluster_stations_table=cluster_stations_table)
+    return clusterized_stations_df, cluster_table_version
 
-    clusterized_stations_df = pd.DataFrame([{'naptanId': row[0],
-                                            'commonName': row[1],
-                                            'latitude': row[2],
-                                            'longitude': row[3],
-                                            'clusterAgglomerative': row[4]} 
-                                            for row in result])    
-    return clusterized_stations_df
+def bus_arrival_api_call(APP_KEY, tfl_client=None):
 
-def bus_arrival_api_call(APP_KEY):
+    # A shared client keeps the TLS connection to TfL open between cycles
+    if tfl_client is None:
+        tfl_client = TflClient(app_key=APP_KEY)
 
-    arrivals_url = "https://api.tfl.gov.uk/Mode/bus/Arrivals"
-    # app_key = os.environ.get('TFL_APP_KEY')
-    url_append = f'?app_key={APP_KEY}' 
-
-    arrivals_response = requests.get(arrivals_url + url_append)
+    try:
+        arrivals_response = tfl_client.get('Mode/bus/Arrivals', conditional=True, stream=True)
+    except requests.RequestException as e:
+        print(f'No Data due to errors: {e}')
+        return pd.DataFrame()
     arrivals_response_status_code = arrivals_response.status_code
 
-    if arrivals_response_status_code == 200:
-        arrivals_pred_df = pd.DataFrame(arrivals_response.json())
+    if arrivals_response_status_code == 304:
+        # Feed did not change since the last published snapshot
+        arrivals_response.close()
+        return None
+    elif arrivals_response_status_code == 200:
+        # Body is parsed while it is downloaded, only the columns used by enrich_data are kept
+        arrivals_response.raw.decode_content = True
+        with arrivals_response:
+            arrivals_pred_df = parse_arrivals_stream(arrivals_response.raw)
         return arrivals_pred_df
     else:
-        print('No Data due to errors')
+        print(f'No Data due to errors, status code: {arrivals_response_status_code}')
+        arrivals_response.close()
         return pd.DataFrame()
     
-def enrich_data(BQ_client, project_id, data_set, arrivals_pred_df, clusterized_stations_df):
+def enrich_data(BQ_client, project_id, data_set, arrivals_pred_df, clusterized_stations_df, cluster_index=None, max_distance_km=None,
+                unknown_naptan_ids=None):
+    # unknown_naptan_ids: optional set, receives the naptanIds found neither in the clusters nor in the raw coordinates
 
     # 1) --> Enrich data with coordinates and clusters
 
@@ -66,22 +99,19 @@ def enrich_data(BQ_client, project_id, data_set, arrivals_pred_df, clusterized_s
         # not_found_naptan_list = list(not_found_naptan_df['naptanId'])
         
         stations_raw_table = 'stopspoint_coordinates'
-        not_found_naptan_df_list = [n for n in not_found_naptan_df['naptanId']]
-
-        if len(not_found_naptan_df_list) > 1:
-            raw_stations_coorsinates_query = f"""
-                SELECT *
-                FROM `{project_id}.{data_set}.{stations_raw_table}`        
-                WHERE naptanId IN {tuple(not_found_naptan_df_list)}
-            """
-        else:
-            raw_stations_coorsinates_query = f"""
-                SELECT *
-                FROM `{project_id}.{data_set}.{stations_raw_table}`        
-                WHERE naptanId IN ({not_found_naptan_df_list[0]})
-            """
-
-        raw_stations_coorinates_result =  BQ_client.query(raw_stations_coorsinates_query)
+        not_found_naptan_df_list = list(dict.fromkeys(not_found_naptan_df['naptanId']))
+
+        # Ids are passed as a query parameter, any number of them and no quoting to get right
+        raw_stations_coorsinates_query = f"""
+            SELECT *
+            FROM `{project_id}.{data_set}.{stations_raw_table}`
+            WHERE naptanId IN UNNEST(@naptan_ids)
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter('naptan_ids', 'STRING', not_found_naptan_df_list),
+        ])
+
+        raw_stations_coorinates_result =  BQ_client.query(raw_stations_coorsinates_query, job_config=job_config)
         
         raw_stations_coorinates_df = pd.DataFrame([{'naptanId': row[0], 
                                                     'commonName': row[1], 
@@ -91,35 +121,17 @@ def enrich_data(BQ_client, project_id, data_set, arrivals_pred_df, clusterized_s
         
         if len(raw_stations_coorinates_df) > 0: # --> If Not found NaptanIds are in Coordinates raw table 
             print('Found those NaptanIds as they are already part of raw coordinates')
+            if unknown_naptan_ids is not None:
+                unknown_naptan_ids.update(set(not_found_naptan_df_list) - set(raw_stations_coorinates_df['naptanId']))
 
-            # Apply haversine_distances to each not found coordinate
-
-            clustered_coords = np.radians(clusterized_stations_df[['latitude', 'longitude']].values)
-            cluster_labels = clusterized_stations_df['clusterAgglomerative'].values
-
-            proximity_clusters = [] 
-
-            for i in range(0,len(raw_stations_coorinates_df)):
-            
-                latitude = raw_stations_coorinates_df.iloc[i]['latitude']
-                longitude = raw_stations_coorinates_df.iloc[i]['longitude']
-
-                # New point (also in radians)
-
-                new_point = np.radians([[latitude,longitude]])
-
-                # Compute distances to all points
-                distances = haversine_distances(clustered_coords, new_point) * 6371.0088  # km
+            # Assign the closest cluster to all not found coordinates in one batched BallTree query
 
-                # Find the closest point and append to list of proximity clusters
-                closest_index = np.argmin(distances)
-                closest_cluster = cluster_labels[closest_index]
+            if cluster_index is None:
+                cluster_index = ClusterIndex(clusterized_stations_df)
 
-                proximity_clusters.append(closest_cluster)
-
-                # print(f"Closest cluster: {closest_cluster}")
-
-            raw_stations_coorinates_df['clusterAgglomerative'] = proximity_clusters
+            raw_stations_coorinates_df = assign_nearest_clusters(cluster_index=cluster_index,
+                                                                 coordinates_df=raw_stations_coorinates_df,
+                                                                 max_distance_km=max_distance_km)
 
             # Now merge with not found naptan Ids:
             not_found_naptan_df_enriched = not_found_naptan_df.merge(raw_stations_coorinates_df[['naptanId', 'latitude'	, 'longitude', 'clusterAgglomerative']], how='left', on='naptanId')
@@ -130,10 +142,12 @@ def enrich_data(BQ_client, project_id, data_set, arrivals_pred_df, clusterized_s
             # Finally, Drop null values in the final enriched in the data frame --> If not found after harvesine proximity that means they are not in the raw coordinates table 
 
             final_arrivals_pred_df_enriched = final_arrivals_pred_df_enriched.dropna(subset='clusterAgglomerative')
-            final_arrivals_pred_df_enriched = final_arrivals_pred_df_enriched [['vehicleId', 'naptanId', 'timeToStation', 'latitude', 'longitude', 'clusterAgglomerative']]
+            final_arrivals_pred_df_enriched = final_arrivals_pred_df_enriched [['vehicleId', 'naptanId', 'lineId', 'timestamp', 'timeToStation', 'latitude', 'longitude', 'clusterAgglomerative']]
         
         else:
             print('The new naptanIds are not in raw Coordinats table so they wont be considered')
+            if unknown_naptan_ids is not None:
+                unknown_naptan_ids.update(not_found_naptan_df_list)
             final_arrivals_pred_df_enriched = arrivals_pred_df_enriched.dropna(subset='clusterAgglomerative')
 
 
@@ -149,54 +163,32 @@ def enrich_data(BQ_client, project_id, data_set, arrivals_pred_df, clusterized_s
     return final_arrivals_pred_df_enriched
 
 
-def create_temp_file(Storage_client, final_arrivals_pred_df_enriched, destination_bucket, destination_path):
+def upload_snapshot_file(store, df, version, base_name, snapshot_format='csv'):
+    # Written once under the version prefix, nothing reads it until the manifest points at it
+    path = snapshot_object_path(version, snapshot_file_name(base_name, snapshot_format))
     try:
-        csv_buffer = StringIO()
-        final_arrivals_pred_df_enriched.to_csv(csv_buffer, index=False)
-        bucket = Storage_client.bucket(destination_bucket)
-        blob = bucket.blob(destination_path)
-        blob.upload_from_string(csv_buffer.getvalue(), content_type="text/csv")
-        print('New data has been succusfully fetched, enriched and uploaded to temporary file location')
-        return True
-    except:
-        print('Temporary file creation failed')
-        return False
+        with store.open_writer(path, content_type=snapshot_content_type(snapshot_format)) as blob_file:
+            write_snapshot(df, blob_file, snapshot_format)
+        print(f'Uploaded {len(df)} rows to {path}')
+        return path
+    except Exception as e:
+        print(f'Upload of {path} failed: {e}')
+        return None
 
 
-def move_files(Storage_client, bucket_name, source_blob_name, destination_blob_name):
-
-    attempts = 1
-    success = False 
-    max_attempts = 5
-
-    while success == False:
-        if attempts <= max_attempts:
-            try:
-                # client = storage.Client()
-                bucket = Storage_client.bucket(bucket_name)
-                source_blob = bucket.blob(source_blob_name)
-                # Copy to new location
-                bucket.copy_blob(source_blob, bucket, destination_blob_name)
-                # Delete original
-                source_blob.delete()
-                success = True
-                print(f'Moved and deleted temporary file succesfully in {attempts} attempts')
-
-            except Exception as e:
-                print((f"Move failed: {e} retrying"))
-                attempts += 1
-        else:        
-            print((f"Ran out of attempts function failed"))        
-            break    
-        
-    if success:
-        return ("Files moved successfully", 200)
-    else:
-        return (f"Move failed", 500)
-    
-def publish_completion_message(project_id, topic_id, message_data):
+def write_legacy_latest_csv(store, df):
+    # Previous fixed path, overwritten in place after the manifest swap. Failures only affect legacy readers
+    try:
+        with store.open_writer(LEGACY_LATEST_CSV_PATH, content_type='text/csv', if_generation_match=None) as blob_file:
+            write_snapshot(df, blob_file, 'csv')
+    except Exception as e:
+        print(f'Upload of {LEGACY_LATEST_CSV_PATH} failed: {e}')
+
 
-    publisher = pubsub_v1.PublisherClient()
+def publish_completion_message(project_id, topic_id, message_data, publisher=None):
+
+    if publisher is None:
+        publisher = pubsub_v1.PublisherClient()
     topic_path = publisher.topic_path(project_id, topic_id)
 
     # Data must be a bytestring
@@ -212,70 +204,264 @@ def publish_completion_message(project_id, topic_id, message_data):
         return False
 
 
-def main():
-    # 1) --> GCP Configuration set up
-    PROJECT_ID = 'lon-trans-streaming-pipeline'
-
-    # BigQuery Configuration
-    BQ_client = bigquery.Client(project=PROJECT_ID)
-    DATA_SET = 'bus_density_streaming_pipeline'
-
-    # Cloud storage configuration
-    Storage_client = storage.Client(project=PROJECT_ID)    
-
-    # 2) --> Read Clusters Table
-    cluster_stations_table = 'stopspoint_coordinates_aggloclusters_enriched'
-    clusterized_stations_df  = fetch_cluster_mapping_table(project_id=PROJECT_ID, 
-                                                           data_set=DATA_SET, 
-                                                           BQ_client=BQ_client, 
-                                                           cluster_stations_table=cluster_stations_table)
-    
+def setup_pipeline():
+    # 1) --> GCP Configuration set up, clients are created once and reused by every cycle
+    fetch_concurrency = int(os.environ.get('ARRIVALS_FETCH_CONCURRENCY', 8))
+    storage_client = storage.Client(project=PROJECT_ID)
+    # TfL budget shared with stop discovery and backfills, live arrivals come first
+    tfl_quota = quota_from_env(caller='arrivals', priority=LIVE, storage_client=storage_client)
+    pipeline = {
+        # BigQuery Configuration
+        'BQ_client': bigquery.Client(project=PROJECT_ID),
+        # Cloud storage configuration, snapshots are published through snapshots/<version>/ + latest/manifest.json
+        'snapshot_store': GcsObjectStore(storage_client, BUCKET),
+        # Pub/Sub configuration
+        'publisher': pubsub_v1.PublisherClient(),
+        # TfL API configuration
+        # 'single' fetches /Mode/bus/Arrivals in one call, 'sharded' fetches /Line/{ids}/Arrivals concurrently
+        'fetch_mode': os.environ.get('ARRIVALS_FETCH_MODE', 'single'),
+        'shard_size': int(os.environ.get('ARRIVALS_SHARD_SIZE', 20)),
+        'fetch_concurrency': fetch_concurrency,
+        # Connection pool sized so every concurrent shard keeps its own keep-alive connection
+        'tfl_client': TflClient(app_key=os.environ.get('TFL_APP_KEY'), pool_size=max(10, fetch_concurrency),
+                                quota=tfl_quota),
+        'tfl_quota': tfl_quota,
+        # Max distance (km) for a new naptanId to be attached to its closest cluster, unset means no limit
+        'max_distance_km': float(os.environ['MAX_CLUSTER_DISTANCE_KM']) if os.environ.get('MAX_CLUSTER_DISTANCE_KM') else None,
+        # Cluster index, rebuilt only when the cluster table version changes
+        'cluster_index': None,
+        # Incremental mode carries coordinates and clusters of already seen predictions between cycles
+        'incremental_enricher': IncrementalEnricher() if os.environ.get('ARRIVALS_INCREMENTAL') == '1' else None,
+        'emit_delta': os.environ.get('ARRIVALS_EMIT_DELTA') == '1',
+        # Every published snapshot is also archived under archive/, ARCHIVE_SNAPSHOTS=0 turns it off
+        'archive_state': {} if os.environ.get('ARCHIVE_SNAPSHOTS', '1') == '1' else None,
+        # Readers that still query the latest/ CSV (dashboards deployed before the manifest reader) keep getting
+        # fresh data, LEGACY_LATEST_CSV=0 stops the copy once every reader follows latest/manifest.json
+        'legacy_latest_csv': os.environ.get('LEGACY_LATEST_CSV', '1') == '1',
+        # Unknown stops are queued for the discovery function, QUEUE_UNKNOWN_STOPS=0 turns it off
+        'discovery_store': GcsObjectStore(storage_client, DISCOVERY_BUCKET)
+                           if os.environ.get('QUEUE_UNKNOWN_STOPS', '1') == '1' else None,
+        'queued_naptan_ids': set(),
+    }
+
+    # Job mode starts a new process every cycle: the validators of the published snapshot come from its manifest,
+    # so the feed is still asked for changes only (304 when nothing changed)
+    try:
+        manifest, _ = read_manifest(pipeline['snapshot_store'])
+    except Exception as e:
+        print(f'Could not read the manifest for TfL validators: {e}')
+        manifest = None
+    if manifest is not None and manifest.get('tfl_validators'):
+        pipeline['tfl_client'].load_validators(manifest['tfl_validators'])
+    return pipeline
+
+
+def run_cycle(pipeline, timer):
+    # One fetch -> enrich -> publish cycle, returns True when the manifest points at the new snapshot
+
+    # 2) --> Read Clusters Table (local cache, only a metadata check when the table did not change)
+    with timer.stage('clusters'):
+        clusterized_stations_df, cluster_table_version = fetch_cluster_mapping_table(project_id=PROJECT_ID,
+                                                                                     data_set=DATA_SET,
+                                                                                     BQ_client=pipeline['BQ_client'],
+                                                                                     cluster_stations_table=CLUSTER_STATIONS_TABLE)
+        cluster_index = pipeline['cluster_index']
+        if cluster_index is None or cluster_index.version != cluster_table_version:
+            cluster_index = ClusterIndex(clusterized_stations_df, version=cluster_table_version)
+            pipeline['cluster_index'] = cluster_index
+
     # 3) --> Bus arrival API CALL
-    API_KEY = os.environ.get('TFL_APP_KEY')
-    arrivals_pred_df = bus_arrival_api_call(API_KEY)
-
-    # 3.5) Pub sub topic id
-    PUBSUB_TOPIC_ID = 'london-transport-data-topic'
-
-    if len(arrivals_pred_df) > 0:
-        # 4) --> Enrich data (Clusters + Nulls values handling)
-        final_arrivals_pred_df_enriched = enrich_data(BQ_client=BQ_client,
-                                                      project_id=PROJECT_ID,
-                                                      data_set=DATA_SET,
-                                                      arrivals_pred_df=arrivals_pred_df,
-                                                      clusterized_stations_df=clusterized_stations_df)
-        
-        # 5) --> Send the most recent data to GCS Temporary file
-        BUCKET = 'arrivals_data'
-        TEMP_FILE_PATH = "temporary/arrivals_most_recent_snapshot.csv"
-        temp_file_success = create_temp_file(Storage_client = Storage_client,
-                                            final_arrivals_pred_df_enriched = final_arrivals_pred_df_enriched,
-                                            destination_bucket=BUCKET,
-                                            destination_path=TEMP_FILE_PATH)
-        time.sleep(10)
-
-        # 6) --> Move files
-        if temp_file_success:
-            
-            destination_blob_name = "latest/arrivals_most_recent_snapshot.csv"
-            job_final_stage = move_files(Storage_client=Storage_client,
-                       bucket_name=BUCKET,
-                       source_blob_name=TEMP_FILE_PATH, 
-                       destination_blob_name=destination_blob_name)
+    with timer.stage('fetch'):
+        if pipeline['fetch_mode'] == 'sharded':
+            arrivals_pred_df = fetch_arrivals_sharded(tfl_client=pipeline['tfl_client'],
+                                                      shard_size=pipeline['shard_size'],
+                                                      concurrency=pipeline['fetch_concurrency'])
         else:
-            print('Error creating TEMPORARY FILE, finishing job...')
+            arrivals_pred_df = bus_arrival_api_call(APP_KEY=None, tfl_client=pipeline['tfl_client'])
+
+    if arrivals_pred_df is None:
+        print('Arrivals feed not modified since the last snapshot, skipping enrichment and upload')
+        return True
+
+    if len(arrivals_pred_df) == 0:
+        print('Error with TFL GET request finishing cycle ...')
+        return False
 
-         # 7) --> Publish Pub/Sub message based on job completion status
-                
-        if job_final_stage[1] ==200:
+    # 4) --> Enrich data (Clusters + Nulls values handling)
+    unknown_naptan_ids = set()
+
+    def enrich(rows_to_enrich_df):
+        return enrich_data(BQ_client=pipeline['BQ_client'],
+                           project_id=PROJECT_ID,
+                           data_set=DATA_SET,
+                           arrivals_pred_df=rows_to_enrich_df,
+                           clusterized_stations_df=clusterized_stations_df,
+                           cluster_index=cluster_index,
+                           max_distance_km=pipeline['max_distance_km'],
+                           unknown_naptan_ids=unknown_naptan_ids)
+
+    with timer.stage('enrich'):
+        incremental_enricher = pipeline['incremental_enricher']
+        if incremental_enricher is not None:
+            # Only predictions not seen in the previous cycle go through enrich_data
+            final_arrivals_pred_df_enriched, delta_df = incremental_enricher.enrich(arrivals_pred_df=arrivals_pred_df,
+                                                                                   enrich_new_rows=enrich,
+                                                                                   cluster_table_version=cluster_table_version)
+        else:
+            final_arrivals_pred_df_enriched, delta_df = enrich(arrivals_pred_df), None
+
+    if unknown_naptan_ids and pipeline['discovery_store'] is not None:
+        with timer.stage('discovery'):
+            queue_unknown_stops(store=pipeline['discovery_store'],
+                                naptan_ids=unknown_naptan_ids,
+                                queued_ids=pipeline['queued_naptan_ids'])
+
+    # 5) --> Upload snapshot (and delta) once, to an immutable versioned path
+    version = new_snapshot_version()
+    with timer.stage('upload'):
+        snapshot_path = upload_snapshot_file(store=pipeline['snapshot_store'],
+                                             df=final_arrivals_pred_df_enriched,
+                                             version=version,
+                                             base_name='arrivals_snapshot',
+                                             snapshot_format=SNAPSHOT_FORMAT)
+        if snapshot_path is None:
+            return False
+        snapshot_files = {'snapshot': snapshot_path}
+
+        # Density cube (distinct vehicles per cluster x 1..20 minute window) read by the dashboard
+        density_cube_df = build_density_cube(final_arrivals_pred_df_enriched)
+        density_cube_path = upload_snapshot_file(store=pipeline['snapshot_store'],
+                                                 df=density_cube_df,
+                                                 version=version,
+                                                 base_name='density_cube',
+                                                 snapshot_format=SNAPSHOT_FORMAT)
+        if density_cube_path is None:
+            return False
+        snapshot_files['density_cube'] = density_cube_path
+
+        # Delta file (inserted, updated and removed predictions) next to the snapshot
+        if delta_df is not None and pipeline['emit_delta']:
+            delta_path = upload_snapshot_file(store=pipeline['snapshot_store'],
+                                              df=delta_df,
+                                              version=version,
+                                              base_name='arrivals_delta',
+                                              snapshot_format=SNAPSHOT_FORMAT)
+            if delta_path is None:
+                # Next delta is computed against the last published snapshot, so no change is lost
+                return False
+            counts = delta_df['change'].value_counts()
+            print(f"Delta: {counts.get('insert', 0)} inserted, {counts.get('update', 0)} updated, {counts.get('delete', 0)} removed")
+            snapshot_files['delta'] = delta_path
+
+    # 6) --> Point the manifest at the new version (generation-match swap)
+    with timer.stage('publish'):
+        publication = publish_snapshot(pipeline['snapshot_store'], version, snapshot_files,
+                                       tfl_validators=pipeline['tfl_client'].validators_to_commit())
+        if publication == FAILED:
+            for path in snapshot_files.values():
+                pipeline['snapshot_store'].delete(path)
+            return False
+        if publication == SUPERSEDED:
+            # Another run published a newer version: this one is not the latest data, nothing below applies to it
+            # (the legacy CSV would go back in time, the enricher and the validators would follow a version no
+            # reader sees, the archive would hold a version never published)
+            return True
+
+        if pipeline['legacy_latest_csv']:
+            write_legacy_latest_csv(pipeline['snapshot_store'], final_arrivals_pred_df_enriched)
+
+    if incremental_enricher is not None:
+        incremental_enricher.commit()
+
+    # Snapshot published, the next cycle can ask TfL for changes since this response only
+    pipeline['tfl_client'].commit_validators()
+
+    # 7) --> Append the snapshot to the hour partitioned archive (dashboard playback), closed hours are compacted
+    if pipeline['archive_state'] is not None:
+        with timer.stage('archive'):
+            archive_snapshot(store=pipeline['snapshot_store'],
+                             version=version,
+                             datasets={'snapshots': final_arrivals_pred_df_enriched, 'density_cubes': density_cube_df},
+                             archive_state=pipeline['archive_state'])
+    return True
+
+
+def run_daemon(pipeline, interval_seconds, max_runtime_seconds=None):
+    # Long running mode: one process runs a cycle every interval_seconds (start to start) and keeps
+    # its clients, cluster index and HTTP connections warm instead of relaunching a job every cycle.
+    # Returns after max_runtime_seconds, before the task timeout of the job would kill a cycle half way
+
+    # Cloud Run sends SIGTERM before stopping the container, finish the current cycle and exit
+    stop_requested = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+
+    print(f'Running arrivals pipeline as a daemon, one cycle every {interval_seconds} seconds')
+    cycle_number = 0
+    next_cycle_at = time.monotonic()
+    stop_at = next_cycle_at + max_runtime_seconds if max_runtime_seconds else None
+
+    while not stop_requested.is_set():
+        if stop_at is not None and time.monotonic() >= stop_at:
+            print(f'Daemon ran for {max_runtime_seconds}s, exiting so the execution is replaced')
+            break
+        cycle_number += 1
+        timer = CycleTimer(cycle_number)
+        try:
+            success = run_cycle(pipeline, timer)
+        except Exception as e:
+            # A failed cycle must not stop the daemon, the next cycle starts from scratch
+            print(f'Cycle {cycle_number} failed: {e}')
+            success = False
+        print(f"Cycle {cycle_number} {'completed successfully' if success else 'failed'}")
+        timer.report()
+        if pipeline['tfl_quota'] is not None:
+            print(f"TfL quota: {pipeline['tfl_quota'].metrics()}")
+
+        next_cycle_at += interval_seconds
+        wait_seconds = next_cycle_at - time.monotonic()
+        if wait_seconds > 0:
+            stop_requested.wait(wait_seconds)
+        else:
+            # Cycle took longer than the interval, start the next one right away instead of catching up
+            print(f'Cycle {cycle_number} overran the {interval_seconds}s interval by {-wait_seconds:.2f}s')
+            next_cycle_at = time.monotonic()
+
+    if stop_requested.is_set():
+        print('Stop requested, shutting down arrivals daemon')
+
+
+def main():
+    pipeline = setup_pipeline()
+
+    # Daemon mode: the process keeps running cycles by itself. Nothing restarts a job execution once it ended
+    # (runtime limit, SIGTERM, crash), so the Pub/Sub retrigger is still published when the daemon stops
+    if os.environ.get('ARRIVALS_MODE', 'job') == 'daemon':
+        try:
+            run_daemon(pipeline, interval_seconds=float(os.environ.get('ARRIVALS_INTERVAL_SECONDS', 30)),
+                       max_runtime_seconds=float(os.environ.get('ARRIVALS_DAEMON_MAX_SECONDS', 23 * 3600)))
+        finally:
+            message = f"Cloud Run Job 'bus-density-image' daemon stopped at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} PDT. Triggering Pipeline One more time"
+            publish_completion_message(PROJECT_ID, PUBSUB_TOPIC_ID, message, publisher=pipeline['publisher'])
+        return
+
+    # Job mode: run a single cycle and publish a Pub/Sub message based on job completion status
+    # The message retriggers the job: it is published whatever happened in the cycle, or the pipeline stops
+    timer = CycleTimer()
+    success = False
+    try:
+        success = run_cycle(pipeline, timer)
+    except Exception as e:
+        print(f'Cycle failed: {e}')
+    finally:
+        timer.report()
+        if pipeline['tfl_quota'] is not None:
+            print(f"TfL quota: {pipeline['tfl_quota'].metrics()}")
+
+        if success:
             message = f"Cloud Run Job 'bus-density-image' completed successfully at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} PDT. Triggering Pipeline One more time"
-            publish_completion_message(PROJECT_ID, PUBSUB_TOPIC_ID, message)
         else:
             message = f"Cloud Run Job 'bus-density-image' failed to complete at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} PDT. Triggering Pipeline One more time"
-            publish_completion_message(PROJECT_ID, PUBSUB_TOPIC_ID, message)
-    else:
-        print('Error with TFL GET request finishing job ...')
-        publish_completion_message(PROJECT_ID, PUBSUB_TOPIC_ID, message)
+        publish_completion_message(PROJECT_ID, PUBSUB_TOPIC_ID, message, publisher=pipeline['publisher'])
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
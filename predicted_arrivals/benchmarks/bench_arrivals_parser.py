@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from arrivals_parser import ARRIVALS_COLUMNS, parse_arrivals_stream
+
+# python3 benchmarks/bench_arrivals_parser.py
+# Compares response.json() + pd.DataFrame (previous bus_arrival_api_call) with the streaming parser
+# on a synthetic /Mode/bus/Arrivals payload. The payload is read from a file to stand in for the HTTP body.
+
+PREDICTIONS_SIZES = [10000, 40000, 80000]
+
+
+def synthetic_arrivals_payload(n, rng):
+    predictions = []
+    for i in range(n):
+        line = f'{rng.integers(1, 700)}'
+        naptan = f'490G{rng.integers(0, 19600):08d}'
+        vehicle = f'LX{rng.integers(0, 9000):05d}'
+        predictions.append({
+            '$type': 'Tfl.Api.Presentation.Entities.Prediction, Tfl.Api.Presentation.Entities',
+            'id': f'-{rng.integers(1e9, 2e9)}',
+            'operationType': 1,
+            'vehicleId': vehicle,
+            'naptanId': naptan,
+            'stationName': 'Synthetic Road',
+            'lineId': line,
+            'lineName': line,
+            'platformName': 'K',
+            'direction': 'outbound',
+            'bearing': '90',
+            'destinationNaptanId': '',
+            'destinationName': 'Synthetic Bus Station',
+            'timestamp': '2025-06-01T12:00:00.0000000Z',
+            'timeToStation': int(rng.integers(0, 1800)),
+            'currentLocation': '',
+            'towards': 'Somewhere',
+            'expectedArrival': '2025-06-01T12:10:00Z',
+            'timeToLive': '2025-06-01T12:10:30Z',
+            'modeName': 'bus',
+            'timing': {'$type': 'Tfl.Api.Presentation.Entities.PredictionTiming, Tfl.Api.Presentation.Entities',
+                       'countdownServerAdjustment': '00:00:00', 'source': '2025-06-01T11:59:00Z',
+                       'insert': '2025-06-01T11:59:30Z', 'read': '2025-06-01T11:59:30Z',
+                       'sent': '2025-06-01T12:00:00Z', 'received': '0001-01-01T00:00:00Z'},
+        })
+    return json.dumps(predictions).encode('utf-8')
+
+
+def current_path(path):
+    with open(path, 'rb') as f:
+        body = f.read()
+    return pd.DataFrame(json.loads(body))[ARRIVALS_COLUMNS]
+
+
+def streaming_path(path):
+    with open(path, 'rb') as f:
+        return parse_arrivals_stream(f)
+
+
+def measure(function, path):
+    # Latency and peak memory are measured in separate runs, tracemalloc slows down the parsing itself
+    start = time.perf_counter()
+    function(path)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    arrivals_pred_df = function(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return arrivals_pred_df, elapsed, peak / 1024 ** 2, arrivals_pred_df.memory_usage(deep=True).sum() / 1024 ** 2
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f"{'predictions':>11} | {'payload MB':>10} | {'path':>9} | {'time (s)':>8} | {'peak MB':>8} | {'frame MB':>8}")
+
+    for n in PREDICTIONS_SIZES:
+        payload = synthetic_arrivals_payload(n, rng)
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            f.write(payload)
+            path = f.name
+
+        try:
+            current_df, *current_stats = measure(current_path, path)
+            streamed_df, *streamed_stats = measure(streaming_path, path)
+        finally:
+            os.remove(path)
+
+        same = current_df.astype(str).equals(streamed_df.astype(str))
+        for name, (elapsed, peak, frame) in [('current', current_stats), ('streaming', streamed_stats)]:
+            print(f'{n:>11} | {len(payload) / 1024 ** 2:>10.1f} | {name:>9} | {elapsed:>8.3f} | {peak:>8.1f} | {frame:>8.1f}')
+        print(f'{"":>11} | same rows and values: {same}')
+
+
+if __name__ == '__main__':
+    main()
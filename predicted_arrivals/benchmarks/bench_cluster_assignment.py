@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from sklearn.metrics.pairwise import haversine_distances
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cluster_index import ClusterIndex, assign_nearest_clusters
+
+# python3 benchmarks/bench_cluster_assignment.py
+# Compares the per-row haversine loop previously used in enrich_data with the batched BallTree query
+
+N_CLUSTERED_STOPS = 19600
+N_CLUSTERS = 150
+UNKNOWN_STOPS_SIZES = [10, 1000, 20000]
+
+
+def synthetic_stops(n, rng):
+    # Points spread over Greater London
+    return pd.DataFrame({'naptanId': [f'490SYN{i:07d}' for i in range(n)],
+                         'latitude': rng.uniform(51.28, 51.70, n),
+                         'longitude': rng.uniform(-0.51, 0.33, n)})
+
+
+def legacy_loop(clusterized_stations_df, raw_stations_coorinates_df):
+    clustered_coords = np.radians(clusterized_stations_df[['latitude', 'longitude']].values)
+    cluster_labels = clusterized_stations_df['clusterAgglomerative'].values
+
+    proximity_clusters = []
+    for i in range(0, len(raw_stations_coorinates_df)):
+        latitude = raw_stations_coorinates_df.iloc[i]['latitude']
+        longitude = raw_stations_coorinates_df.iloc[i]['longitude']
+        new_point = np.radians([[latitude, longitude]])
+        distances = haversine_distances(clustered_coords, new_point) * 6371.0088
+        proximity_clusters.append(cluster_labels[np.argmin(distances)])
+
+    return np.array(proximity_clusters)
+
+
+def main():
+    rng = np.random.default_rng(42)
+    clusterized_stations_df = synthetic_stops(N_CLUSTERED_STOPS, rng)
+    clusterized_stations_df['clusterAgglomerative'] = rng.integers(0, N_CLUSTERS, N_CLUSTERED_STOPS)
+
+    start = time.perf_counter()
+    cluster_index = ClusterIndex(clusterized_stations_df)
+    build_time = time.perf_counter() - start
+    print(f'BallTree build over {N_CLUSTERED_STOPS} clustered stops: {build_time * 1000:.1f} ms (once per cluster table version)')
+    print(f"{'unknown stops':>14} | {'legacy loop (s)':>15} | {'ball tree (s)':>13} | {'speed up':>9} | same clusters")
+
+    for n in UNKNOWN_STOPS_SIZES:
+        unknown_stops_df = synthetic_stops(n, rng)
+
+        start = time.perf_counter()
+        legacy_clusters = legacy_loop(clusterized_stations_df, unknown_stops_df)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        assigned_df = assign_nearest_clusters(cluster_index, unknown_stops_df)
+        tree_time = time.perf_counter() - start
+
+        same = bool((assigned_df['clusterAgglomerative'].to_numpy() == legacy_clusters).all())
+        print(f'{n:>14} | {legacy_time:>15.3f} | {tree_time:>13.4f} | {legacy_time / tree_time:>8.0f}x | {same}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snapshot_store import (PUBLISHED, LocalObjectStore, new_snapshot_version, publish_snapshot, read_manifest,
+                            snapshot_object_path)
+from snapshot_writer import write_snapshot
+
+# python3 benchmarks/bench_snapshot_publication.py
+# Runs snapshot publication against the local filesystem object store:
+#   1) latency of the previous temporary upload + sleep(10) + copy + delete versus versioned upload + manifest swap
+#   2) concurrent publishers racing on the manifest: it must end on the newest version and only point at existing files
+
+LEGACY_SLEEP_SECONDS = 10
+CONCURRENT_PUBLISHERS = 8
+VERSIONS_PER_PUBLISHER = 10
+KEEP_VERSIONS = 5
+
+
+def synthetic_snapshot(n, rng):
+    return pd.DataFrame({'vehicleId': pd.Categorical([f'LX{v:05d}' for v in rng.integers(0, 9000, n)]),
+                         'naptanId': pd.Categorical([f'490G{v:08d}' for v in rng.integers(0, 19600, n)]),
+                         'timeToStation': rng.integers(0, 1800, n).astype(np.int32),
+                         'clusterAgglomerative': rng.integers(0, 150, n).astype(float)})
+
+
+def legacy_publication(store, df):
+    # Same object operations as create_temp_file + move_files, the fixed sleep is added afterwards
+    with store.open_writer('temporary/arrivals_most_recent_snapshot.parquet') as f:
+        write_snapshot(df, f)
+    data, _ = store.read_bytes('temporary/arrivals_most_recent_snapshot.parquet')
+    store.write_bytes('latest/arrivals_most_recent_snapshot.parquet', data)
+    store.delete('temporary/arrivals_most_recent_snapshot.parquet')
+
+
+def versioned_publication(store, df):
+    version = new_snapshot_version()
+    path = snapshot_object_path(version, 'arrivals_snapshot.parquet')
+    with store.open_writer(path) as f:
+        write_snapshot(df, f)
+    return publish_snapshot(store, version, {'snapshot': path}, keep_versions=KEEP_VERSIONS)
+
+
+def latency_comparison(root_dir, df):
+    store = LocalObjectStore(os.path.join(root_dir, 'latency'))
+
+    start = time.perf_counter()
+    legacy_publication(store, df)
+    legacy_time = time.perf_counter() - start + LEGACY_SLEEP_SECONDS
+
+    start = time.perf_counter()
+    versioned_publication(store, df)
+    versioned_time = time.perf_counter() - start
+
+    print(f'temporary + sleep + copy + delete: {legacy_time:.3f}s (3 object writes/deletes + {LEGACY_SLEEP_SECONDS}s sleep)')
+    print(f'versioned upload + manifest swap : {versioned_time:.3f}s (1 upload, 1 manifest read, 1 manifest write)')
+
+
+def concurrent_publishers(root_dir, df):
+    store = LocalObjectStore(os.path.join(root_dir, 'race'))
+    published = []
+
+    def publisher():
+        for _ in range(VERSIONS_PER_PUBLISHER):
+            version = new_snapshot_version()
+            path = snapshot_object_path(version, 'arrivals_snapshot.parquet')
+            with store.open_writer(path) as f:
+                write_snapshot(df, f)
+            if publish_snapshot(store, version, {'snapshot': path}, keep_versions=KEEP_VERSIONS) == PUBLISHED:
+                published.append(version)
+
+    threads = [threading.Thread(target=publisher) for _ in range(CONCURRENT_PUBLISHERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    manifest, _ = read_manifest(store)
+    referenced = [manifest['files']] + [entry['files'] for entry in manifest['history']]
+    missing = [path for files in referenced for path in files.values() if not os.path.exists(store.full_path(path))]
+
+    print(f'{CONCURRENT_PUBLISHERS} publishers x {VERSIONS_PER_PUBLISHER} versions: manifest on {manifest["version"]}')
+    print(f'manifest on newest version: {manifest["version"] == max(published)}')
+    print(f'versions kept in manifest history: {len(manifest["history"]) + 1}, missing referenced files: {len(missing)}')
+
+
+def main():
+    df = synthetic_snapshot(40000, np.random.default_rng(42))
+    root_dir = tempfile.mkdtemp()
+    try:
+        latency_comparison(root_dir, df)
+        concurrent_publishers(root_dir, df)
+    finally:
+        shutil.rmtree(root_dir)
+
+
+if __name__ == '__main__':
+    main()
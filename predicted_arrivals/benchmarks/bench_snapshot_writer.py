@@ -0,0 +1,98 @@
+import io
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snapshot_writer import write_snapshot
+
+# python3 benchmarks/bench_snapshot_writer.py
+# Compares the previous CSV upload (StringIO + getvalue + upload_from_string) with Parquet streamed
+# to a blob writer. The upload itself is replaced by a sink that only counts the bytes it receives.
+
+SNAPSHOT_SIZES = [10000, 40000, 80000]
+
+
+class CountingSink(io.RawIOBase):
+    # Stand-in for blob.open('wb'): accepts chunks and keeps only their size
+
+    def __init__(self):
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+
+def synthetic_snapshot(n, rng):
+    return pd.DataFrame({
+        'vehicleId': pd.Categorical([f'LX{v:05d}' for v in rng.integers(0, 9000, n)]),
+        'naptanId': pd.Categorical([f'490G{v:08d}' for v in rng.integers(0, 19600, n)]),
+        'lineId': pd.Categorical([f'{v}' for v in rng.integers(1, 700, n)]),
+        'timestamp': pd.Categorical(['2025-06-01T12:00:00.0000000Z'] * n),
+        'timeToStation': rng.integers(0, 1800, n).astype(np.int32),
+        'latitude': rng.uniform(51.28, 51.70, n),
+        'longitude': rng.uniform(-0.51, 0.33, n),
+        'clusterAgglomerative': rng.integers(0, 150, n).astype(float),
+        'pull_time': '2025-06-01 13:00:00',
+    })
+
+
+def previous_csv_path(df):
+    csv_buffer = io.StringIO()
+    df.to_csv(csv_buffer, index=False)
+    payload = csv_buffer.getvalue()
+    # upload_from_string encodes the text before sending it
+    return len(payload.encode('utf-8'))
+
+
+def streamed_path(df, snapshot_format):
+    sink = CountingSink()
+    write_snapshot(df, sink, snapshot_format)
+    return sink.bytes_written
+
+
+def measure(function, *args):
+    start = time.perf_counter()
+    bytes_uploaded = function(*args)
+    elapsed = time.perf_counter() - start
+
+    # Python allocations are traced by tracemalloc, Arrow buffers by a dedicated proxy memory pool
+    default_pool = pa.default_memory_pool()
+    arrow_pool = pa.proxy_memory_pool(default_pool)
+    pa.set_memory_pool(arrow_pool)
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        pa.set_memory_pool(default_pool)
+    return bytes_uploaded, elapsed, (peak + arrow_pool.max_memory()) / 1024 ** 2
+
+
+def main():
+    rng = np.random.default_rng(42)
+    print(f"{'rows':>6} | {'path':>16} | {'MB uploaded':>11} | {'time (s)':>8} | {'peak MB':>7}")
+
+    for n in SNAPSHOT_SIZES:
+        df = synthetic_snapshot(n, rng)
+        results = [('csv + StringIO', measure(previous_csv_path, df)),
+                   ('csv streamed', measure(streamed_path, df, 'csv')),
+                   ('parquet zstd', measure(streamed_path, df, 'parquet'))]
+        for name, (bytes_uploaded, elapsed, peak) in results:
+            print(f'{n:>6} | {name:>16} | {bytes_uploaded / 1024 ** 2:>11.2f} | {elapsed:>8.3f} | {peak:>7.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import os
+import glob
+import pyarrow as pa
+
+# Local cache of the cluster mapping table. The table only changes when the clustering notebook is re-run,
+# so every cycle only does a metadata lookup (no query, no bytes scanned) and the rows are read again from
+# BigQuery only when the last modified time or the row count changed.
+
+CLUSTER_CACHE_DIR = os.environ.get('CLUSTER_CACHE_DIR', '/tmp/cluster_cache')
+CLUSTER_TABLE_COLUMNS = ['naptanId', 'commonName', 'latitude', 'longitude', 'clusterAgglomerative']
+# The table stores longitude as 'longitud'
+CLUSTER_TABLE_RENAMES = {'longitud': 'longitude'}
+
+# Last table loaded in this process, reused as long as the version does not change
+_loaded_table = {'version': None, 'df': None}
+
+
+def cluster_table_version(BQ_client, table_ref):
+    # tables.get only returns metadata, this call is free and takes a few ms
+    table = BQ_client.get_table(table_ref)
+    return f"{int(table.modified.timestamp() * 1_000_000)}-{table.num_rows}"
+
+
+def cache_file_path(cache_dir, cluster_stations_table, version):
+    return os.path.join(cache_dir, f'{cluster_stations_table}-{version}.arrow')
+
+
+def write_cache_file(arrow_table, cache_dir, cluster_stations_table, version):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_file_path(cache_dir, cluster_stations_table, version)
+
+    # Write to a temporary file and rename it, a crashed run never leaves a half written cache behind
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+    os.replace(tmp_path, path)
+
+    # Drop the files of previous versions
+    for old_path in glob.glob(os.path.join(cache_dir, f'{cluster_stations_table}-*.arrow')):
+        if old_path != path:
+            os.remove(old_path)
+
+    return path
+
+
+def read_cache_file(path):
+    # Uncompressed Arrow IPC file: no download and no decoding, only the copy of the columns into the frame
+    with pa.memory_map(path, 'r') as source:
+        clusterized_stations_df = pa.ipc.open_file(source).read_all().to_pandas()
+    return clusterized_stations_df
+
+
+def download_cluster_table(BQ_client, table_ref):
+    # list_rows reads the table directly (no query job) and builds Arrow columns instead of per row dicts
+    arrow_table = BQ_client.list_rows(table_ref).to_arrow()
+    # Columns renamed and selected by name, a column added to or moved in the table does not shift the others
+    arrow_table = arrow_table.rename_columns([CLUSTER_TABLE_RENAMES.get(name, name) for name in arrow_table.column_names])
+    missing = [column for column in CLUSTER_TABLE_COLUMNS if column not in arrow_table.column_names]
+    if missing:
+        raise ValueError(f'{table_ref} has no column {missing}, found {arrow_table.column_names}')
+    return arrow_table.select(CLUSTER_TABLE_COLUMNS)
+
+
+def load_cluster_mapping_table(BQ_client, project_id, data_set, cluster_stations_table, cache_dir=CLUSTER_CACHE_DIR):
+
+    table_ref = f'{project_id}.{data_set}.{cluster_stations_table}'
+    version = cluster_table_version(BQ_client, table_ref)
+
+    # 1) --> Same version already loaded in this process
+    if _loaded_table['version'] == version:
+        return _loaded_table['df'], version
+
+    # 2) --> Same version cached on local disk
+    path = cache_file_path(cache_dir, cluster_stations_table, version)
+    if os.path.exists(path):
+        print(f'Cluster table version {version} read from local cache')
+        clusterized_stations_df = read_cache_file(path)
+
+    # 3) --> New version, download it once and cache it
+    else:
+        print(f'Cluster table changed (version {version}), downloading it from BigQuery')
+        arrow_table = download_cluster_table(BQ_client, table_ref)
+        path = write_cache_file(arrow_table, cache_dir, cluster_stations_table, version)
+        clusterized_stations_df = read_cache_file(path)
+
+    _loaded_table['version'] = version
+    _loaded_table['df'] = clusterized_stations_df
+    return clusterized_stations_df, version
@@ -0,0 +1,27 @@
+import time
+from contextlib import contextmanager
+
+
+class CycleTimer:
+    # Wall time of every stage of one pipeline cycle, printed as a single line at the end of the cycle
+
+    def __init__(self, cycle_number=None):
+        self.cycle_number = cycle_number
+        self.timings = {}
+        self.started_at = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def total(self):
+        return time.perf_counter() - self.started_at
+
+    def report(self):
+        stages = ' | '.join(f'{name} {seconds:.2f}s' for name, seconds in self.timings.items())
+        cycle = f'Cycle {self.cycle_number}' if self.cycle_number is not None else 'Cycle'
+        print(f'⏱️ {cycle} timings: {stages} | total {self.total():.2f}s')
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+# Cluster x forecast window density cube: distinct vehicles arriving at every cluster within 1..20 minutes,
+# plus the cluster centroids. Same numbers the dashboard computes with
+#   df[df['timeToStation'] <= window * 60].groupby('clusterAgglomerative')['vehicleId'].nunique()
+# for every window, but done once per snapshot in a single vectorized pass.
+
+MAX_WINDOW_MINUTES = 20
+
+
+def window_column(window_minutes):
+    return f'window_{window_minutes}'
+
+
+def build_density_cube(final_arrivals_pred_df_enriched, max_window_minutes=MAX_WINDOW_MINUTES):
+    df = final_arrivals_pred_df_enriched.dropna(subset=['clusterAgglomerative'])
+    window_columns = [window_column(w) for w in range(1, max_window_minutes + 1)]
+    if len(df) == 0:
+        return pd.DataFrame(columns=['clusterAgglomerative', 'latitude', 'longitude'] + window_columns)
+
+    # 1) --> Cluster centroids, mean of the coordinates of every prediction (as the dashboard does)
+    centroids = df.groupby('clusterAgglomerative', sort=True)[['latitude', 'longitude']].mean()
+    clusters = centroids.index.to_numpy()
+
+    # 2) --> Earliest arrival of every vehicle at every cluster: rows sorted by timeToStation, first one kept
+    first_arrivals = (df[['clusterAgglomerative', 'vehicleId', 'timeToStation']]
+                      .sort_values('timeToStation', kind='stable')
+                      .drop_duplicates(subset=['clusterAgglomerative', 'vehicleId'], keep='first'))
+
+    # 3) --> First window (in minutes) that includes that arrival: timeToStation <= window * 60
+    first_window = np.maximum(np.ceil(first_arrivals['timeToStation'].to_numpy() / 60), 1).astype(np.int64)
+    in_range = first_window <= max_window_minutes
+
+    cluster_position = np.searchsorted(clusters, first_arrivals['clusterAgglomerative'].to_numpy()[in_range])
+
+    # 4) --> Vehicles entering each window, accumulated over the windows
+    new_vehicles = np.zeros((len(clusters), max_window_minutes), dtype=np.int32)
+    np.add.at(new_vehicles, (cluster_position, first_window[in_range] - 1), 1)
+    counts = np.cumsum(new_vehicles, axis=1, dtype=np.int32)
+
+    density_cube_df = pd.DataFrame(counts, columns=window_columns)
+    density_cube_df.insert(0, 'clusterAgglomerative', clusters.astype(np.int32))
+    density_cube_df.insert(1, 'latitude', centroids['latitude'].to_numpy())
+    density_cube_df.insert(2, 'longitude', centroids['longitude'].to_numpy())
+    return density_cube_df
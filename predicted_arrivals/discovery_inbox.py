@@ -0,0 +1,56 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from snapshot_store import PreconditionFailed
+
+# Stops the arrivals feed mentions but that have no coordinates yet, handed to the stop discovery function
+# (london_transport_api/station_mapping) through its bucket instead of it downloading the Arrivals feed again:
+#   discovery_inbox/<naptanId>    empty object, created once (if_generation_match=0)
+# The object name is the deduplication: a stop seen by many cycles, or by several processes, is queued once.
+# Discovery moves the ids into its work queue and deletes the objects.
+# Every cycle lists the inbox once and only writes the ids missing from it, concurrently: an id TfL never
+# resolves stays unknown, it is written again only after discovery took it out of the inbox.
+
+DISCOVERY_INBOX_PREFIX = 'discovery_inbox'
+DISCOVERY_INBOX_WRITERS = int(os.environ.get('DISCOVERY_INBOX_WRITERS', 16))
+
+
+def inbox_path(naptan_id):
+    return f'{DISCOVERY_INBOX_PREFIX}/{naptan_id}'
+
+
+def queue_unknown_stops(store, naptan_ids, queued_ids, max_workers=DISCOVERY_INBOX_WRITERS):
+    # queued_ids: ids this process already queued, they are not written again every cycle
+    # Failures are printed and do not fail the cycle, the stops are queued again by the next one
+    to_queue = set(naptan_ids) - queued_ids
+    if not to_queue:
+        return 0
+    try:
+        in_inbox = {path[len(DISCOVERY_INBOX_PREFIX) + 1:] for path in store.list_paths(f'{DISCOVERY_INBOX_PREFIX}/')}
+    except Exception as e:
+        print(f'Listing the discovery inbox failed: {e}')
+        in_inbox = set()
+    queued_ids.update(to_queue & in_inbox)
+    to_write = sorted(to_queue - in_inbox)
+
+    def write(naptan_id):
+        # Returns True when the object was created by this call
+        try:
+            store.write_bytes(inbox_path(naptan_id), b'', content_type='text/plain', if_generation_match=0)
+            return True
+        except PreconditionFailed:
+            # Queued by another process since the listing
+            return False
+
+    added = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(to_write) or 1))) as executor:
+        futures = {naptan_id: executor.submit(write, naptan_id) for naptan_id in to_write}
+        for naptan_id, future in futures.items():
+            try:
+                added += future.result()
+            except Exception as e:
+                print(f'Queueing naptanId {naptan_id} for discovery failed: {e}')
+                continue
+            queued_ids.add(naptan_id)
+    if added:
+        print(f'Queued {added} unknown naptanIds for discovery')
+    return added
@@ -0,0 +1,116 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytz
+
+# Incremental enrichment: consecutive Arrivals snapshots mostly contain the same (vehicleId, naptanId)
+# predictions with a smaller timeToStation. Coordinates and cluster of those keys are carried forward
+# from the previous cycle and only keys never seen before go through enrich_data.
+
+KEY_COLUMNS = ['vehicleId', 'naptanId']
+ARRIVALS_COLUMNS = ['vehicleId', 'naptanId', 'lineId', 'timestamp', 'timeToStation']
+ENRICHED_COLUMNS = ['latitude', 'longitude', 'clusterAgglomerative']
+SNAPSHOT_COLUMNS = ARRIVALS_COLUMNS + ENRICHED_COLUMNS + ['pull_time']
+DELTA_COLUMNS = ['change'] + SNAPSHOT_COLUMNS
+
+
+def london_pull_time():
+    london_timezone = pytz.timezone('Europe/London')
+    return datetime.now(london_timezone).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def key_index(df):
+    return pd.MultiIndex.from_frame(df[KEY_COLUMNS].astype(str))
+
+
+def compute_delta(previous_snapshot_df, snapshot_df):
+    # Rows inserted, updated (timeToStation or cluster changed) and removed between two snapshots
+    if previous_snapshot_df is None or len(previous_snapshot_df) == 0:
+        return snapshot_df.assign(change='insert')[DELTA_COLUMNS]
+
+    previous_keys = key_index(previous_snapshot_df)
+    current_keys = key_index(snapshot_df)
+
+    is_new = ~current_keys.isin(previous_keys)
+    is_removed = ~previous_keys.isin(current_keys)
+
+    previous_values = previous_snapshot_df.set_axis(previous_keys)[['timeToStation', 'clusterAgglomerative']]
+    kept = snapshot_df[~is_new]
+    kept_previous = previous_values.loc[current_keys[~is_new]]
+    is_updated = ((kept['timeToStation'].to_numpy() != kept_previous['timeToStation'].to_numpy()) |
+                  (kept['clusterAgglomerative'].to_numpy() != kept_previous['clusterAgglomerative'].to_numpy()))
+
+    delta_df = pd.concat([snapshot_df[is_new].assign(change='insert'),
+                          kept[is_updated].assign(change='update'),
+                          previous_snapshot_df[is_removed].assign(change='delete')],
+                         axis=0, ignore_index=True)
+    return delta_df[DELTA_COLUMNS]
+
+
+class IncrementalEnricher:
+
+    def __init__(self):
+        # Last enriched snapshot, source of the carried forward coordinates and clusters
+        self.snapshot_df = None
+        # Last snapshot that was actually published, deltas are always computed against it
+        self.published_snapshot_df = None
+        self.cluster_table_version = None
+
+    def reset(self):
+        self.snapshot_df = None
+
+    def enrich(self, arrivals_pred_df, enrich_new_rows, cluster_table_version=None):
+        # enrich_new_rows: function enriching a subset of arrivals_pred_df (e.g. enrich_data)
+        # Returns (snapshot, delta against the last published snapshot)
+
+        # Clusters carried forward are only valid for the cluster table version they were computed with
+        if cluster_table_version != self.cluster_table_version:
+            if self.snapshot_df is not None:
+                print('Cluster table changed, enriching every prediction again')
+            self.reset()
+            self.cluster_table_version = cluster_table_version
+
+        # 1) --> One prediction per key, the closest one when a vehicle calls twice at the same stop
+        current_df = (arrivals_pred_df[ARRIVALS_COLUMNS]
+                      .astype({column: str for column in KEY_COLUMNS})
+                      .sort_values('timeToStation', kind='stable')
+                      .drop_duplicates(subset=KEY_COLUMNS, keep='first'))
+
+        # 2) --> Carry forward coordinates and cluster of keys already enriched
+        if self.snapshot_df is not None and len(self.snapshot_df) > 0:
+            is_known = key_index(current_df).isin(key_index(self.snapshot_df))
+        else:
+            is_known = np.zeros(len(current_df), dtype=bool)
+
+        known_df = current_df[is_known].merge(self.snapshot_df[KEY_COLUMNS + ENRICHED_COLUMNS], how='inner', on=KEY_COLUMNS) \
+            if is_known.any() else None
+
+        # 3) --> Enrich only new keys, the ones enrich_data could not place in a cluster are dropped
+        new_df = current_df[~is_known]
+        print(f'Incremental enrichment: {is_known.sum()} predictions carried forward, {len(new_df)} new')
+        if len(new_df) > 0:
+            new_enriched_df = (enrich_new_rows(new_df)
+                               .dropna(subset=['clusterAgglomerative'])
+                               .astype({column: str for column in KEY_COLUMNS})
+                               [KEY_COLUMNS + ENRICHED_COLUMNS]
+                               .drop_duplicates(subset=KEY_COLUMNS))
+            new_df = new_df.merge(new_enriched_df, how='inner', on=KEY_COLUMNS)
+        else:
+            new_df = None
+
+        snapshot_parts = [df for df in [known_df, new_df] if df is not None]
+        if snapshot_parts:
+            snapshot_df = pd.concat(snapshot_parts, axis=0, ignore_index=True)
+        else:
+            snapshot_df = pd.DataFrame(columns=ARRIVALS_COLUMNS + ENRICHED_COLUMNS)
+        snapshot_df['pull_time'] = london_pull_time()
+        snapshot_df = snapshot_df[SNAPSHOT_COLUMNS]
+
+        # 4) --> Keys missing from this cycle expire with the previous snapshot
+        self.snapshot_df = snapshot_df
+        delta_df = compute_delta(self.published_snapshot_df, snapshot_df)
+        return snapshot_df, delta_df
+
+    def commit(self):
+        # Called once the snapshot (and its delta) are published, the next delta starts from it
+        self.published_snapshot_df = self.snapshot_df
@@ -0,0 +1,109 @@
+import asyncio
+import time
+import random
+import ijson
+import pandas as pd
+from pandas.api.types import union_categoricals
+import requests
+import urllib3
+from arrivals_parser import CATEGORICAL_COLUMNS, empty_arrivals_df, parse_arrivals_stream
+
+# Alternative to the single /Mode/bus/Arrivals call: /Line/{ids}/Arrivals is called for batches of line ids
+# with a bounded number of requests in flight. A failed shard only loses its own lines, not the whole cycle.
+
+LINE_IDS_REFRESH_SECONDS = 6 * 60 * 60
+# Errors that only lose the shard: requests errors, and errors of the streamed body that requests does not
+# translate (truncated JSON, connection reset or read timeout while the parser reads response.raw)
+SHARD_ERRORS = (requests.RequestException, ValueError, ijson.JSONError, urllib3.exceptions.HTTPError)
+
+# Bus line ids change with timetable updates only, they are kept for LINE_IDS_REFRESH_SECONDS
+_line_ids_cache = {'line_ids': None, 'fetched_at': 0.0}
+
+
+def fetch_bus_line_ids(tfl_client):
+    if _line_ids_cache['line_ids'] and time.monotonic() - _line_ids_cache['fetched_at'] < LINE_IDS_REFRESH_SECONDS:
+        return _line_ids_cache['line_ids']
+
+    response = tfl_client.get('Line/Mode/bus')
+    response.raise_for_status()
+    line_ids = sorted(line['id'] for line in response.json())
+
+    _line_ids_cache['line_ids'] = line_ids
+    _line_ids_cache['fetched_at'] = time.monotonic()
+    print(f'Fetched {len(line_ids)} bus line ids')
+    return line_ids
+
+
+def fetch_shard(tfl_client, line_ids):
+    # Blocking call, runs in a worker thread. The pooled session of the client is shared by all shards
+    response = tfl_client.get(f'Line/{",".join(line_ids)}/Arrivals', stream=True)
+    with response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return parse_arrivals_stream(response.raw)
+
+
+def retry_delay(attempt, error, base_backoff, max_backoff):
+    # Full jitter, never shorter than the Retry-After TfL sent with a 429 or 503
+    delay = random.uniform(0, min(max_backoff, base_backoff * 2 ** attempt))
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return max(delay, min(max_backoff, float(retry_after))) if retry_after else delay
+    except ValueError:
+        return delay
+
+
+async def fetch_shard_with_limit(tfl_client, line_ids, semaphore, retries, base_backoff=0.5, max_backoff=5.0):
+    for attempt in range(retries + 1):
+        # The semaphore bounds requests in flight, it is not held while backing off
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(fetch_shard, tfl_client, line_ids)
+            except SHARD_ERRORS as e:
+                error = e
+        if attempt == retries:
+            print(f'Shard {line_ids[0]}..{line_ids[-1]} failed after {attempt + 1} attempts: {error}')
+            return None
+        await asyncio.sleep(retry_delay(attempt, error, base_backoff, max_backoff))
+
+
+async def fetch_all_shards(tfl_client, shards, concurrency, retries):
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[fetch_shard_with_limit(tfl_client, shard, semaphore, retries) for shard in shards])
+
+
+def concat_arrivals(arrivals_frames):
+    # Same schema as parse_arrivals_stream: categories of every shard are merged, codes are remapped
+    arrivals_frames = [df for df in arrivals_frames if df is not None and len(df) > 0]
+    if not arrivals_frames:
+        return empty_arrivals_df()
+
+    arrivals_pred_df = pd.DataFrame({
+        column: union_categoricals([df[column] for df in arrivals_frames])
+        for column in CATEGORICAL_COLUMNS
+    })
+    arrivals_pred_df['timeToStation'] = pd.concat([df['timeToStation'] for df in arrivals_frames], ignore_index=True).to_numpy()
+    return arrivals_pred_df
+
+
+def fetch_arrivals_sharded(tfl_client, shard_size=20, concurrency=8, retries=1, max_failed_shards_ratio=0.5):
+    # Returns the merged predictions or an empty frame when too many shards failed to publish a usable snapshot
+
+    try:
+        line_ids = fetch_bus_line_ids(tfl_client)
+    except (requests.RequestException, ValueError) as e:
+        print(f'No Data due to errors fetching bus line ids: {e}')
+        return empty_arrivals_df()
+
+    shards = [line_ids[i:i + shard_size] for i in range(0, len(line_ids), shard_size)]
+    shard_results = asyncio.run(fetch_all_shards(tfl_client, shards, concurrency, retries))
+
+    failed_shards = sum(1 for result in shard_results if result is None)
+    if failed_shards:
+        print(f'{failed_shards} of {len(shards)} arrivals shards failed')
+    if failed_shards > max_failed_shards_ratio * len(shards):
+        print('Too many arrivals shards failed, the snapshot would miss most of the network')
+        return empty_arrivals_df()
+
+    return concat_arrivals(shard_results)
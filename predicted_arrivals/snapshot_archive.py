@@ -0,0 +1,142 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+from snapshot_store import PreconditionFailed
+from snapshot_writer import conform_snapshot, conform_table, snapshot_to_arrow
+
+# Time partitioned archive of every published snapshot, read back by the dashboard playback mode.
+# Each cycle appends one small Parquet part per dataset:
+#   archive/<dataset>/_parts/dt=YYYY-MM-DD/hour=HH/<version>.parquet
+# Once the hour is over its parts are compacted into one file, one row group per snapshot version:
+#   archive/<dataset>/dt=YYYY-MM-DD/hour=HH/frames.parquet
+# Only open hours are left under _parts/, so finding the hours to compact lists a handful of objects.
+
+ARCHIVE_PREFIX = 'archive'
+PARTS_DIR = '_parts'
+COMPACTED_FILE_NAME = 'frames.parquet'
+VERSION_COLUMN = 'version'
+
+
+def version_partition(version):
+    # Versions are UTC timestamps (20250601T120000123456Z) --> dt=2025-06-01/hour=12
+    return f'dt={version[0:4]}-{version[4:6]}-{version[6:8]}/hour={version[9:11]}'
+
+
+def part_path(dataset, version):
+    return f'{ARCHIVE_PREFIX}/{dataset}/{PARTS_DIR}/{version_partition(version)}/{version}.parquet'
+
+
+def compacted_path(dataset, partition):
+    return f'{ARCHIVE_PREFIX}/{dataset}/{partition}/{COMPACTED_FILE_NAME}'
+
+
+def parse_part_path(path):
+    # Returns (partition, version) of a part path
+    partition_and_file = path.split(f'/{PARTS_DIR}/', 1)[1]
+    partition, file_name = partition_and_file.rsplit('/', 1)
+    return partition, file_name[:-len('.parquet')]
+
+
+def archive_frame(store, dataset, version, df):
+    # One snapshot of one dataset, tagged with its version
+    # Parts of one hour share one schema, whatever columns each snapshot came with
+    table = conform_snapshot(snapshot_to_arrow(df))
+    table = table.append_column(VERSION_COLUMN, pa.array([version] * len(df), type=pa.string()))
+    path = part_path(dataset, version)
+    with store.open_writer(path, content_type='application/vnd.apache.parquet') as f:
+        pq.write_table(table, f, compression='zstd')
+    return path
+
+
+def read_parquet(store, path):
+    data, generation = store.read_bytes(path)
+    if data is None:
+        return None, 0
+    return pq.ParquetFile(pa.BufferReader(data)), generation
+
+
+def compact_partition(store, dataset, partition, part_paths):
+    # Parts are streamed in version order into one file, one row group each. Versions already in the
+    # compacted file (late part, or a compaction stopped before deleting its parts) are not written twice
+    path = compacted_path(dataset, partition)
+    existing_file, generation = read_parquet(store, path)
+
+    # (version, function reading that snapshot), only one snapshot is held in memory at a time
+    frames = {}
+    schemas = []
+    if existing_file is not None:
+        schemas.append(existing_file.schema_arrow)
+        for i in range(existing_file.num_row_groups):
+            version = existing_file.read_row_group(i, columns=[VERSION_COLUMN]).column(VERSION_COLUMN)[0].as_py()
+            frames[version] = lambda i=i: existing_file.read_row_group(i)
+    new_versions = 0
+    for part in part_paths:
+        version = parse_part_path(part)[1]
+        if version not in frames:
+            part_file = read_parquet(store, part)[0]
+            # Parts written before every snapshot had the same columns can differ: the file gets the union of
+            # their schemas. Only the footer is kept, the part is read again when its turn comes
+            schemas.append(part_file.schema_arrow)
+            frames[version] = lambda part=part: read_parquet(store, part)[0].read()
+            new_versions += 1
+
+    if new_versions:
+        schema = pa.unify_schemas(schemas, promote_options='permissive')
+        try:
+            with store.open_writer(path, content_type='application/vnd.apache.parquet',
+                                   if_generation_match=generation) as f:
+                writer = pq.ParquetWriter(f, schema, compression='zstd')
+                try:
+                    for version in sorted(frames):
+                        table = frames[version]()
+                        if table.num_rows > 0:
+                            writer.write_table(conform_table(table, schema), row_group_size=table.num_rows)
+                finally:
+                    writer.close()
+        except PreconditionFailed:
+            # Another process compacted this hour in between, its parts are compacted on the next run
+            print(f'Archive partition {path} changed while compacting, keeping its parts')
+            return False
+
+    for part in part_paths:
+        store.delete(part)
+    print(f'Compacted {new_versions} snapshots into {path}')
+    return True
+
+
+def compact_closed_partitions(store, dataset, current_version):
+    # Hours before the hour of current_version receive no new snapshots
+    current_partition = version_partition(current_version)
+    parts_by_partition = {}
+    for path in store.list_paths(f'{ARCHIVE_PREFIX}/{dataset}/{PARTS_DIR}/'):
+        partition, _ = parse_part_path(path)
+        if partition < current_partition:
+            parts_by_partition.setdefault(partition, []).append(path)
+
+    for partition, part_paths in sorted(parts_by_partition.items()):
+        compact_partition(store, dataset, partition, part_paths)
+
+
+def archive_snapshot(store, version, datasets, archive_state):
+    # datasets: {'snapshots': enriched snapshot df, 'density_cubes': density cube df}
+    # archive_state keeps the hour compacted last, so hours are only checked when a new one starts
+    # Failures are printed and do not fail the cycle, the live snapshot is already published. Every dataset is
+    # archived and compacted on its own: a failing one does not hold back the others
+    success = True
+    for dataset, df in datasets.items():
+        try:
+            archive_frame(store, dataset, version, df)
+        except Exception as e:
+            print(f'Archiving {dataset} of snapshot version {version} failed: {e}')
+            success = False
+
+    partition = version_partition(version)
+    if archive_state.get('partition') != partition:
+        for dataset in datasets:
+            try:
+                compact_closed_partitions(store, dataset, version)
+            except Exception as e:
+                # Parts that could not be compacted stay under _parts/ and are tried again when the next hour starts
+                print(f'Compacting {dataset} archive before version {version} failed: {e}')
+                success = False
+        archive_state['partition'] = partition
+    return success
@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import random
+import fcntl
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from google.api_core import exceptions as gcp_exceptions
+
+# Atomic snapshot publication. Every snapshot is written once to an immutable versioned path
+# (snapshots/<version>/...) and a small manifest object is then swapped with a generation-match
+# precondition to point at it. Readers read the manifest and follow it, so they never see a half
+# written file and the job never needs a temporary copy, a fixed sleep or a delete.
+
+SNAPSHOTS_PREFIX = 'snapshots'
+MANIFEST_PATH = 'latest/manifest.json'
+KEEP_VERSIONS = int(os.environ.get('SNAPSHOT_KEEP_VERSIONS', 5))
+
+# publish_snapshot results
+PUBLISHED = 'published'
+# A newer version was published concurrently, this one is dropped
+SUPERSEDED = 'superseded'
+FAILED = 'failed'
+
+
+class PreconditionFailed(Exception):
+    pass
+
+
+class GcsObjectStore:
+
+    def __init__(self, Storage_client, bucket_name):
+        self.bucket = Storage_client.bucket(bucket_name)
+
+    @contextmanager
+    def open_writer(self, path, content_type=None, if_generation_match=0):
+        # if_generation_match=0: versioned objects are created once and never overwritten
+        blob = self.bucket.blob(path)
+        try:
+            with blob.open('wb', ignore_flush=True, content_type=content_type,
+                           if_generation_match=if_generation_match) as blob_file:
+                yield blob_file
+        except gcp_exceptions.PreconditionFailed as e:
+            raise PreconditionFailed(str(e))
+
+    def read_bytes(self, path):
+        # Returns (data, generation), generation 0 when the object does not exist
+        blob = self.bucket.blob(path)
+        try:
+            data = blob.download_as_bytes()
+        except gcp_exceptions.NotFound:
+            return None, 0
+        return data, blob.generation
+
+    def write_bytes(self, path, data, content_type=None, if_generation_match=None):
+        blob = self.bucket.blob(path)
+        try:
+            blob.upload_from_string(data, content_type=content_type, if_generation_match=if_generation_match)
+        except gcp_exceptions.PreconditionFailed as e:
+            raise PreconditionFailed(str(e))
+        return blob.generation
+
+    def delete(self, path):
+        try:
+            self.bucket.blob(path).delete()
+        except gcp_exceptions.NotFound:
+            pass
+
+    def list_paths(self, prefix):
+        return sorted(blob.name for blob in self.bucket.list_blobs(prefix=prefix))
+
+
+class LocalObjectStore:
+    # Local filesystem stand-in with the same generation semantics, used for local runs and benchmarks
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        self.lock_path = os.path.join(root_dir, '.store.lock')
+
+    def full_path(self, path):
+        return os.path.join(self.root_dir, path)
+
+    def generation(self, path):
+        try:
+            with open(self.full_path(path) + '.generation') as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    @contextmanager
+    def locked(self):
+        # Serialises compare-and-swap between threads and processes sharing the directory
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def commit_file(self, tmp_path, path, if_generation_match):
+        with self.locked():
+            current_generation = self.generation(path)
+            if if_generation_match is not None and current_generation != if_generation_match:
+                os.remove(tmp_path)
+                raise PreconditionFailed(f'{path}: generation {current_generation} != {if_generation_match}')
+            os.replace(tmp_path, self.full_path(path))
+            new_generation = time.time_ns()
+            with open(self.full_path(path) + '.generation', 'w') as f:
+                f.write(str(new_generation))
+        return new_generation
+
+    @contextmanager
+    def open_writer(self, path, content_type=None, if_generation_match=0):
+        os.makedirs(os.path.dirname(self.full_path(path)), exist_ok=True)
+        tmp_path = f'{self.full_path(path)}.tmp-{os.getpid()}-{time.time_ns()}'
+        try:
+            with open(tmp_path, 'wb') as f:
+                yield f
+        except BaseException:
+            # Same as an aborted GCS upload: nothing is committed and no temporary file is left behind
+            os.remove(tmp_path)
+            raise
+        self.commit_file(tmp_path, path, if_generation_match=if_generation_match)
+
+    def read_bytes(self, path):
+        with self.locked():
+            try:
+                with open(self.full_path(path), 'rb') as f:
+                    return f.read(), self.generation(path)
+            except FileNotFoundError:
+                return None, 0
+
+    def write_bytes(self, path, data, content_type=None, if_generation_match=None):
+        os.makedirs(os.path.dirname(self.full_path(path)), exist_ok=True)
+        tmp_path = f'{self.full_path(path)}.tmp-{os.getpid()}-{time.time_ns()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return self.commit_file(tmp_path, path, if_generation_match)
+
+    def delete(self, path):
+        for file_path in [self.full_path(path), self.full_path(path) + '.generation']:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+    def list_paths(self, prefix):
+        # Object names under prefix, the lock and generation sidecar files are not objects
+        paths = []
+        for dir_path, _, file_names in os.walk(self.root_dir):
+            for file_name in file_names:
+                if file_name.endswith('.generation') or file_name == '.store.lock' or '.tmp-' in file_name:
+                    continue
+                path = os.path.relpath(os.path.join(dir_path, file_name), self.root_dir)
+                if path.startswith(prefix):
+                    paths.append(path)
+        return sorted(paths)
+
+
+def new_snapshot_version():
+    # Sortable and unique per cycle, e.g. 20250601T120000123456Z
+    return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+
+
+def snapshot_object_path(version, file_name, prefix=SNAPSHOTS_PREFIX):
+    return f'{prefix}/{version}/{file_name}'
+
+
+def read_manifest(store, manifest_path=MANIFEST_PATH):
+    # Returns (manifest dict or None, generation)
+    data, generation = store.read_bytes(manifest_path)
+    if data is None:
+        return None, 0
+    return json.loads(data), generation
+
+
+def publish_snapshot(store, version, files, manifest_path=MANIFEST_PATH, keep_versions=KEEP_VERSIONS, max_attempts=5,
+                     tfl_validators=None):
+    # files: {'snapshot': path, 'delta': path, ...} already written under the version prefix
+    # tfl_validators: ETag / Last-Modified of the TfL responses the snapshot was built from, kept in the manifest
+    # Returns PUBLISHED when the manifest points at this version, SUPERSEDED when it already points at a newer
+    # one (the files of this version are deleted), FAILED when the manifest could not be swapped
+
+    for attempt in range(1, max_attempts + 1):
+        manifest, generation = read_manifest(store, manifest_path)
+
+        if manifest is not None and manifest['version'] >= version:
+            # A newer snapshot was published concurrently, this one would never be referenced
+            print(f"Manifest already points at version {manifest['version']}, version {version} is not published")
+            for path in files.values():
+                store.delete(path)
+            return SUPERSEDED
+
+        history = ([manifest] + manifest.get('history', [])) if manifest is not None else []
+        history = [{'version': entry['version'], 'files': entry['files']} for entry in history]
+        new_manifest = {'version': version,
+                        'published_at': datetime.now(timezone.utc).isoformat(),
+                        'files': files,
+                        'history': history[:keep_versions - 1]}
+        if tfl_validators is not None:
+            new_manifest['tfl_validators'] = tfl_validators
+
+        try:
+            store.write_bytes(manifest_path, json.dumps(new_manifest).encode('utf-8'),
+                              content_type='application/json', if_generation_match=generation)
+        except PreconditionFailed:
+            # Another writer swapped the manifest in between, read it again after a jittered backoff
+            backoff = min(2.0, 0.1 * 2 ** (attempt - 1))
+            print(f'Manifest changed while publishing version {version}, retrying ({attempt}/{max_attempts})')
+            time.sleep(random.uniform(0, backoff))
+            continue
+
+        print(f'Published snapshot version {version}')
+
+        # Versions falling out of the history are no longer referenced by any manifest
+        for expired in history[keep_versions - 1:]:
+            for path in expired['files'].values():
+                store.delete(path)
+        return PUBLISHED
+
+    print(f'Could not publish snapshot version {version} after {max_attempts} attempts')
+    return FAILED
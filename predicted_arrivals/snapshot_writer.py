@@ -0,0 +1,91 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Serialisation of the enriched snapshot. Parquet (zstd, explicit schema) is written straight into a
+# file-like object such as blob.open('wb'), which uploads it in chunks: no full CSV string is ever built.
+
+SNAPSHOT_FORMATS = {'parquet': ('parquet', 'application/vnd.apache.parquet'),
+                    'csv': ('csv', 'text/csv')}
+
+SNAPSHOT_SCHEMA_FIELDS = {
+    'vehicleId': pa.dictionary(pa.int32(), pa.string()),
+    'naptanId': pa.dictionary(pa.int32(), pa.string()),
+    'lineId': pa.dictionary(pa.int32(), pa.string()),
+    'timestamp': pa.dictionary(pa.int32(), pa.string()),
+    'timeToStation': pa.int32(),
+    'latitude': pa.float64(),
+    'longitude': pa.float64(),
+    'clusterAgglomerative': pa.int32(),
+    'pull_time': pa.string(),
+}
+
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+
+
+def snapshot_file_name(base_name, snapshot_format):
+    extension, _ = SNAPSHOT_FORMATS[snapshot_format]
+    return f'{base_name}.{extension}'
+
+
+def snapshot_content_type(snapshot_format):
+    return SNAPSHOT_FORMATS[snapshot_format][1]
+
+
+def snapshot_schema(df):
+    # Known columns get their explicit type, anything else is inferred
+    fields = []
+    for column in df.columns:
+        if column in SNAPSHOT_SCHEMA_FIELDS:
+            fields.append(pa.field(column, SNAPSHOT_SCHEMA_FIELDS[column]))
+        else:
+            fields.append(pa.field(column, pa.Array.from_pandas(df[column]).type))
+    return pa.schema(fields)
+
+
+def conform_table(table, schema):
+    # Columns of schema in its order, cast to its types, missing ones filled with nulls
+    arrays = []
+    for field in schema:
+        if field.name in table.column_names:
+            arrays.append(table.column(field.name).cast(field.type))
+        else:
+            arrays.append(pa.nulls(table.num_rows, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def conform_snapshot(table):
+    # Snapshots always get every known column, known columns first: every version has the same schema for the
+    # external table and the other readers. Other frames (density cubes, deltas) are left as they are
+    # (density cubes share the cluster and coordinates columns, not the arrival ones)
+    if 'vehicleId' not in table.column_names:
+        return table
+    fields = [pa.field(name, field_type) for name, field_type in SNAPSHOT_SCHEMA_FIELDS.items()]
+    fields += [field for field in table.schema if field.name not in SNAPSHOT_SCHEMA_FIELDS]
+    return conform_table(table, pa.schema(fields))
+
+
+def snapshot_to_arrow(df):
+    schema = snapshot_schema(df)
+    arrays = []
+    for field in schema:
+        values = df[field.name]
+        if pa.types.is_dictionary(field.type):
+            # Categoricals keep their codes, plain string columns are dictionary encoded here
+            array = pa.Array.from_pandas(values.astype('category'))
+            arrays.append(array.cast(field.type))
+        else:
+            # from_pandas turns NaN into nulls, e.g. a naptanId that could not be placed in any cluster
+            arrays.append(pa.Array.from_pandas(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_snapshot(df, file_obj, snapshot_format='parquet'):
+    # file_obj: binary file-like object (blob.open('wb'), open(path, 'wb'), BytesIO, ...)
+    if snapshot_format == 'parquet':
+        pq.write_table(conform_snapshot(snapshot_to_arrow(df)), file_obj, compression='zstd', row_group_size=PARQUET_ROW_GROUP_SIZE)
+    elif snapshot_format == 'csv':
+        # Rows are encoded chunk by chunk into the binary stream
+        df.to_csv(file_obj, index=False, encoding='utf-8')
+    else:
+        raise ValueError(f'Unknown snapshot format: {snapshot_format}')
+
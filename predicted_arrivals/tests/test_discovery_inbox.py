@@ -0,0 +1,60 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snapshot_store import LocalObjectStore
+from discovery_inbox import inbox_path, queue_unknown_stops
+
+# python3 -m pytest tests/
+
+
+class CountingStore(LocalObjectStore):
+
+    def __init__(self, root_dir):
+        super().__init__(root_dir)
+        self.writes = 0
+        self.listings = 0
+
+    def list_paths(self, prefix):
+        self.listings += 1
+        return super().list_paths(prefix)
+
+    def write_bytes(self, path, data, content_type=None, if_generation_match=None):
+        self.writes += 1
+        return super().write_bytes(path, data, content_type=content_type, if_generation_match=if_generation_match)
+
+
+def test_only_ids_missing_from_the_inbox_are_written(tmp_path):
+    store = CountingStore(str(tmp_path))
+    store.write_bytes(inbox_path('n1'), b'', if_generation_match=0)
+    store.writes = 0
+
+    # A new process (job mode) knows nothing of earlier cycles, the listing tells it what is already queued
+    queued_ids = set()
+    assert queue_unknown_stops(store, ['n1', 'n2', 'n3', 'n3'], queued_ids) == 2
+    assert store.listings == 1 and store.writes == 2
+    assert queued_ids == {'n1', 'n2', 'n3'}
+
+    # Next cycle of the same process: nothing to list or write
+    assert queue_unknown_stops(store, ['n1', 'n2'], queued_ids) == 0
+    assert store.listings == 1 and store.writes == 2
+    assert store.list_paths('discovery_inbox/') == ['discovery_inbox/n1', 'discovery_inbox/n2', 'discovery_inbox/n3']
+
+
+def test_failed_writes_are_retried_next_cycle(tmp_path):
+    store = CountingStore(str(tmp_path))
+    failing = {'n2'}
+
+    def write_bytes(path, data, content_type=None, if_generation_match=None):
+        if path.endswith(tuple(failing)):
+            raise OSError('unavailable')
+        return CountingStore.write_bytes(store, path, data, content_type, if_generation_match)
+
+    store.write_bytes = write_bytes
+    queued_ids = set()
+    assert queue_unknown_stops(store, ['n1', 'n2'], queued_ids) == 1
+    assert queued_ids == {'n1'}
+
+    failing.clear()
+    assert queue_unknown_stops(store, ['n1', 'n2'], queued_ids) == 1
+    assert queued_ids == {'n1', 'n2'}
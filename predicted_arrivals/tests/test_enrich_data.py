@@ -0,0 +1,57 @@
+import os
+import sys
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from arrivals_process_v1 import enrich_data
+
+# python3 -m pytest tests/
+
+
+class FakeBigQuery:
+    # Answers the raw coordinates query with the rows of the requested naptanIds
+
+    def __init__(self, raw_rows):
+        self.raw_rows = raw_rows
+        self.queries = []
+
+    def query(self, query, job_config=None):
+        self.queries.append((query, job_config))
+        (parameter,) = job_config.query_parameters
+        return [row for row in self.raw_rows if row[0] in parameter.values]
+
+
+def clusters():
+    return pd.DataFrame({'naptanId': ['n1', 'n2'], 'commonName': ['A', 'B'], 'latitude': [51.5, 51.6],
+                         'longitude': [-0.1, -0.2], 'clusterAgglomerative': [3, 4]})
+
+
+def arrivals(naptan_ids):
+    return pd.DataFrame({'vehicleId': [f'v{i}' for i in range(len(naptan_ids))], 'naptanId': naptan_ids,
+                         'lineId': ['1'] * len(naptan_ids), 'timestamp': ['2025-06-01T12:00:00Z'] * len(naptan_ids),
+                         'timeToStation': [60] * len(naptan_ids)})
+
+
+def test_single_unclustered_id_is_passed_as_a_parameter():
+    client = FakeBigQuery([('n9', 'New stop', 51.5001, -0.1001)])
+    enriched = enrich_data(client, 'project', 'data_set', arrivals(['n1', 'n9', 'n9']), clusters())
+
+    (query, job_config), = client.queries
+    assert 'IN UNNEST(@naptan_ids)' in query
+    assert job_config.query_parameters[0].values == ['n9']
+    assert sorted(enriched['naptanId']) == ['n1', 'n9', 'n9']
+    # Same columns as when every naptanId is already clustered
+    assert list(enriched.columns) == ['vehicleId', 'naptanId', 'lineId', 'timestamp', 'timeToStation', 'latitude',
+                                      'longitude', 'clusterAgglomerative', 'pull_time']
+    assert set(enriched.loc[enriched['naptanId'] == 'n9', 'clusterAgglomerative']) == {3}
+
+
+def test_ids_missing_from_the_raw_table_are_reported():
+    client = FakeBigQuery([('n9', 'New stop', 51.6001, -0.2001)])
+    unknown = set()
+    enriched = enrich_data(client, 'project', 'data_set', arrivals(['n2', 'n8', 'n9']), clusters(),
+                           unknown_naptan_ids=unknown)
+
+    assert client.queries[0][1].query_parameters[0].values == ['n8', 'n9']
+    assert unknown == {'n8'}
+    assert sorted(enriched['naptanId']) == ['n2', 'n9']
@@ -0,0 +1,68 @@
+import os
+import sys
+import warnings
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snapshot_store import LocalObjectStore
+from snapshot_archive import (archive_frame, archive_snapshot, compact_closed_partitions, compacted_path,
+                              part_path, read_parquet)
+from density_cube import build_density_cube
+
+# python3 -m pytest tests/
+
+
+def enriched_snapshot(with_line_columns):
+    # Snapshots of earlier cycles may lack lineId and timestamp (enrich_data dropped them for new naptanIds)
+    df = pd.DataFrame({'vehicleId': ['v1', 'v2'], 'naptanId': ['n1', 'n2'], 'lineId': ['1', '2'],
+                       'timestamp': ['2025-06-01T12:00:00Z'] * 2, 'timeToStation': [60, 300],
+                       'latitude': [51.5, 51.6], 'longitude': [-0.1, -0.2], 'clusterAgglomerative': [3, 4],
+                       'pull_time': ['2025-06-01 13:00:00'] * 2})
+    if not with_line_columns:
+        df = df[['vehicleId', 'naptanId', 'timeToStation', 'latitude', 'longitude', 'clusterAgglomerative', 'pull_time']]
+    return df
+
+
+def test_hour_with_both_enrich_shapes_is_compacted(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    versions = ['20250601T120000000000Z', '20250601T120030000000Z', '20250601T120100000000Z']
+    for version, with_line_columns in zip(versions, [True, False, True]):
+        snapshot_df = enriched_snapshot(with_line_columns)
+        assert archive_snapshot(store, version, {'snapshots': snapshot_df,
+                                                 'density_cubes': build_density_cube(snapshot_df)}, {})
+
+    # The first snapshot of the next hour compacts the closed one, for both datasets
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        next_df = enriched_snapshot(False)
+        assert archive_snapshot(store, '20250601T130000000000Z',
+                                {'snapshots': next_df, 'density_cubes': build_density_cube(next_df)}, {})
+
+    for dataset in ['snapshots', 'density_cubes']:
+        assert store.list_paths(f'archive/{dataset}/_parts/dt=2025-06-01/hour=12/') == []
+        parquet_file, _ = read_parquet(store, compacted_path(dataset, 'dt=2025-06-01/hour=12'))
+        assert parquet_file.num_row_groups == 3
+
+    snapshots = pq.read_table(tmp_path / compacted_path('snapshots', 'dt=2025-06-01/hour=12')).to_pandas()
+    assert snapshots['lineId'].isna().tolist() == [False, False, True, True, False, False]
+    assert sorted(snapshots['version'].unique()) == versions
+
+
+def test_parts_written_with_different_columns_are_unified(tmp_path):
+    # Parts archived before snapshots were given a fixed column set
+    store = LocalObjectStore(str(tmp_path))
+    old_part = part_path('snapshots', '20250601T120000000000Z')
+    table = pq.read_table(tmp_path / archive_frame(store, 'snapshots', '20250601T120030000000Z',
+                                                   enriched_snapshot(True)))
+    old_table = table.drop_columns(['lineId', 'timestamp'])
+    old_table = old_table.set_column(old_table.column_names.index('version'), 'version',
+                                     pa.array(['20250601T120000000000Z'] * old_table.num_rows))
+    with store.open_writer(old_part) as f:
+        pq.write_table(old_table, f)
+
+    compact_closed_partitions(store, 'snapshots', '20250601T130000000000Z')
+    compacted = pq.read_table(tmp_path / compacted_path('snapshots', 'dt=2025-06-01/hour=12'))
+    assert compacted.num_rows == 4
+    assert 'lineId' in compacted.column_names
@@ -0,0 +1,136 @@
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snapshot_store import (FAILED, PUBLISHED, SUPERSEDED, LocalObjectStore, publish_snapshot, read_manifest,
+                            snapshot_object_path)
+from tfl_client import TflClient
+
+# python3 -m pytest tests/
+
+
+def write_version(store, version):
+    path = snapshot_object_path(version, 'arrivals_snapshot.parquet')
+    with store.open_writer(path) as f:
+        f.write(version.encode('utf-8'))
+    return {'snapshot': path}
+
+
+def exists(store, files):
+    return all(os.path.exists(store.full_path(path)) for path in files.values())
+
+
+class RacingStore(LocalObjectStore):
+    # Another publisher swaps the manifest between the read and the first write of this one
+
+    def __init__(self, root_dir, racing_version):
+        super().__init__(root_dir)
+        self.racing_version = racing_version
+
+    def write_bytes(self, path, data, content_type=None, if_generation_match=None):
+        if self.racing_version is not None:
+            racing_version, self.racing_version = self.racing_version, None
+            assert publish_snapshot(self, racing_version, write_version(self, racing_version)) == PUBLISHED
+        return super().write_bytes(path, data, content_type=content_type, if_generation_match=if_generation_match)
+
+
+def test_manifest_swap_retries_after_a_concurrent_publish(tmp_path):
+    store = RacingStore(str(tmp_path), racing_version='20250601T120000000000Z')
+    files = write_version(store, '20250601T120030000000Z')
+
+    assert publish_snapshot(store, '20250601T120030000000Z', files) == PUBLISHED
+
+    # The racing version was not overwritten blindly: it is kept in the history of the newer one
+    manifest, _ = read_manifest(store)
+    assert manifest['version'] == '20250601T120030000000Z'
+    assert [entry['version'] for entry in manifest['history']] == ['20250601T120000000000Z']
+
+
+def test_concurrent_publishers_end_on_the_newest_version(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    published = []
+    lock = threading.Lock()
+
+    def publisher(index):
+        for cycle in range(5):
+            version = f'20250601T12{cycle:02d}{index:02d}000000Z'
+            if publish_snapshot(store, version, write_version(store, version), keep_versions=3,
+                                max_attempts=50) == PUBLISHED:
+                with lock:
+                    published.append(version)
+
+    threads = [threading.Thread(target=publisher, args=(index,)) for index in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    manifest, _ = read_manifest(store)
+    assert manifest['version'] == max(published)
+    assert exists(store, manifest['files'])
+    assert all(exists(store, entry['files']) for entry in manifest['history'])
+
+
+def test_history_keeps_the_last_versions_and_deletes_the_others(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    versions = [f'20250601T1200{second:02d}000000Z' for second in range(6)]
+    files = {version: write_version(store, version) for version in versions}
+    for version in versions:
+        assert publish_snapshot(store, version, files[version], keep_versions=3) == PUBLISHED
+
+    manifest, _ = read_manifest(store)
+    assert manifest['version'] == versions[-1]
+    assert [entry['version'] for entry in manifest['history']] == [versions[-2], versions[-3]]
+    assert all(exists(store, files[version]) for version in versions[-3:])
+    assert not any(os.path.exists(store.full_path(files[version]['snapshot'])) for version in versions[:-3])
+
+
+def test_older_version_is_superseded(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+    newer_files = write_version(store, '20250601T120030000000Z')
+    older_files = write_version(store, '20250601T120000000000Z')
+    assert publish_snapshot(store, '20250601T120030000000Z', newer_files) == PUBLISHED
+
+    assert publish_snapshot(store, '20250601T120000000000Z', older_files) == SUPERSEDED
+
+    manifest, _ = read_manifest(store)
+    assert manifest['version'] == '20250601T120030000000Z'
+    assert manifest['history'] == []
+    assert not os.path.exists(store.full_path(older_files['snapshot']))
+
+
+def test_manifest_that_keeps_changing_fails(tmp_path):
+    store = LocalObjectStore(str(tmp_path))
+
+    def always_stale(path, data, content_type=None, if_generation_match=None):
+        return LocalObjectStore.write_bytes(store, path, data, content_type=content_type, if_generation_match=-1)
+
+    store.write_bytes = always_stale
+    files = write_version(store, '20250601T120000000000Z')
+    assert publish_snapshot(store, '20250601T120000000000Z', files, max_attempts=2) == FAILED
+
+
+def test_tfl_validators_survive_a_new_process(tmp_path):
+    class Response:
+        status_code = 200
+        headers = {'ETag': '"v1"', 'Last-Modified': 'Sun, 01 Jun 2025 12:00:00 GMT'}
+
+    sent_headers = []
+    client = TflClient(app_key='key')
+    client.session.get = lambda url, params, headers, timeout, stream: sent_headers.append(headers) or Response()
+    client.get('Mode/bus/Arrivals', conditional=True)
+
+    store = LocalObjectStore(str(tmp_path))
+    version = '20250601T120000000000Z'
+    assert publish_snapshot(store, version, write_version(store, version),
+                            tfl_validators=client.validators_to_commit()) == PUBLISHED
+
+    # Next job execution: a new client, validators loaded from the manifest
+    manifest, _ = read_manifest(store)
+    new_client = TflClient(app_key='key')
+    new_client.load_validators(manifest['tfl_validators'])
+    new_client.session.get = lambda url, params, headers, timeout, stream: sent_headers.append(headers) or Response()
+    new_client.get('Mode/bus/Arrivals', conditional=True)
+    assert sent_headers == [{}, {'If-None-Match': '"v1"', 'If-Modified-Since': 'Sun, 01 Jun 2025 12:00:00 GMT'}]
+    assert 'key' not in str(manifest['tfl_validators'])
@@ -0,0 +1,32 @@
+import os
+import sys
+from io import BytesIO
+import pandas as pd
+import pyarrow.parquet as pq
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snapshot_writer import SNAPSHOT_SCHEMA_FIELDS, write_snapshot
+from density_cube import build_density_cube
+
+# python3 -m pytest tests/
+
+
+def written_schema(df):
+    buffer = BytesIO()
+    write_snapshot(df, buffer, 'parquet')
+    buffer.seek(0)
+    return pq.read_schema(buffer)
+
+
+def test_snapshots_always_have_every_known_column():
+    full_df = pd.DataFrame({'vehicleId': ['v1'], 'naptanId': ['n1'], 'lineId': ['1'],
+                            'timestamp': ['2025-06-01T12:00:00Z'], 'timeToStation': [60], 'latitude': [51.5],
+                            'longitude': [-0.1], 'clusterAgglomerative': [3], 'pull_time': ['2025-06-01 13:00:00']})
+    partial_df = full_df.drop(columns=['lineId', 'timestamp'])
+
+    assert written_schema(partial_df) == written_schema(full_df)
+    assert written_schema(partial_df).names == list(SNAPSHOT_SCHEMA_FIELDS)
+
+    # Density cubes are not snapshots, they keep their own columns
+    cube_df = build_density_cube(full_df)
+    assert written_schema(cube_df).names == list(cube_df.columns)
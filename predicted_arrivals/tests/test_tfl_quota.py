@@ -0,0 +1,39 @@
+import os
+import sys
+import time
+import threading
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from tfl_quota import DISCOVERY, LIVE, DeadlineExceeded, SqliteQuotaBackend, TflQuota
+
+# python3 -m pytest tests/
+
+
+def test_discovery_leaves_the_reserve_to_live_arrivals(tmp_path):
+    backend = SqliteQuotaBackend(str(tmp_path / 'quota.sqlite3'), rate_per_second=0.01, capacity=4)
+    discovery = TflQuota(backend, caller='stop_discovery', priority=DISCOVERY)
+    live = TflQuota(backend, caller='arrivals', priority=LIVE)
+
+    for _ in range(3):
+        discovery.acquire()
+    # One token left: it is the reserve of live arrivals
+    with pytest.raises(DeadlineExceeded):
+        discovery.acquire(deadline=time.monotonic() + 1)
+    live.acquire(deadline=time.monotonic() + 1)
+    assert discovery.metrics()['tokens_spent'] == 3
+    assert live.metrics()['tokens_spent'] == 1
+
+
+def test_waiting_caller_does_not_hold_back_a_deadline(tmp_path):
+    backend = SqliteQuotaBackend(str(tmp_path / 'quota.sqlite3'), rate_per_second=0.1, capacity=1)
+    quota = TflQuota(backend, caller='stop_discovery')
+    quota.acquire()
+
+    # Another thread waits for the next token (10 s away), a caller with a deadline gives up right away
+    threading.Thread(target=quota.acquire, daemon=True).start()
+    time.sleep(0.1)
+    started_at = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        quota.acquire(deadline=time.monotonic() + 0.5)
+    assert time.monotonic() - started_at < 0.5
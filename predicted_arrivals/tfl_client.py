@@ -0,0 +1,85 @@
+import os
+from urllib.parse import urlencode
+import requests
+from requests.adapters import HTTPAdapter
+
+# Shared TfL API client: one pooled keep-alive session, gzip responses, connect/read deadlines and
+# conditional requests (ETag / Last-Modified) so an unchanged feed comes back as a 304 with no body.
+# With a quota (tfl_quota.TflQuota) every request first takes a token of the budget shared by the app key.
+
+TFL_API_URL = 'https://api.tfl.gov.uk'
+TFL_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('TFL_CONNECT_TIMEOUT_SECONDS', 5))
+TFL_READ_TIMEOUT_SECONDS = float(os.environ.get('TFL_READ_TIMEOUT_SECONDS', 30))
+
+
+class TflClient:
+
+    def __init__(self, app_key=None, connect_timeout=TFL_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout=TFL_READ_TIMEOUT_SECONDS, pool_size=10, base_url=TFL_API_URL, quota=None):
+        self.app_key = app_key
+        self.quota = quota
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept': 'application/json',
+                                     'Accept-Encoding': 'gzip, deflate'})
+
+        # url -> (ETag, Last-Modified) of the last response that was fully processed
+        self.validators = {}
+        # Validators of responses received but not processed yet, see commit_validators
+        self.pending_validators = {}
+
+    def url(self, path):
+        return f'{self.base_url}/{path.lstrip("/")}'
+
+    def get(self, path, params=None, conditional=False, stream=False, deadline=None):
+        # deadline (time.monotonic()): the request is not sent when the quota has no token for it before then,
+        # tfl_quota.DeadlineExceeded is raised
+        url = self.url(path)
+        params = dict(params or {})
+        validators_key = url + ('?' + urlencode(sorted(params.items())) if params else '')
+        if self.app_key:
+            params['app_key'] = self.app_key
+
+        headers = {}
+        if conditional and validators_key in self.validators:
+            etag, last_modified = self.validators[validators_key]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        if self.quota is not None:
+            self.quota.acquire(deadline=deadline)
+        response = self.session.get(url, params=params, headers=headers, timeout=self.timeout, stream=stream)
+        if self.quota is not None:
+            self.quota.record_response(response.status_code)
+
+        if conditional and response.status_code == 200:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag or last_modified:
+                self.pending_validators[validators_key] = (etag, last_modified)
+
+        return response
+
+    def validators_to_commit(self):
+        # Validators once commit_validators ran, {url: [ETag, Last-Modified]}, stored with the published snapshot
+        return {key: list(value) for key, value in {**self.validators, **self.pending_validators}.items()}
+
+    def load_validators(self, validators):
+        # Validators stored by a previous process, so a new process can ask for changes since its snapshot
+        self.validators.update({key: tuple(value) for key, value in validators.items()})
+
+    def commit_validators(self):
+        # Called once the cycle has published the data, a failed cycle never leaves a validator behind
+        # that would make the next request answer 304 for data that was never published
+        self.validators.update(self.pending_validators)
+        self.pending_validators.clear()
+
+    def close(self):
+        self.session.close()
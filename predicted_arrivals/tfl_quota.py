@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+from google.api_core import exceptions as gcp_exceptions
+
+# TfL request budget shared by every caller of the app key (arrivals job, stop discovery, backfills).
+# One token bucket holds the whole key quota, callers take tokens from it before each request:
+#   GcsQuotaBackend     bucket in a small JSON object swapped with generation-match, shared by every service.
+#                       The deployed configuration: the arrivals job and the discovery function never share a host
+#   SqliteQuotaBackend  bucket row in a SQLite file, shared by the processes of one host (local runs)
+# Priorities: a caller only takes a token while the bucket keeps the reserve of its priority, so live arrivals
+# always find tokens that discovery and backfills are not allowed to spend.
+# Remote backends are slow per call: callers lease lease_size tokens at a time and spend them locally.
+
+LIVE = 0
+DISCOVERY = 1
+BACKFILL = 2
+# Share of the bucket capacity a priority must leave in it
+PRIORITY_RESERVE = {LIVE: 0.0, DISCOVERY: 0.25, BACKFILL: 0.5}
+
+# TfL allows 500 requests per minute per app key
+QUOTA_REQUESTS_PER_MINUTE = float(os.environ.get('TFL_QUOTA_REQUESTS_PER_MINUTE', 500))
+QUOTA_BURST = float(os.environ.get('TFL_QUOTA_BURST', 50))
+# Bucket both the arrivals job and stop discovery can write to
+QUOTA_BUCKET = os.environ.get('TFL_QUOTA_BUCKET', 'bus_stop_points')
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class SqliteQuotaBackend:
+
+    def __init__(self, path, rate_per_second, capacity, bucket_name='tfl'):
+        self.path = path
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.bucket_name = bucket_name
+        self.connection = sqlite3.connect(path, isolation_level=None, timeout=30, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)')
+        self.lock = threading.Lock()
+
+    def take(self, tokens, floor):
+        # Returns 0 when the tokens were taken, otherwise the seconds to wait before asking again
+        # Wall clock time: the bucket is shared between processes, monotonic clocks are not
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = self.connection.execute('SELECT tokens, updated_at FROM token_buckets WHERE name = ?',
+                                              (self.bucket_name,)).fetchone()
+                available = self.capacity if row is None else min(self.capacity, row[0] + (now - row[1]) * self.rate)
+                wait_seconds = 0.0
+                if available - tokens >= floor:
+                    available -= tokens
+                else:
+                    wait_seconds = (tokens + floor - available) / self.rate
+                self.connection.execute('INSERT OR REPLACE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                                        (self.bucket_name, available, now))
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.connection.execute('COMMIT')
+        return wait_seconds
+
+
+class GcsQuotaBackend:
+
+    def __init__(self, bucket, object_path, rate_per_second, capacity, max_attempts=10):
+        self.bucket = bucket
+        self.object_path = object_path
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.max_attempts = max_attempts
+
+    def take(self, tokens, floor):
+        # Same bucket as SqliteQuotaBackend in {"tokens": n, "updated_at": t}, read-modify-write with
+        # generation match, retried when another caller swapped the object in between
+        for attempt in range(self.max_attempts):
+            blob = self.bucket.blob(self.object_path)
+            try:
+                state = json.loads(blob.download_as_bytes())
+                generation = blob.generation
+            except gcp_exceptions.NotFound:
+                state, generation = {'tokens': self.capacity, 'updated_at': time.time()}, 0
+
+            now = time.time()
+            available = min(self.capacity, state['tokens'] + max(0.0, now - state['updated_at']) * self.rate)
+            if available - tokens < floor:
+                # Nothing written: refilling is computed from updated_at by the next caller anyway
+                return (tokens + floor - available) / self.rate
+            try:
+                blob.upload_from_string(json.dumps({'tokens': available - tokens, 'updated_at': now}),
+                                        content_type='application/json', if_generation_match=generation)
+                return 0.0
+            except gcp_exceptions.PreconditionFailed:
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        # Contended: ask again a little later instead of failing the request
+        return tokens / self.rate
+
+
+class TflQuota:
+    # Thread safe front of a backend for one caller, keeps its metrics
+
+    def __init__(self, backend, caller, priority=LIVE, lease_size=1, max_wait_step=5.0):
+        self.backend = backend
+        self.caller = caller
+        self.priority = priority
+        self.floor = backend.capacity * PRIORITY_RESERVE[priority]
+        self.lease_size = lease_size
+        self.max_wait_step = max_wait_step
+        self.leased = 0
+        self.lock = threading.Lock()
+        self.counters = {'tokens_spent': 0, 'throttled': 0, 'throttled_seconds': 0.0, 'responses_429': 0}
+
+    def acquire(self, tokens=1, deadline=None):
+        # Blocks until tokens can be spent. The lock is only held to ask the backend, not while waiting.
+        # deadline (time.monotonic()): raises DeadlineExceeded instead of waiting for tokens that would only come
+        # after it
+        throttled = False
+        while True:
+            with self.lock:
+                if self.leased < tokens:
+                    wait_seconds = self.backend.take(max(tokens, self.lease_size), self.floor)
+                    if wait_seconds == 0:
+                        self.leased += max(tokens, self.lease_size)
+                if self.leased >= tokens:
+                    self.leased -= tokens
+                    self.counters['tokens_spent'] += tokens
+                    return
+                if deadline is not None and time.monotonic() + wait_seconds > deadline:
+                    raise DeadlineExceeded(f'{self.caller}: no TfL token before the deadline')
+                if not throttled:
+                    # Without the wait this request could have gone over the key quota and come back as a 429
+                    self.counters['throttled'] += 1
+                    throttled = True
+                wait_seconds = min(wait_seconds, self.max_wait_step)
+                self.counters['throttled_seconds'] += wait_seconds
+            time.sleep(wait_seconds)
+
+    def record_response(self, status_code):
+        if status_code == 429:
+            self.counters['responses_429'] += 1
+
+    def metrics(self):
+        # throttled: requests held back to stay under the quota, i.e. 429s avoided
+        with self.lock:
+            return {'caller': self.caller, 'priority': self.priority, **self.counters,
+                    'throttled_seconds': round(self.counters['throttled_seconds'], 2)}
+
+
+def quota_from_env(caller, priority, storage_client=None):
+    # TFL_QUOTA_BACKEND: 'gcs' (default, every service), 'sqlite' (processes of this host, local runs), 'none'
+    backend_name = os.environ.get('TFL_QUOTA_BACKEND', 'gcs')
+    rate = QUOTA_REQUESTS_PER_MINUTE / 60
+    if backend_name == 'none':
+        return None
+    if backend_name == 'gcs':
+        if storage_client is None:
+            from google.cloud import storage
+            storage_client = storage.Client()
+        backend = GcsQuotaBackend(bucket=storage_client.bucket(QUOTA_BUCKET),
+                                  object_path=os.environ.get('TFL_QUOTA_OBJECT', 'tfl_quota/token_bucket.json'),
+                                  rate_per_second=rate, capacity=QUOTA_BURST)
+        lease_size = int(os.environ.get('TFL_QUOTA_LEASE', 10))
+    else:
+        backend = SqliteQuotaBackend(path=os.environ.get('TFL_QUOTA_PATH', '/tmp/tfl_quota.sqlite3'),
+                                     rate_per_second=rate, capacity=QUOTA_BURST)
+        lease_size = int(os.environ.get('TFL_QUOTA_LEASE', 1))
+    return TflQuota(backend, caller=caller, priority=priority, lease_size=lease_size)
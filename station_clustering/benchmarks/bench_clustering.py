@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import resource
+import multiprocessing
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from clustering import ward_clusters
+
+# python3 benchmarks/bench_clustering.py [sizes...]
+# Full clustering runs on synthetic stop sets: unconstrained ward (the notebook's run, 20k only: its distance
+# matrix does not fit beyond that) versus ward on the k nearest neighbours graph. Every run is a fresh process,
+# peak memory is its max RSS. Agreement is the adjusted Rand index against unconstrained ward, on the 20k stops
+# nearest to a town centre when the whole set is too large for it.
+
+SIZES = [20000, 200000, 1000000]
+REFERENCE_SIZE = 20000
+STOPS_PER_TOWN = 400
+
+
+def synthetic_stops(n, seed=42):
+    # Towns of ~400 stops with London-like spreads, the area grows with n so the stop density stays the same
+    rng = np.random.default_rng(seed)
+    towns = max(1, n // STOPS_PER_TOWN)
+    scale = np.sqrt(n / 20000)
+    centres = np.column_stack([51.5 + rng.normal(0, 0.15 * scale, towns), -0.1 + rng.normal(0, 0.25 * scale, towns)])
+    town = rng.integers(0, towns, n)
+    spread = rng.uniform(0.005, 0.03, towns)[town]
+    points = centres[town] + rng.normal(0, 1, (n, 2)) * spread[:, None]
+    return pd.DataFrame({'latitude': points[:, 0], 'longitud': points[:, 1]})
+
+
+def run(method, stops_df, queue):
+    start = time.perf_counter()
+    labels = ward_clusters(stops_df, method=method)
+    queue.put((labels, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def timed_run(method, stops_df):
+    # Returns (labels, seconds, peak MB) of a run in its own process
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=run, args=(method, stops_df, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def reference_window(stops_df, size=REFERENCE_SIZE):
+    # Row positions of the stops nearest to the first town centre, a contiguous area unconstrained ward can handle
+    if len(stops_df) <= size:
+        return np.arange(len(stops_df))
+    centre = stops_df[['latitude', 'longitud']].iloc[0].to_numpy()
+    distances = ((stops_df[['latitude', 'longitud']].to_numpy() - centre) ** 2).sum(axis=1)
+    return np.sort(np.argpartition(distances, size)[:size])
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    baseline_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{"stops":>9} {"method":<9} {"clusters":>9} {"time":>9} {"peak MB":>9} {"ARI":>6}')
+    for size in sizes:
+        stops_df = synthetic_stops(size)
+        window = reference_window(stops_df)
+        reference_labels, _, _ = timed_run('ward', stops_df.iloc[window].reset_index(drop=True))
+        methods = ['ward', 'knn_ward'] if size <= REFERENCE_SIZE else ['knn_ward']
+        for method in methods:
+            labels, seconds, peak_mb = timed_run(method, stops_df)
+            ari = adjusted_rand_score(reference_labels, labels[window])
+            print(f'{size:>9} {method:<9} {len(np.unique(labels)):>9} {seconds:>8.1f}s {peak_mb:>9.0f} {ari:>6.3f}')
+    print(f'(parent process before the runs: {baseline_mb:.0f} MB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import os
+import json
+from datetime import datetime, timezone
+from google.api_core import exceptions as gcp_exceptions
+from clustering import haversine_km
+
+# Drift of the clusters since the last full run, kept in the bucket:
+#   station_clustering/drift_state.json
+#   {"clustered_at": iso time, "stops_at_full_run": n, "online_assigned": n,
+#    "clusters": {id: [centroid latitude rad, centroid longitud rad, radius km at the full run, radius km now]}}
+# Every stop assigned online counts, and widens the radius of its cluster when it lands outside of it.
+# A full re-cluster runs once either measure passes its threshold.
+
+DRIFT_STATE_PATH = 'station_clustering/drift_state.json'
+# Share of the stops of the last full run assigned online since then
+MAX_ONLINE_FRACTION = float(os.environ.get('CLUSTERING_MAX_ONLINE_FRACTION', 0.05))
+# Growth of the summed cluster radii since the last full run
+MAX_RADIUS_GROWTH = float(os.environ.get('CLUSTERING_MAX_RADIUS_GROWTH', 0.10))
+
+
+class ClusterDrift:
+
+    def __init__(self, state=None, generation=0):
+        self.state = state
+        self.generation = generation
+
+    @classmethod
+    def after_full_run(cls, stop_count, radii, generation=0):
+        # radii: clustering.cluster_radii of the new clusters
+        state = {'clustered_at': datetime.now(timezone.utc).isoformat(), 'stops_at_full_run': stop_count,
+                 'online_assigned': 0,
+                 'clusters': {str(cluster): [lat, lon, radius, radius] for cluster, (lat, lon, radius) in radii.items()}}
+        return cls(state, generation)
+
+    def record_online(self, clusters, latitudes_rad, longitudes_rad):
+        # New stops attached to clusters, a stop further from the centroid than the radius widens it
+        for cluster, lat, lon in zip(clusters, latitudes_rad, longitudes_rad):
+            entry = self.state['clusters'].get(str(int(cluster)))
+            if entry is not None:
+                entry[3] = max(entry[3], float(haversine_km(lat, lon, entry[0], entry[1])))
+        self.state['online_assigned'] += len(clusters)
+
+    def metrics(self):
+        if self.state is None:
+            return {'online_assigned': None, 'online_fraction': None, 'radius_growth': None}
+        base = sum(entry[2] for entry in self.state['clusters'].values())
+        now = sum(entry[3] for entry in self.state['clusters'].values())
+        return {'online_assigned': self.state['online_assigned'],
+                'online_fraction': self.state['online_assigned'] / max(1, self.state['stops_at_full_run']),
+                'radius_growth': now / base - 1 if base > 0 else 0.0}
+
+    def recluster_due(self, max_online_fraction=MAX_ONLINE_FRACTION, max_radius_growth=MAX_RADIUS_GROWTH):
+        # No state yet: the clusters were made by the notebook, the first run re-clusters to get a baseline
+        if self.state is None:
+            return True
+        metrics = self.metrics()
+        return metrics['online_fraction'] > max_online_fraction or metrics['radius_growth'] > max_radius_growth
+
+
+def load_drift(bucket):
+    blob = bucket.blob(DRIFT_STATE_PATH)
+    try:
+        data = blob.download_as_bytes()
+    except gcp_exceptions.NotFound:
+        return ClusterDrift()
+    return ClusterDrift(json.loads(data), blob.generation)
+
+
+def save_drift(bucket, drift):
+    # Generation match: two runs overlapping would otherwise both count their stops against the old state
+    blob = bucket.blob(DRIFT_STATE_PATH)
+    blob.upload_from_string(json.dumps(drift.state), content_type='application/json',
+                            if_generation_match=drift.generation)
+    drift.generation = blob.generation
@@ -0,0 +1,48 @@
+import numpy as np
+from sklearn.neighbors import BallTree
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+class ClusterIndex:
+    # Haversine BallTree over the clustered stops coordinates, built once per cluster table version
+    # and queried in a single batch for every naptanId that has no cluster yet
+
+    def __init__(self, clusterized_stations_df, version=None):
+        self.version = version
+        self.cluster_labels = clusterized_stations_df['clusterAgglomerative'].to_numpy()
+        clustered_coords = np.radians(clusterized_stations_df[['latitude', 'longitude']].to_numpy(dtype=np.float64))
+        self.tree = BallTree(clustered_coords, metric='haversine')
+
+    def __len__(self):
+        return len(self.cluster_labels)
+
+    def query(self, latitudes, longitudes):
+        # Returns (closest cluster, distance in km) for every point, one k-NN query for all of them
+        points = np.radians(np.column_stack([np.asarray(latitudes, dtype=np.float64),
+                                             np.asarray(longitudes, dtype=np.float64)]))
+        if len(points) == 0:
+            return self.cluster_labels[:0], np.empty(0)
+
+        distances, indices = self.tree.query(points, k=1)
+        return self.cluster_labels[indices[:, 0]], distances[:, 0] * EARTH_RADIUS_KM
+
+
+def assign_nearest_clusters(cluster_index, coordinates_df, max_distance_km=None):
+    # Adds clusterAgglomerative + cluster_distance_km to a (latitude, longitude) frame.
+    # Points further than max_distance_km from any clustered stop are left without cluster (NaN)
+
+    coordinates_df = coordinates_df.copy()
+    closest_clusters, distances_km = cluster_index.query(coordinates_df['latitude'], coordinates_df['longitude'])
+
+    coordinates_df['clusterAgglomerative'] = closest_clusters
+    coordinates_df['cluster_distance_km'] = distances_km
+
+    if max_distance_km is not None:
+        too_far = distances_km > max_distance_km
+        if too_far.any():
+            print(f'{int(too_far.sum())} naptanIds are further than {max_distance_km} km from any cluster, they wont be considered')
+            coordinates_df['clusterAgglomerative'] = coordinates_df['clusterAgglomerative'].astype('float64')
+            coordinates_df.loc[too_far, 'clusterAgglomerative'] = np.nan
+
+    return coordinates_df
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+import pandas as pd
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.neighbors import kneighbors_graph
+
+# Clustering of the bus stops, as in stations_clustering.ipynb: ward linkage on (latitude, longitud) in radians
+# cut at distance_threshold=0.001. Cluster ids are kept stable between full runs (relabel_clusters) so only
+# the stops whose cluster really changed are written back, and new stops are attached online to the cluster
+# of their nearest clustered stop (cluster_index.ClusterIndex, same module as the arrivals job) until drift
+# calls for a full run.
+#
+# Full runs: unconstrained ward needs the n x n distances (O(n^2) memory, ~20 s and GBs at 20k stops), so
+# CLUSTERING_METHOD=knn_ward (default) only merges clusters along a k nearest neighbours graph: memory O(n k),
+# the same clusters on London-like data (ARI ~1 at k=15, see benchmarks/bench_clustering.py).
+
+EARTH_RADIUS_KM = 6371.0088
+DISTANCE_THRESHOLD = 0.001
+CLUSTER_COLUMN = 'clusterAgglomerative'
+# 'knn_ward' (scalable) or 'ward' (unconstrained, the notebook's run)
+CLUSTERING_METHOD = os.environ.get('CLUSTERING_METHOD', 'knn_ward')
+KNN_NEIGHBOURS = int(os.environ.get('CLUSTERING_KNN_NEIGHBOURS', 15))
+
+
+def coordinates_rad(stations_df):
+    return np.radians(stations_df[['latitude', 'longitud']].to_numpy(dtype=np.float64))
+
+
+def ward_clusters(stations_df, distance_threshold=DISTANCE_THRESHOLD, method=CLUSTERING_METHOD,
+                  n_neighbors=KNN_NEIGHBOURS):
+    # Full batch run, returns one label per row
+    coords = coordinates_rad(stations_df)
+    if method == 'knn_ward':
+        return knn_ward_labels(coords, distance_threshold, n_neighbors)
+    model = AgglomerativeClustering(distance_threshold=distance_threshold, n_clusters=None, linkage='ward')
+    return model.fit_predict(coords)
+
+
+def knn_ward_labels(coords, distance_threshold=DISTANCE_THRESHOLD, n_neighbors=KNN_NEIGHBOURS):
+    # Ward restricted to the edges of the k nearest neighbours graph. The graph falls apart into separate groups
+    # of stops (towns, isolated stops), each one is clustered on its own: scikit-learn would otherwise join them
+    # with a dense distance matrix between components, which is what this avoids
+    n = len(coords)
+    if n <= n_neighbors + 1:
+        if n < 2:
+            return np.zeros(n, dtype=np.int64)
+        return AgglomerativeClustering(distance_threshold=distance_threshold, n_clusters=None,
+                                       linkage='ward').fit_predict(coords)
+
+    graph = kneighbors_graph(coords, n_neighbors, include_self=False)
+    graph = graph.maximum(graph.T).tocsr()
+    n_components, components = connected_components(graph, directed=False)
+
+    labels = np.empty(n, dtype=np.int64)
+    next_label = 0
+    order = np.argsort(components, kind='stable')
+    bounds = np.searchsorted(components[order], np.arange(n_components + 1))
+    for component in range(n_components):
+        members = order[bounds[component]:bounds[component + 1]]
+        if len(members) == 1:
+            component_labels = np.zeros(1, dtype=np.int64)
+        else:
+            model = AgglomerativeClustering(distance_threshold=distance_threshold, n_clusters=None, linkage='ward',
+                                            connectivity=graph[members][:, members])
+            component_labels = model.fit_predict(coords[members])
+        labels[members] = component_labels + next_label
+        next_label += int(component_labels.max()) + 1
+    return labels
+
+
+def relabel_clusters(stations_df, new_labels, previous_df):
+    # Maps the labels of a new run onto the cluster ids of previous_df (naptanId, clusterAgglomerative): every
+    # new cluster takes the previous id most of its stops had, largest overlaps first, each previous id at most
+    # once. Clusters with no match get ids after the largest previous one
+    new_labels = np.asarray(new_labels)
+    overlap = pd.DataFrame({'naptanId': stations_df['naptanId'].to_numpy(), 'new': new_labels}).merge(
+        previous_df[['naptanId', CLUSTER_COLUMN]], on='naptanId', how='inner')
+    counts = overlap.groupby(['new', CLUSTER_COLUMN]).size().sort_values(ascending=False, kind='stable')
+
+    mapping, taken = {}, set()
+    for (new_label, previous_label), _ in counts.items():
+        if new_label not in mapping and previous_label not in taken:
+            mapping[new_label] = previous_label
+            taken.add(previous_label)
+
+    next_id = int(previous_df[CLUSTER_COLUMN].max()) + 1 if len(previous_df) else 0
+    for new_label in np.unique(new_labels):
+        if new_label not in mapping:
+            mapping[new_label] = next_id
+            next_id += 1
+    return np.array([mapping[label] for label in new_labels], dtype=np.int64)
+
+
+def cluster_radii(stations_df):
+    # {cluster id: (centroid latitude rad, centroid longitud rad, radius km)}, radius is the largest haversine
+    # distance of a stop of the cluster to its centroid
+    coords = coordinates_rad(stations_df)
+    frame = pd.DataFrame({'cluster': stations_df[CLUSTER_COLUMN].to_numpy(), 'lat': coords[:, 0], 'lon': coords[:, 1]})
+    centroids = frame.groupby('cluster')[['lat', 'lon']].transform('mean')
+    frame['distance_km'] = haversine_km(frame['lat'], frame['lon'], centroids['lat'], centroids['lon'])
+    summary = frame.groupby('cluster').agg(lat=('lat', 'mean'), lon=('lon', 'mean'), radius_km=('distance_km', 'max'))
+    return {int(cluster): (row.lat, row.lon, row.radius_km) for cluster, row in summary.iterrows()}
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.asarray(values, dtype=np.float64) for values in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
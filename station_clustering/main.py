@@ -0,0 +1,158 @@
+import os
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery, storage
+from google.api_core import exceptions as gcp_exceptions
+from clustering import CLUSTER_COLUMN, cluster_radii, coordinates_rad, relabel_clusters, ward_clusters
+from cluster_index import ClusterIndex
+from cluster_drift import ClusterDrift, load_drift, save_drift
+
+# Scheduled clustering job. Stops discovered since the last run are attached online to the nearest existing
+# cluster, a full ward re-cluster only runs once the drift passes its thresholds (cluster_drift.py) or with
+# CLUSTERING_FORCE_FULL=1. Only new stops and stops whose cluster changed are merged into the cluster table,
+# so the arrivals job reloads it only when something changed. A full run also removes the stops that are no
+# longer in the raw table.
+
+PROJECT_ID = 'lon-trans-streaming-pipeline'
+DATA_SET = 'bus_density_streaming_pipeline'
+STATIONS_RAW_TABLE = 'stopspoint_coordinates'
+CLUSTER_STATIONS_TABLE = 'stopspoint_coordinates_aggloclusters_enriched'
+BUCKET = os.environ.get('CLUSTERING_BUCKET', 'bus_stop_points')
+
+STATION_COLUMNS = ['naptanId', 'commonName', 'latitude', 'longitud']
+# Other names the coordinates columns are found under
+COLUMN_ALIASES = {'longitude': 'longitud'}
+CLUSTER_TABLE_SCHEMA = [
+    bigquery.SchemaField("naptanId", "STRING"),
+    bigquery.SchemaField("commonName", "STRING"),
+    bigquery.SchemaField("latitude", "FLOAT"),
+    bigquery.SchemaField("longitud", "FLOAT"),
+    bigquery.SchemaField("clusterAgglomerative", "INTEGER"),
+]
+
+
+def table_ref(table):
+    return f'{PROJECT_ID}.{DATA_SET}.{table}'
+
+
+def select_columns(df, columns, table):
+    # Columns by name, a table whose columns were added or reordered still loads the right ones
+    df = df.rename(columns={alias: name for alias, name in COLUMN_ALIASES.items() if name not in df.columns})
+    missing = [column for column in columns if column not in df.columns]
+    if missing:
+        raise ValueError(f'{table} has no column {missing}, found {list(df.columns)}')
+    return df[columns]
+
+
+def load_stations(BQ_client):
+    # Raw coordinates, one row per naptanId (a stop can be in several discovery files)
+    stations_df = BQ_client.list_rows(table_ref(STATIONS_RAW_TABLE)).to_dataframe()
+    stations_df = select_columns(stations_df, STATION_COLUMNS, STATIONS_RAW_TABLE).dropna(subset=['latitude', 'longitud'])
+    return stations_df.drop_duplicates(subset='naptanId', keep='last').reset_index(drop=True)
+
+
+def load_clusters(BQ_client):
+    try:
+        clusters_df = BQ_client.list_rows(table_ref(CLUSTER_STATIONS_TABLE)).to_dataframe()
+    except gcp_exceptions.NotFound:
+        return pd.DataFrame(columns=STATION_COLUMNS + [CLUSTER_COLUMN])
+    return select_columns(clusters_df, STATION_COLUMNS + [CLUSTER_COLUMN], CLUSTER_STATIONS_TABLE)
+
+
+def merge_changed_rows(BQ_client, changed_df, full_df=None, removed_count=0):
+    # Rows go to a staging table and are merged by naptanId, the cluster table is never truncated.
+    # Online runs stage the changed rows only. Full runs (full_df) stage the whole new clustering, flagged with
+    # the changed rows, so the stops missing from it are deleted while unchanged rows are not rewritten
+    if len(changed_df) == 0 and removed_count == 0:
+        print('No cluster changes to write')
+        return 0
+
+    staged_df = changed_df if full_df is None else full_df
+    staged_df = staged_df[STATION_COLUMNS + [CLUSTER_COLUMN]].assign(
+        changed=staged_df['naptanId'].isin(changed_df['naptanId']))
+    staging_table = table_ref(f'{CLUSTER_STATIONS_TABLE}_changes')
+    job_config = bigquery.LoadJobConfig(schema=CLUSTER_TABLE_SCHEMA + [bigquery.SchemaField("changed", "BOOLEAN")],
+                                        write_disposition="WRITE_TRUNCATE")
+    BQ_client.load_table_from_dataframe(dataframe=staged_df, destination=staging_table, job_config=job_config).result()
+
+    delete_clause = 'WHEN NOT MATCHED BY SOURCE THEN DELETE' if full_df is not None else ''
+    merge_query = f"""
+        MERGE `{table_ref(CLUSTER_STATIONS_TABLE)}` T
+        USING `{staging_table}` S
+        ON T.naptanId = S.naptanId
+        WHEN MATCHED AND S.changed THEN
+            UPDATE SET commonName = S.commonName, latitude = S.latitude, longitud = S.longitud,
+                       clusterAgglomerative = S.clusterAgglomerative
+        WHEN NOT MATCHED BY TARGET THEN
+            INSERT (naptanId, commonName, latitude, longitud, clusterAgglomerative)
+            VALUES (S.naptanId, S.commonName, S.latitude, S.longitud, S.clusterAgglomerative)
+        {delete_clause}
+    """
+    BQ_client.query(merge_query).result()
+    print(f'✅ Merged {len(changed_df)} changed rows into {CLUSTER_STATIONS_TABLE}, removed {removed_count} stops')
+    return len(changed_df) + removed_count
+
+
+def changed_rows(new_clusters_df, previous_df):
+    # New stops, and stops whose cluster, name or coordinates differ from the table
+    compared = new_clusters_df.merge(previous_df, on='naptanId', how='left', suffixes=('', '_previous'),
+                                     indicator=True)
+    changed = compared['_merge'] == 'left_only'
+    for column in ['commonName', 'latitude', 'longitud', CLUSTER_COLUMN]:
+        changed |= compared[column].ne(compared[f'{column}_previous']) & compared[column].notna()
+    return new_clusters_df[changed.to_numpy()]
+
+
+def full_recluster(BQ_client, stations_df, clusters_df):
+    print(f'Full ward clustering of {len(stations_df)} stops')
+    labels = relabel_clusters(stations_df, ward_clusters(stations_df), clusters_df)
+    new_clusters_df = stations_df.assign(**{CLUSTER_COLUMN: labels})
+    print(f'{len(np.unique(labels))} clusters')
+    # Stops no longer in the raw table (or without coordinates) leave the cluster table
+    removed_count = int((~clusters_df['naptanId'].isin(new_clusters_df['naptanId'])).sum())
+    merge_changed_rows(BQ_client, changed_rows(new_clusters_df, clusters_df), full_df=new_clusters_df,
+                       removed_count=removed_count)
+    return ClusterDrift.after_full_run(len(new_clusters_df), cluster_radii(new_clusters_df))
+
+
+def main():
+    BQ_client = bigquery.Client(project=PROJECT_ID)
+    bucket = storage.Client(project=PROJECT_ID).bucket(BUCKET)
+
+    drift = load_drift(bucket)
+    stations_df = load_stations(BQ_client)
+    clusters_df = load_clusters(BQ_client)
+    new_stops_df = stations_df[~stations_df['naptanId'].isin(clusters_df['naptanId'])]
+    print(f'{len(stations_df)} stops, {len(clusters_df)} clustered, {len(new_stops_df)} new')
+
+    full_run = os.environ.get('CLUSTERING_FORCE_FULL') == '1' or len(clusters_df) == 0 or drift.recluster_due()
+    if not full_run and len(new_stops_df) == 0:
+        print(f'Nothing to assign, drift: {drift.metrics()}')
+        return
+
+    if not full_run:
+        # Online: nearest clustered stop, counted against the drift before anything is written
+        cluster_index = ClusterIndex(clusters_df.rename(columns={'longitud': 'longitude'}))
+        clusters, distances_km = cluster_index.query(new_stops_df['latitude'], new_stops_df['longitud'])
+        coords = coordinates_rad(new_stops_df)
+        drift.record_online(clusters, coords[:, 0], coords[:, 1])
+        print(f'Assigned {len(new_stops_df)} new stops online (max {distances_km.max():.2f} km away), '
+              f'drift: {drift.metrics()}')
+        full_run = drift.recluster_due()
+        if not full_run:
+            merge_changed_rows(BQ_client, new_stops_df.assign(**{CLUSTER_COLUMN: clusters}))
+
+    if full_run:
+        generation = drift.generation
+        drift = full_recluster(BQ_client, stations_df, clusters_df)
+        drift.generation = generation
+
+    try:
+        save_drift(bucket, drift)
+    except gcp_exceptions.PreconditionFailed:
+        # Another run saved in between, its state stands and the next run counts from it
+        print('Drift state changed while clustering, not saved')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,13 @@
 import streamlit as st
-import pandas as pd
 from datetime import datetime
 import pytz
-from google.cloud import bigquery
-from streamlit_autorefresh import st_autorefresh
-import pydeck as pdk
-from sklearn.preprocessing import MinMaxScaler
+from google.cloud import bigquery, storage
+import os
+from density_queries import cluster_count_deltas, query_cluster_density, query_full_table, snapshot_uri
+from shared_cache import SharedCache
+from deck_payload import build_density_deck, map_theme
+from version_watcher import VersionWatcher
+from playback import PlaybackFrames, version_label
 
 # python3 -m streamlit run app.py
 
@@ -13,111 +15,127 @@ from sklearn.preprocessing import MinMaxScaler
 PROJECT_ID = "lon-trans-streaming-pipeline"
 TABLE_ID = "bus_density_streaming_pipeline.most_recent_predicted_arrivals"
 FULL_TABLE = f"{PROJECT_ID}.{TABLE_ID}"
+SNAPSHOTS_BUCKET = "arrivals_data"
 
 st.set_page_config(layout="wide", page_title="🚌 London Bus Density")
 st.title("🚌 🇬🇧 London Predibus, How many buses are arriving in the next minutes?")
 st.caption("Real-time forecast based on TfL live bus arrival data")
 
-# ---------- AUTO REFRESH ----------
-st_autorefresh(interval=30 * 1000, key="auto_refresh")  # every 30 seconds
-
 # ---------- USER INPUT ----------
 time_window = st.slider("Select forecast window (in minutes)", min_value=1, max_value=20, value=10, step=1)
 
-# ---------- BIGQUERY CONNECTION ----------
-client = bigquery.Client(project=PROJECT_ID)
-
-def red_gray_blue(norm_val):
-    if norm_val < 0.5:
-        # Red (1,0,0) to Gray (128,128,128)
-        t = norm_val / 0.5
-        r = int(255 * (1 - t) + 128 * t)
-        g = int(0 + 128 * t)
-        b = int(0 + 128 * t)
-    else:
-        # Gray (128,128,128) to Blue (0,0,255)
-        t = (norm_val - 0.5) / 0.5
-        r = int(128 * (1 - t))
-        g = int(128 * (1 - t))
-        b = int(128 * (1 - t) + 255 * t)
-    
-    return [b, g, r, 180]  # keep alpha fixed
-
-@st.cache_data(ttl=30)
-def load_data():
-    query = f"SELECT * FROM `{FULL_TABLE}`"
-    return client.query(query).to_dataframe()
-
-df = load_data()
-
-# ---------- PULL TIME----------
-latest_updated_time = df['pull_time'].max()
-st.info(f"Data last updated from TFL: {latest_updated_time.strftime('%Y-%m-%d %H:%M:%S')}")
-
-# ---------- DATA PROCESSING ----------
-df_filtered = df[df['timeToStation'] <= time_window * 60]
-df_grouped = (
-    df_filtered
-    .groupby('clusterAgglomerative')['vehicleId']
-    .nunique()
-    .reset_index(name='buses_approaching')
-    .sort_values(by='buses_approaching', ascending=False)
-    .merge(
-        df.groupby('clusterAgglomerative')[['latitude', 'longitude']].mean().reset_index(),
-        how='left',
-        on='clusterAgglomerative'
-    )
-)
-
-# Normalize bus density to 0–1
-scaler = MinMaxScaler()
-df_grouped['density_norm'] = scaler.fit_transform(df_grouped[['buses_approaching']])
-
-# Map density to color
-df_grouped['color'] = df_grouped['density_norm'].apply(red_gray_blue)
+# Filter, COUNT(DISTINCT) and centroids run in BigQuery, QUERY_MODE=full_table keeps the previous full pull
+QUERY_MODE = os.environ.get('QUERY_MODE', 'pushdown')
+# Data is refreshed when a new snapshot version is published, the TTL is only a fallback
+CACHE_TTL_SECONDS = int(os.environ.get('DASHBOARD_CACHE_TTL_SECONDS', 600))
+VERSION_POLL_SECONDS = float(os.environ.get('DASHBOARD_VERSION_POLL_SECONDS', 2))
 
 # ---------- MAP ----------
+def render_density_map(deck):
+    st.subheader("📍 Map of Bus Density by Cluster")
+    st.pydeck_chart(deck, use_container_width=True, height=1200)
+
+def current_map_theme():
+    london_tz = pytz.timezone("Europe/London")
+    return map_theme(datetime.now(london_tz).hour)
+
+# ---------- PLAYBACK ----------
+# Past densities from the snapshot archive, scrubbed with a time slider instead of following the live data
+mode = st.sidebar.radio("Mode", ["Live", "Playback"], horizontal=True)
+
+@st.cache_resource
+def get_playback_frames():
+    return PlaybackFrames(storage.Client(project=PROJECT_ID), SNAPSHOTS_BUCKET)
+
+if mode == "Playback":
+    playback_frames = get_playback_frames()
+    playback_day = st.sidebar.date_input("Day (UTC)", value=datetime.now(pytz.utc).date())
+    versions = playback_frames.day_versions(playback_day.strftime('%Y-%m-%d'))
+    if not versions:
+        st.warning(f"No archived snapshots on {playback_day}")
+        st.stop()
+
+    version = st.select_slider("Snapshot time", options=versions, value=versions[-1], format_func=version_label)
+    frame = playback_frames.get_frame(version)
+    # Frames next to this one are decoded while the user looks at it
+    playback_frames.prefetch_around(versions, versions.index(version))
+
+    if frame is None or len(frame) == 0:
+        st.info(f"No bus data archived for {version_label(version)}")
+        st.stop()
+    df_frame = frame.rename(columns={f'window_{time_window}': 'buses_approaching'})
+    df_frame = df_frame.loc[df_frame['buses_approaching'] > 0, ['clusterAgglomerative', 'buses_approaching', 'latitude', 'longitude']]
+    st.info(f"Playback of the snapshot published at {version_label(version)}")
+    render_density_map(build_density_deck(df_frame, current_map_theme()))
+    st.stop()
+
+# ---------- SHARED DATA CACHE ----------
+# One set of clients, one manifest watcher and one cache for the whole server process, shared by every session
+@st.cache_resource
+def get_density_cache():
+    client = bigquery.Client(project=PROJECT_ID)
+    storage_client = storage.Client(project=PROJECT_ID)
+    watcher = VersionWatcher(storage_client, SNAPSHOTS_BUCKET, poll_seconds=VERSION_POLL_SECONDS)
+
+    def load_density(key, previous):
+        time_window, query_mode = key
+        current_uri = snapshot_uri(SNAPSHOTS_BUCKET, watcher.current())
+        if previous is not None and previous['snapshot_uri'] == current_uri:
+            # Same snapshot version, nothing new to query
+            return previous
+        if query_mode == 'full_table':
+            df_grouped, latest_updated_time, stats = query_full_table(client, FULL_TABLE, time_window, current_uri)
+        else:
+            df_grouped, latest_updated_time, stats = query_cluster_density(client, FULL_TABLE, time_window, current_uri)
+        # Only the clusters whose count changed since the previous version
+        deltas = cluster_count_deltas(previous['df_grouped'], df_grouped) if previous is not None else None
+        return {'snapshot_uri': current_uri, 'df_grouped': df_grouped, 'deltas': deltas,
+                'latest_updated_time': latest_updated_time, 'stats': stats}
+
+    density_cache = SharedCache(load_density, ttl_seconds=CACHE_TTL_SECONDS, name='density cache')
+    # New version published: every window being watched is reloaded once, in the background
+    watcher.add_listener(lambda manifest: density_cache.refresh_all())
+    return density_cache
+
+density_cache = get_density_cache()
+cache_key = (time_window, QUERY_MODE)
+density = density_cache.get(cache_key)
+latest_updated_time = density['latest_updated_time']
+query_stats = density['stats']
+
+# ---------- LIVE UPDATES ----------
+# Only this fragment runs on a timer, it reads the in-process cache and reruns the page when the data of
+# the selected window moved to a new snapshot version
+@st.fragment(run_every=VERSION_POLL_SECONDS)
+def rerun_on_new_version(rendered_uri):
+    if density_cache.get(cache_key)['snapshot_uri'] != rendered_uri:
+        st.rerun()
+
+rerun_on_new_version(density['snapshot_uri'])
 
-london_tz = pytz.timezone("Europe/London")
-now_in_london = datetime.now(london_tz)
-current_hour = now_in_london.hour
-
-st.subheader("📍 Map of Bus Density by Cluster")
-st.pydeck_chart(
-    pdk.Deck(
-        map_style= "dark" if current_hour > 17 or current_hour < 6 else "light",
-        initial_view_state=pdk.ViewState(
-            latitude=51.5074,
-            longitude=-0.1278,
-            zoom=10,
-            pitch=45,
-        ),
-        layers=[
-            # Scatterplot layer for density
-            pdk.Layer(
-                "ScatterplotLayer",
-                data=df_grouped,
-                get_position='[longitude, latitude]',
-                get_radius="buses_approaching * 30",
-                get_fill_color='color',
-                pickable=True,
-                auto_highlight=True,
-            ),
-            # Text layer for labels
-            pdk.Layer(
-                "TextLayer",
-                data=df_grouped,
-                get_position='[longitude, latitude]',
-                get_text='buses_approaching',
-                get_size=16,
-                get_color=[255, 255, 255],
-                get_angle=0,
-                get_alignment_baseline="'bottom'",
-                billboard=True,
-            )
-        ],
-        tooltip={"text": "{buses_approaching} buses approaching this area"}
-    ),
-    use_container_width=True,
-    height=1200
-)
+# ---------- PULL TIME----------
+if latest_updated_time is not None:
+    st.info(f"Data last updated from TFL: {latest_updated_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+# ---------- QUERY COST ----------
+with st.sidebar.expander("BigQuery query stats"):
+    st.write(f"Query: {query_stats['query']}")
+    st.write(f"Bytes processed: {query_stats['bytes_processed'] / 1024 ** 2:.2f} MB")
+    st.write(f"Bytes billed: {query_stats['bytes_billed'] / 1024 ** 2:.2f} MB")
+    st.write(f"Rows returned: {query_stats['rows']}")
+    st.write(f"Latency: {query_stats['latency_s']} s (cache hit: {query_stats['cache_hit']})")
+    cache_info = density_cache.info(cache_key)
+    st.write(f"Shared cache: age {cache_info['age_s']} s, {cache_info['loads']} loads for {cache_info['reads']} reads")
+
+# ---------- CHANGES ----------
+if density['deltas'] is not None:
+    with st.sidebar.expander(f"Clusters changed in the last update ({len(density['deltas'])})"):
+        st.dataframe(density['deltas'], hide_index=True)
+
+# ---------- LIVE MAP ----------
+# Built and serialised once per snapshot version, window and theme, shared by every session
+@st.cache_resource(max_entries=128)
+def get_density_deck(snapshot_uri, time_window, query_mode, theme, _density):
+    return build_density_deck(_density['df_grouped'], theme)
+
+render_density_map(get_density_deck(density['snapshot_uri'], time_window, QUERY_MODE, current_map_theme(), density))
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from map_styling import add_color_columns, density_colors
+
+# python3 benchmarks/bench_map_styling.py
+# Compares the previous MinMaxScaler + apply(red_gray_blue) styling with the lookup table styling,
+# for the cluster map (~150 points) and stop level maps (10k and 100k points).
+
+POINT_COUNTS = [150, 10000, 100000]
+REPEATS = 5
+
+
+def red_gray_blue(norm_val):
+    # Previous per row color function of the dashboard
+    if norm_val < 0.5:
+        t = norm_val / 0.5
+        r = int(255 * (1 - t) + 128 * t)
+        g = int(0 + 128 * t)
+        b = int(0 + 128 * t)
+    else:
+        t = (norm_val - 0.5) / 0.5
+        r = int(128 * (1 - t))
+        g = int(128 * (1 - t))
+        b = int(128 * (1 - t) + 255 * t)
+    return [b, g, r, 180]
+
+
+def previous_styling(df):
+    from sklearn.preprocessing import MinMaxScaler
+    scaler = MinMaxScaler()
+    df['density_norm'] = scaler.fit_transform(df[['buses_approaching']])
+    df['color'] = df['density_norm'].apply(red_gray_blue)
+    return np.array(df['color'].tolist(), dtype=np.uint8)
+
+
+def lut_styling(df):
+    colors = density_colors(df['buses_approaching'].to_numpy())
+    add_color_columns(df, colors)
+    return colors
+
+
+def best_time(function, df):
+    times = []
+    for _ in range(REPEATS):
+        df_copy = df.copy()
+        start = time.perf_counter()
+        result = function(df_copy)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    start = time.perf_counter()
+    import sklearn.preprocessing  # noqa: F401
+    print(f'sklearn.preprocessing import (cold start cost removed from the dashboard): {time.perf_counter() - start:.3f}s')
+
+    rng = np.random.default_rng(42)
+    print(f"{'points':>7} | {'apply (ms)':>10} | {'lut (ms)':>8} | {'speedup':>7} | {'max channel diff':>16}")
+    for n in POINT_COUNTS:
+        df = pd.DataFrame({'buses_approaching': rng.integers(1, 60, n)})
+        previous_time, previous_colors = best_time(previous_styling, df)
+        lut_time, lut_colors = best_time(lut_styling, df)
+        # The table quantizes the ramp to 256 steps, channels may differ by a couple of units
+        max_diff = np.abs(previous_colors.astype(int) - lut_colors.astype(int)).max()
+        print(f'{n:>7} | {previous_time * 1000:>10.2f} | {lut_time * 1000:>8.2f} | '
+              f'{previous_time / lut_time:>6.1f}x | {max_diff:>16}')
+
+
+if __name__ == '__main__':
+    main()
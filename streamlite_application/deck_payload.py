@@ -0,0 +1,71 @@
+import json
+import pydeck as pdk
+from map_styling import COLOR_COLUMNS, FILL_COLOR_ACCESSOR, add_color_columns, density_colors
+
+# Density map built and serialised once per (snapshot version, window, theme) and shared by every session.
+# st.pydeck_chart calls deck.to_json() on every rerun, PrecomputedDeck returns the JSON made when it was built.
+# pydeck only sends binary attributes through its Jupyter widget, the Streamlit component takes the JSON spec,
+# so the payload is kept small instead: compact JSON, only the columns the layers read, coordinates rounded to ~1 m.
+
+PAYLOAD_COLUMNS = ['longitude', 'latitude', 'buses_approaching'] + COLOR_COLUMNS
+COORDINATE_DECIMALS = 5
+
+
+class PrecomputedDeck(pdk.Deck):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # pydeck indents its JSON, re-encoded compact it is about half the size
+        self.json_payload = json.dumps(json.loads(super().to_json()), separators=(',', ':'))
+
+    def to_json(self):
+        return self.json_payload
+
+
+def map_theme(current_hour):
+    return "dark" if current_hour > 17 or current_hour < 6 else "light"
+
+
+def density_payload(df_grouped):
+    # Bus density normalised to 0–1 and mapped to color through the lookup table
+    payload_df = add_color_columns(df_grouped.copy(), density_colors(df_grouped['buses_approaching'].to_numpy()))
+    payload_df[['longitude', 'latitude']] = payload_df[['longitude', 'latitude']].round(COORDINATE_DECIMALS)
+    return payload_df[PAYLOAD_COLUMNS]
+
+
+def build_density_deck(df_grouped, theme):
+    payload_df = density_payload(df_grouped)
+    return PrecomputedDeck(
+        map_style=theme,
+        initial_view_state=pdk.ViewState(
+            latitude=51.5074,
+            longitude=-0.1278,
+            zoom=10,
+            pitch=45,
+        ),
+        layers=[
+            # Scatterplot layer for density
+            pdk.Layer(
+                "ScatterplotLayer",
+                data=payload_df,
+                get_position='[longitude, latitude]',
+                get_radius="buses_approaching * 30",
+                get_fill_color=FILL_COLOR_ACCESSOR,
+                pickable=True,
+                auto_highlight=True,
+            ),
+            # Text layer for labels
+            pdk.Layer(
+                "TextLayer",
+                data=payload_df,
+                get_position='[longitude, latitude]',
+                get_text='buses_approaching',
+                get_size=16,
+                get_color=[255, 255, 255],
+                get_angle=0,
+                get_alignment_baseline="'bottom'",
+                billboard=True,
+            )
+        ],
+        tooltip={"text": "{buses_approaching} buses approaching this area"}
+    )
@@ -0,0 +1,117 @@
+import json
+import time
+import pandas as pd
+from google.cloud import bigquery
+
+# Bus density queries for the dashboard. The window filter, COUNT(DISTINCT vehicleId) per cluster and the
+# cluster centroids are computed by BigQuery, only ~150 rows come back instead of the whole snapshot.
+# The previous full table pull is kept to compare bytes scanned and latency of both paths.
+#
+# The arrivals job publishes every snapshot under snapshots/<version>/ and points latest/manifest.json at it.
+# The table is an external table over all the versioned snapshots, queries filter on the _FILE_NAME of the
+# version the manifest points at:
+#   bq mk --external_table_definition=PARQUET=gs://arrivals_data/snapshots/*/arrivals_snapshot.parquet \
+#       bus_density_streaming_pipeline.most_recent_predicted_arrivals
+
+CLUSTER_DENSITY_QUERY = """
+    SELECT
+        clusterAgglomerative,
+        COUNT(DISTINCT IF(timeToStation <= @window_seconds, vehicleId, NULL)) AS buses_approaching,
+        AVG(latitude) AS latitude,
+        AVG(longitude) AS longitude,
+        MAX(pull_time) AS pull_time
+    FROM `{table}`
+    WHERE clusterAgglomerative IS NOT NULL
+        AND _FILE_NAME = @snapshot_uri
+    GROUP BY clusterAgglomerative
+    HAVING buses_approaching > 0
+    ORDER BY buses_approaching DESC
+"""
+
+FULL_TABLE_QUERY = "SELECT * FROM `{table}` WHERE _FILE_NAME = @snapshot_uri"
+
+MANIFEST_PATH = 'latest/manifest.json'
+
+
+def read_manifest(storage_client, bucket_name, manifest_path=MANIFEST_PATH):
+    # Small JSON object, tells which snapshot version is the current one
+    blob = storage_client.bucket(bucket_name).blob(manifest_path)
+    return json.loads(blob.download_as_bytes())
+
+
+def snapshot_uri(bucket_name, manifest, file_key='snapshot'):
+    return f"gs://{bucket_name}/{manifest['files'][file_key]}"
+
+
+def run_query(client, query, job_config=None, label='query'):
+    # Returns (dataframe, stats) with the bytes scanned and wall time of the query
+    start = time.perf_counter()
+    query_job = client.query(query, job_config=job_config)
+    df = query_job.to_dataframe()
+    latency = time.perf_counter() - start
+
+    stats = {'query': label,
+             'bytes_processed': query_job.total_bytes_processed or 0,
+             'bytes_billed': query_job.total_bytes_billed or 0,
+             'cache_hit': bool(query_job.cache_hit),
+             'rows': len(df),
+             'latency_s': round(latency, 3)}
+    print(f"BigQuery {label}: {stats['bytes_processed'] / 1024 ** 2:.2f} MB processed, "
+          f"{stats['bytes_billed'] / 1024 ** 2:.2f} MB billed, {stats['rows']} rows, {stats['latency_s']}s, "
+          f"cache hit: {stats['cache_hit']}")
+    return df, stats
+
+
+def latest_pull_time(pull_times):
+    # Snapshots store pull_time as a London time string ('%Y-%m-%d %H:%M:%S'), the app formats a datetime
+    if len(pull_times) == 0:
+        return None
+    return pd.to_datetime(pull_times).max()
+
+
+def query_cluster_density(client, table, time_window, snapshot_uri):
+    # Returns (cluster density dataframe, latest pull time, query stats)
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('window_seconds', 'INT64', time_window * 60),
+        bigquery.ScalarQueryParameter('snapshot_uri', 'STRING', snapshot_uri),
+    ])
+    df_grouped, stats = run_query(client, CLUSTER_DENSITY_QUERY.format(table=table), job_config, label='cluster density')
+    latest_updated_time = latest_pull_time(df_grouped['pull_time'])
+    return df_grouped.drop(columns=['pull_time']), latest_updated_time, stats
+
+
+def group_cluster_density(df, time_window):
+    df_filtered = df[df['timeToStation'] <= time_window * 60]
+    df_grouped = (
+        df_filtered
+        .groupby('clusterAgglomerative')['vehicleId']
+        .nunique()
+        .reset_index(name='buses_approaching')
+        .sort_values(by='buses_approaching', ascending=False)
+        .merge(
+            df.groupby('clusterAgglomerative')[['latitude', 'longitude']].mean().reset_index(),
+            how='left',
+            on='clusterAgglomerative'
+        )
+    )
+    return df_grouped
+
+
+def query_full_table(client, table, time_window, snapshot_uri):
+    # Previous path: whole snapshot pulled and grouped in pandas
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter('snapshot_uri', 'STRING', snapshot_uri),
+    ])
+    df, stats = run_query(client, FULL_TABLE_QUERY.format(table=table), job_config, label='full table')
+    return group_cluster_density(df, time_window), latest_pull_time(df['pull_time']), stats
+
+
+def cluster_count_deltas(previous_df, current_df):
+    # Clusters whose bus count changed between two versions: (clusterAgglomerative, previous, current, change)
+    previous_counts = previous_df.set_index('clusterAgglomerative')['buses_approaching']
+    current_counts = current_df.set_index('clusterAgglomerative')['buses_approaching']
+    counts = pd.concat([previous_counts.rename('previous'), current_counts.rename('current')], axis=1).fillna(0)
+    counts = counts.astype('int64')
+    counts['change'] = counts['current'] - counts['previous']
+    deltas = counts[counts['change'] != 0].reset_index()
+    return deltas.sort_values('change', key=abs, ascending=False, ignore_index=True)
@@ -0,0 +1,58 @@
+import numpy as np
+
+# Vectorized styling of the density map. The red - gray - blue ramp is precomputed once as a 256 entry
+# RGBA lookup table, the normalised density is quantized to 0..255 and used as an index into it.
+# Colors come out as one packed (n, 4) uint8 array in the [b, g, r, alpha] order the map always used, deck.gl
+# reads it as RGBA so quiet clusters render blue and busy clusters red.
+
+LUT_SIZE = 256
+ALPHA = 180
+COLOR_COLUMNS = ['color_r', 'color_g', 'color_b', 'color_a']
+
+
+def red_gray_blue_lut(size=LUT_SIZE, alpha=ALPHA):
+    norm_val = np.linspace(0.0, 1.0, size)
+    low = norm_val < 0.5
+
+    # Red (255,0,0) to Gray (128,128,128) below 0.5, Gray to Blue (0,0,255) above
+    t = np.where(low, norm_val / 0.5, (norm_val - 0.5) / 0.5)
+    r = np.where(low, 255 * (1 - t) + 128 * t, 128 * (1 - t))
+    g = np.where(low, 128 * t, 128 * (1 - t))
+    b = np.where(low, 128 * t, 128 * (1 - t) + 255 * t)
+
+    lut = np.empty((size, 4), dtype=np.uint8)
+    lut[:, 0] = b.astype(np.uint8)
+    lut[:, 1] = g.astype(np.uint8)
+    lut[:, 2] = r.astype(np.uint8)
+    lut[:, 3] = alpha
+    return lut
+
+
+RED_GRAY_BLUE_LUT = red_gray_blue_lut()
+
+
+def min_max_normalize(values):
+    # Same result as MinMaxScaler on one column, a constant column maps to 0
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values
+    low, high = values.min(), values.max()
+    if high == low:
+        return np.zeros_like(values)
+    return (values - low) / (high - low)
+
+
+def density_colors(values, lut=RED_GRAY_BLUE_LUT):
+    # Returns the packed (n, 4) uint8 colors of the raw density values
+    index = np.rint(min_max_normalize(values) * (len(lut) - 1)).astype(np.intp)
+    return lut[index]
+
+
+def add_color_columns(df, colors):
+    # One uint8 column per channel, read by the map layers as '[color_r, color_g, color_b, color_a]'
+    for i, column in enumerate(COLOR_COLUMNS):
+        df[column] = colors[:, i]
+    return df
+
+
+FILL_COLOR_ACCESSOR = '[' + ', '.join(COLOR_COLUMNS) + ']'
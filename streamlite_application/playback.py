@@ -0,0 +1,153 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core import exceptions as gcp_exceptions
+
+# Playback of archived density cubes. The arrivals job appends every snapshot to
+#   archive/density_cubes/_parts/dt=YYYY-MM-DD/hour=HH/<version>.parquet   (open hour, one file per snapshot)
+#   archive/density_cubes/dt=YYYY-MM-DD/hour=HH/frames.parquet             (closed hour, one row group per snapshot)
+# A frame is the density cube of one snapshot version. Decoded frames are kept in a bounded LRU shared by all
+# sessions, frames around the one being shown are decoded in the background so scrubbing does not wait.
+# The versions of a day are listed again at most every PLAYBACK_LISTING_TTL_SECONDS (and when the hour rolls
+# over), not on every rerun of the slider.
+
+ARCHIVE_PREFIX = 'archive/density_cubes'
+PARTS_DIR = '_parts'
+VERSION_COLUMN = 'version'
+LISTING_TTL_SECONDS = float(os.environ.get('PLAYBACK_LISTING_TTL_SECONDS', 30))
+
+
+def version_day(version):
+    # 20250601T120000123456Z --> 2025-06-01
+    return f'{version[0:4]}-{version[4:6]}-{version[6:8]}'
+
+
+def version_label(version):
+    # 20250601T120000123456Z --> 2025-06-01 12:00:00 UTC
+    return f'{version[0:4]}-{version[4:6]}-{version[6:8]} {version[9:11]}:{version[11:13]}:{version[13:15]} UTC'
+
+
+class PlaybackFrames:
+
+    def __init__(self, storage_client, bucket_name, max_frames=1024, prefetch_radius=12, max_workers=2,
+                 listing_ttl_seconds=LISTING_TTL_SECONDS):
+        self.bucket = storage_client.bucket(bucket_name)
+        self.max_frames = max_frames
+        self.prefetch_radius = prefetch_radius
+        self.listing_ttl_seconds = listing_ttl_seconds
+
+        # Reentrant: a future that is already done runs its callback (which takes the lock) right away
+        self.lock = threading.RLock()
+        self.frames = OrderedDict()      # version -> decoded density cube, least recently used first
+        self.frame_sources = {}          # version -> (object path, row group or None for a part file)
+        self.hour_versions = {}          # (compacted object path, generation) -> versions in it
+        self.loading = {}                # object path -> future, one download per object at a time
+        self.day_listings = {}           # day -> (listed at, UTC hour listed in, sorted versions)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='playback prefetch')
+
+    def day_versions(self, day, refresh=False):
+        # Sorted snapshot versions archived on day (YYYY-MM-DD), compacted hours only read their version column
+        # The listing is reused for listing_ttl_seconds within the same UTC hour, refresh=True lists again
+        current_hour = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H')
+        with self.lock:
+            listing = self.day_listings.get(day)
+        if (not refresh and listing is not None and listing[1] == current_hour
+                and time.monotonic() - listing[0] < self.listing_ttl_seconds):
+            return listing[2]
+
+        sources = {}
+        for blob in self.bucket.list_blobs(prefix=f'{ARCHIVE_PREFIX}/{PARTS_DIR}/dt={day}/'):
+            version = blob.name.rsplit('/', 1)[1][:-len('.parquet')]
+            sources[version] = (blob.name, None)
+        for blob in self.bucket.list_blobs(prefix=f'{ARCHIVE_PREFIX}/dt={day}/'):
+            for i, version in enumerate(self.compacted_versions(blob)):
+                # A part can still exist for a version that was just compacted, either source has the same frame
+                sources.setdefault(version, (blob.name, i))
+
+        versions = sorted(sources)
+        with self.lock:
+            self.frame_sources.update(sources)
+            self.day_listings[day] = (time.monotonic(), current_hour, versions)
+        return versions
+
+    def compacted_versions(self, blob):
+        # Versions of the row groups of a compacted hour, read once per object generation
+        key = (blob.name, blob.generation)
+        if key not in self.hour_versions:
+            parquet_file = pq.ParquetFile(pa.BufferReader(blob.download_as_bytes()))
+            self.hour_versions[key] = [
+                parquet_file.read_row_group(i, columns=[VERSION_COLUMN]).column(VERSION_COLUMN)[0].as_py()
+                for i in range(parquet_file.num_row_groups)]
+        return self.hour_versions[key]
+
+    def cached(self, version):
+        with self.lock:
+            return version in self.frames
+
+    def get_frame(self, version):
+        with self.lock:
+            if version in self.frames:
+                self.frames.move_to_end(version)
+                return self.frames[version]
+        try:
+            self.load_source(self.frame_sources[version][0]).result()
+        except gcp_exceptions.NotFound:
+            # Compaction replaced the listed part in between: the frame is in the compacted hour now
+            self.day_versions(version_day(version), refresh=True)
+            self.load_source(self.frame_sources[version][0]).result()
+        with self.lock:
+            # None when the archive holds no rows for this version
+            return self.frames.get(version)
+
+    def load_source(self, path):
+        # Returns the future of the download + decode of one archive object, shared by concurrent callers
+        with self.lock:
+            future = self.loading.get(path)
+            if future is None:
+                future = self.executor.submit(self.decode_source, path)
+                self.loading[path] = future
+                future.add_done_callback(lambda _: self.loading_done(path))
+            return future
+
+    def loading_done(self, path):
+        with self.lock:
+            self.loading.pop(path, None)
+
+    def decode_source(self, path):
+        # A compacted hour is one download, all of its frames are decoded and cached together
+        parquet_file = pq.ParquetFile(pa.BufferReader(self.bucket.blob(path).download_as_bytes()))
+        decoded = []
+        for i in range(parquet_file.num_row_groups):
+            frame_df = parquet_file.read_row_group(i).to_pandas()
+            if len(frame_df) > 0:
+                decoded.append((frame_df[VERSION_COLUMN].iloc[0], frame_df.drop(columns=[VERSION_COLUMN])))
+        if not decoded and f'/{PARTS_DIR}/' in path:
+            # Snapshot with no bus in any cluster: its version comes from the part name, the frame is empty
+            empty_df = parquet_file.schema_arrow.empty_table().to_pandas().drop(columns=[VERSION_COLUMN])
+            decoded.append((path.rsplit('/', 1)[1][:-len('.parquet')], empty_df))
+
+        with self.lock:
+            for version, frame_df in decoded:
+                self.frames[version] = frame_df
+                self.frames.move_to_end(version)
+            while len(self.frames) > self.max_frames:
+                self.frames.popitem(last=False)
+
+    def prefetch_around(self, versions, position):
+        # Neighbouring frames of versions[position], nearest first, decoded in the background
+        neighbours = []
+        for offset in range(1, self.prefetch_radius + 1):
+            neighbours += [position + offset, position - offset]
+        paths = []
+        for i in neighbours:
+            if 0 <= i < len(versions) and not self.cached(versions[i]):
+                path = self.frame_sources[versions[i]][0]
+                if path not in paths:
+                    paths.append(path)
+        for path in paths:
+            self.load_source(path)
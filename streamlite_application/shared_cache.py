@@ -0,0 +1,145 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Process-wide cache shared by every dashboard session (held in st.cache_resource).
+#   - single flight: one load per key at a time, concurrent readers of a missing key wait for the same load
+#   - refresh ahead: a background thread reloads keys shortly before their TTL expires
+#   - stale while refreshing: readers always get the last loaded value, never wait for a refresh
+# Only the very first read of a key waits for the loader. N viewers cost one load per key and TTL.
+
+
+class CacheEntry:
+
+    def __init__(self):
+        self.value = None
+        self.loaded_at = None  # monotonic time of the last successful load, None until the first one
+        self.last_read = time.monotonic()
+        self.refreshing = False
+        self.reload_requested = False  # refresh_all() called while a load was running
+        self.error = None
+        self.ready = threading.Event()
+
+
+class SharedCache:
+
+    def __init__(self, loader, ttl_seconds=30, refresh_ahead_seconds=5, idle_seconds=300,
+                 max_refresh_workers=4, name='shared cache'):
+        # loader(key, previous_value) -> value, previous_value is None on the first load
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.refresh_ahead_seconds = min(refresh_ahead_seconds, ttl_seconds)
+        self.idle_seconds = idle_seconds
+        self.name = name
+
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stats = {'reads': 0, 'loads': 0, 'waits': 0, 'load_errors': 0}
+
+        self.executor = ThreadPoolExecutor(max_workers=max_refresh_workers, thread_name_prefix=f'{name} refresh')
+        self.stop_event = threading.Event()
+        self.refresher = threading.Thread(target=self.refresh_loop, name=f'{name} refresher', daemon=True)
+        self.refresher.start()
+
+    def get(self, key):
+        with self.lock:
+            self.stats['reads'] += 1
+            entry = self.entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = self.entries[key] = CacheEntry()
+                entry.refreshing = True
+            entry.last_read = time.monotonic()
+
+            if entry.loaded_at is not None:
+                # Served even when past the TTL, the refresher is already reloading it
+                if self.age(entry) >= self.ttl_seconds and not entry.refreshing:
+                    entry.refreshing = True
+                    self.executor.submit(self.load, key, entry)
+                return entry.value
+            if not owner:
+                self.stats['waits'] += 1
+
+        if owner:
+            self.load(key, entry)
+        else:
+            entry.ready.wait()
+
+        if entry.loaded_at is None:
+            raise entry.error
+        return entry.value
+
+    def age(self, entry):
+        return time.monotonic() - entry.loaded_at
+
+    def load(self, key, entry):
+        try:
+            value = self.loader(key, entry.value)
+        except Exception as e:
+            print(f'{self.name}: load of {key} failed: {e}')
+            with self.lock:
+                self.stats['load_errors'] += 1
+                entry.error = e
+                entry.refreshing = False
+                if entry.loaded_at is None:
+                    # Nothing to serve, the next reader retries the load
+                    self.entries.pop(key, None)
+            entry.ready.set()
+            return
+
+        with self.lock:
+            self.stats['loads'] += 1
+            entry.value = value
+            entry.loaded_at = time.monotonic()
+            entry.error = None
+            reload_requested, entry.reload_requested = entry.reload_requested, False
+            entry.refreshing = reload_requested
+        entry.ready.set()
+        if reload_requested:
+            # The loaded value may predate the refresh_all() call, load once more
+            self.executor.submit(self.load, key, entry)
+
+    def refresh_loop(self):
+        tick = max(0.5, self.refresh_ahead_seconds / 2)
+        while not self.stop_event.wait(tick):
+            now = time.monotonic()
+            due = []
+            with self.lock:
+                for key, entry in list(self.entries.items()):
+                    if entry.refreshing or entry.loaded_at is None:
+                        continue
+                    if now - entry.last_read > self.idle_seconds:
+                        # Nobody looked at this key for a while, stop refreshing it
+                        del self.entries[key]
+                        continue
+                    if now - entry.loaded_at >= self.ttl_seconds - self.refresh_ahead_seconds:
+                        entry.refreshing = True
+                        due.append((key, entry))
+            for key, entry in due:
+                self.executor.submit(self.load, key, entry)
+
+    def refresh_all(self):
+        # Reloads every key in the background right away, e.g. when the data source announces a new version
+        with self.lock:
+            due = []
+            for key, entry in self.entries.items():
+                if entry.refreshing:
+                    entry.reload_requested = True
+                elif entry.loaded_at is not None:
+                    entry.refreshing = True
+                    due.append((key, entry))
+        for key, entry in due:
+            self.executor.submit(self.load, key, entry)
+
+    def info(self, key):
+        # Age and state of a key, for the dashboard sidebar
+        with self.lock:
+            entry = self.entries.get(key)
+            stats = dict(self.stats)
+            if entry is None or entry.loaded_at is None:
+                return {**stats, 'age_s': None, 'refreshing': entry is not None}
+            return {**stats, 'age_s': round(self.age(entry), 1), 'refreshing': entry.refreshing}
+
+    def close(self):
+        self.stop_event.set()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,68 @@
+import json
+import threading
+from density_queries import MANIFEST_PATH
+
+# Update channel of the dashboard. One thread per server process watches latest/manifest.json, the pointer
+# the arrivals job swaps when a snapshot is published. Every poll is a metadata request on the manifest
+# object, the manifest itself is only downloaded when its generation changes. Listeners are called with
+# the new manifest, sessions compare versions instead of rerunning on a timer.
+
+
+class VersionWatcher:
+
+    def __init__(self, storage_client, bucket_name, manifest_path=MANIFEST_PATH, poll_seconds=2.0):
+        self.blob = storage_client.bucket(bucket_name).blob(manifest_path)
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.generation = None
+        self.manifest = None
+
+        # First read is synchronous so the dashboard has a version to render straight away
+        self.poll()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.watch, name='manifest watcher', daemon=True)
+        self.thread.start()
+
+    def add_listener(self, listener):
+        # listener(manifest), called from the watcher thread on every new version
+        with self.lock:
+            self.listeners.append(listener)
+
+    def current(self):
+        with self.lock:
+            return self.manifest
+
+    def poll(self):
+        # Returns True when a new version was found
+        self.blob.reload()
+        if self.blob.generation == self.generation:
+            return False
+
+        manifest = json.loads(self.blob.download_as_bytes(if_generation_match=self.blob.generation))
+        with self.lock:
+            previous_version = self.manifest['version'] if self.manifest is not None else None
+            self.manifest = manifest
+            self.generation = self.blob.generation
+            listeners = list(self.listeners)
+
+        if manifest['version'] == previous_version:
+            return False
+        print(f"New snapshot version {manifest['version']} (previous {previous_version})")
+        for listener in listeners:
+            try:
+                listener(manifest)
+            except Exception as e:
+                print(f'Version listener failed: {e}')
+        return True
+
+    def watch(self):
+        while not self.stop_event.wait(self.poll_seconds):
+            try:
+                self.poll()
+            except Exception as e:
+                # Manifest swapped between reload and download, or a transient error: next poll retries
+                print(f'Manifest poll failed: {e}')
+
+    def close(self):
+        self.stop_event.set()